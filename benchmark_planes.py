@@ -0,0 +1,78 @@
+import random
+import timeit
+
+import chess
+import numpy as np
+
+from board import BughouseBoard
+from planes import BOARD_PLANES, CLOCK_PLANES, CLOCK_SCALE, MODE_PLANE, NUM_PLANES, POCKET_SCALE, PROMOTED_PLANE, \
+    TEAM_PLANE, TURN_PLANE, PlaneEncoder, read_positions
+
+
+# --------------------------
+# Straightforward per-square encoder, kept here as the baseline
+# --------------------------
+def loop_encode(positions, out):
+    out[:len(positions)] = 0
+    for i, (board, side, mode) in enumerate(positions):
+        planes = out[i]
+        for b in range(2):
+            cb = board.boards[b]
+            base = b * BOARD_PLANES
+            for square in chess.SQUARES:
+                piece = cb.piece_at(square)
+                if piece is not None:
+                    offset = 0 if piece.color == chess.WHITE else 6
+                    planes[base + offset + piece.piece_type - 1, square // 8, square % 8] = 1
+                if cb.promoted & chess.BB_SQUARES[square]:
+                    planes[base + PROMOTED_PLANE, square // 8, square % 8] = 1
+            for j, piece_type in enumerate((chess.PAWN, chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN)):
+                planes[base + 12 + j] = cb.pockets[chess.WHITE].count(piece_type) / POCKET_SCALE
+                planes[base + 17 + j] = cb.pockets[chess.BLACK].count(piece_type) / POCKET_SCALE
+            planes[base + TURN_PLANE] = cb.turn == chess.WHITE
+            planes[base + CLOCK_PLANES] = board.times[b][chess.WHITE] / CLOCK_SCALE
+            planes[base + CLOCK_PLANES + 1] = board.times[b][chess.BLACK] / CLOCK_SCALE
+        planes[TEAM_PLANE] = side == chess.WHITE
+        planes[MODE_PLANE] = mode == "sit"
+    return out[:len(positions)]
+
+
+def random_positions(count, seed=0):
+    """
+    Positions from random bughouse games, so that pockets and promoted pieces show up.
+    """
+    rng = random.Random(seed)
+    positions = read_positions()
+    while len(positions) < count:
+        board = BughouseBoard()
+        for ply in range(rng.randint(20, 120)):
+            board_num = rng.randint(0, 1)
+            moves = list(board.boards[board_num].legal_moves)
+            if not moves:
+                break
+            board.push(board_num, rng.choice(moves))
+            if ply % 4 == 0:
+                board.times = [[rng.randint(0, 1800) for _ in range(2)] for _ in range(2)]
+                positions.append((board.copy(stack=False), rng.random() < 0.5, rng.choice(("go", "sit"))))
+    return positions[:count]
+
+
+def main():
+    positions = random_positions(8192)
+    for batch_size in (256, 1024, 8192):
+        batch = positions[:batch_size]
+        encoder = PlaneEncoder(batch_size)
+        expected = np.zeros((batch_size, NUM_PLANES, 8, 8), dtype=np.float32)
+        assert np.array_equal(encoder.encode(batch), loop_encode(batch, expected))
+
+        number = max(1, 4096 // batch_size)
+        loop = min(timeit.repeat(lambda: loop_encode(batch, expected), number=1, repeat=3))
+        fast = min(timeit.repeat(lambda: encoder.encode(batch), number=number, repeat=5)) / number
+        print(f"--- batch of {batch_size} ---")
+        print(f"{'per-square loop':<20} {batch_size / loop:12.0f} positions/s")
+        print(f"{'PlaneEncoder':<20} {batch_size / fast:12.0f} positions/s")
+        print(f"speedup: {loop / fast:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import math
+import timeit
+
+import chess
+
+from tcn import tcn_decode, tcn_decode_packed, tcn_encode
+
+# Both boards of a real bughouse game (see engine.py), 102 and 75 plies.
+GAME = [
+    'mC!Tbs0SlBZRgv5QfH90BJ8!JQXQHQ45=V2VcVTEV979eg-D-uEKvKRK-N=xNDKDCK+XdE92ExXQuE6Xnv0IghIB+TBKTK-MEV!9K292xE1TED-UDY&0Y0U0VE0L*Y=0Y0L0+V21VMTMae0LsCQCvC*DfDMD-M10+T08=18Z-KZYMSYRCLXohoDvKv=xox-nEn=EnE-nEn+E',
+    'lB0KBK5Qgv70bsQKsJKvov07mC=SJs9ziqzsjs-y=j*R=t-Fhg=U+M-ofoFogo=xog+T+F&ogoxo-gTMcM=TMuUMFw=D+mDunu3NwRYR-nNF=r=wnxwpelp{dg&w+pwxry-fmfo{af*ogoxo*n-blc',
+]
+
+
+# --------------------------
+# Previous implementation, kept here as the baseline
+# --------------------------
+def legacy_tcn_decode(n):
+    tcn_chars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!?{~}(^)[_]@#$,./&-*++='
+    piece_chars = 'qnrbkp'
+    c = []
+    for i in range(0, len(n), 2):
+        u = {'from_square': None, 'to_square': None, 'drop': None, 'promotion': None}
+        o = tcn_chars.index(n[i])
+        s = tcn_chars.index(n[i + 1])
+        if s > 63:
+            u['promotion'] = piece_chars[math.floor((s - 64) / 3)]
+            s = o + (-8 if o < 16 else 8) + ((s - 1) % 3) - 1
+        if o > 75:
+            u['drop'] = piece_chars[o - 79]
+        else:
+            u['from_square'] = tcn_chars[o % 8] + str(math.floor(o / 8) + 1)
+        u['to_square'] = tcn_chars[s % 8] + str(math.floor(s / 8) + 1)
+        c.append(chess.Move(
+            from_square=chess.parse_square(u['to_square'] if u['from_square'] is None else u['from_square']),
+            to_square=chess.parse_square(u['to_square']),
+            drop=None if u['drop'] is None else chess.Piece.from_symbol(u['drop']).piece_type,
+            promotion=None if u['promotion'] is None else chess.Piece.from_symbol(u['promotion']).piece_type,
+        ))
+    return c
+
+
+def legacy_tcn_encode(n):
+    tcn_chars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!?{~}(^)[_]@#$,./&-*++='
+    piece_chars = 'qnrbkp'
+    w = ''
+    for i in range(len(n)):
+        if n[i][1] == '@':
+            s = 79 + piece_chars.index(n[i][0].lower())
+        else:
+            s = tcn_chars.index(n[i][0]) + 8 * (int(n[i][1]) - 1)
+        u = tcn_chars.index(n[i][2]) + 8 * (int(n[i][3]) - 1)
+        if len(n[i]) > 4:
+            add_u = 9 + u - s if u < s else u - s - 7
+            u = 3 * piece_chars.index(n[i][4]) + 64 + add_u
+        w += tcn_chars[s]
+        w += tcn_chars[u]
+    return w
+
+
+def bench(label, fn, plies, number):
+    seconds = min(timeit.repeat(fn, number=number, repeat=5)) / number
+    print(f"{label:<32} {seconds * 1e6:10.1f} us/game {plies / seconds / 1e6:8.2f} Mplies/s")
+    return seconds
+
+
+def main():
+    for repeat in (1, 4, 16):
+        game = GAME[0] * repeat
+        data = game.encode('ascii')
+        uci = [move.uci() for move in tcn_decode(game)]
+        plies = len(uci)
+        number = max(1, 2000 // repeat)
+
+        assert legacy_tcn_decode(game) == tcn_decode(game) == tcn_decode(data)
+        assert legacy_tcn_encode(uci) == tcn_encode(uci) == game
+
+        print(f"--- {plies} plies ---")
+        legacy = bench("legacy tcn_decode", lambda: legacy_tcn_decode(game), plies, number)
+        bench("legacy tcn_decode per pair", lambda: [legacy_tcn_decode(game[i:i + 2])[0] for i in range(0, len(game), 2)], plies, number)
+        fast = bench("tcn_decode (str)", lambda: tcn_decode(game), plies, number)
+        bench("tcn_decode (bytes)", lambda: tcn_decode(data), plies, number)
+        bench("tcn_decode_packed", lambda: tcn_decode_packed(game), plies, number)
+        print(f"decode speedup: {legacy / fast:.1f}x")
+
+        legacy = bench("legacy tcn_encode", lambda: legacy_tcn_encode(uci), plies, number)
+        fast = bench("tcn_encode", lambda: tcn_encode(uci), plies, number)
+        bench("tcn_encode per move", lambda: [tcn_encode([move]) for move in uci], plies, number)
+        print(f"encode speedup: {legacy / fast:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,60 @@
+import random
+from collections import OrderedDict
 from typing import List
 
 import chess
 from chess.variant import CrazyhouseBoard, CrazyhousePocket
 
+PIECE_VALUES = {
+    chess.PAWN: 1,
+    chess.KNIGHT: 3,
+    chess.BISHOP: 3,
+    chess.ROOK: 5,
+    chess.QUEEN: 9,
+    chess.KING: 0,
+}
+
+# Zobrist keys, indexed by board number first. They come from a fixed seed so that
+# hashes stay valid in caches and books that outlive the process.
+_zobrist_random = random.Random(0x6E6163686F73)
+ZOBRIST_PIECES = [[[[_zobrist_random.getrandbits(64) for _ in chess.SQUARES] for _ in range(7)] for _ in chess.COLORS] for _ in range(2)]
+ZOBRIST_PROMOTED = [[_zobrist_random.getrandbits(64) for _ in chess.SQUARES] for _ in range(2)]
+ZOBRIST_CASTLING = [[_zobrist_random.getrandbits(64) for _ in chess.SQUARES] for _ in range(2)]
+ZOBRIST_EP = [[_zobrist_random.getrandbits(64) for _ in chess.FILE_NAMES] for _ in range(2)]
+ZOBRIST_BLACK_TO_MOVE = [_zobrist_random.getrandbits(64) for _ in range(2)]
+# Pocket counts above this share the last key.
+ZOBRIST_POCKET_LIMIT = 32
+# Positions per BughouseBoard (and its copies) whose legal move sets are kept.
+LEGAL_CACHE_SIZE = 4096
+POCKET_PIECE_TYPES = [chess.PAWN, chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN]
+ZOBRIST_POCKETS = [[[[0] + [_zobrist_random.getrandbits(64) for _ in range(ZOBRIST_POCKET_LIMIT)] for _ in range(7)] for _ in chess.COLORS] for _ in range(2)]
+
+
+class UndoRecord:
+    """
+    What BughouseBoard.pop needs to take back a push besides the board's own move stack,
+    which already restores the pieces, promoted mask and pockets of the board moved on.
+    """
+
+    __slots__ = ('captured', 'captured_promoted', 'partner_color')
+
+    def __init__(self, captured, captured_promoted, partner_color):
+        self.captured = captured  # Piece type passed to the partner's pocket, or None
+        self.captured_promoted = captured_promoted  # The captured piece was a promoted pawn
+        self.partner_color = partner_color  # Pocket on the other board that received it
+
+
+class BoardSnapshot:
+    """
+    A position to come back to with BughouseBoard.restore.
+    """
+
+    __slots__ = ('ply', 'zobrist')
+
+    def __init__(self, ply, zobrist):
+        self.ply = ply
+        self.zobrist = zobrist
+
 
 class BughouseBoard(object):
     def __init__(self, time_control: int = 1800) -> None:
@@ -10,17 +62,61 @@ class BughouseBoard(object):
         self.times = [[time_control for _ in range(2)] for _ in range(2)]
         self.board_order = []
         self.move_history = []
+        self.undo_stack = []  # UndoRecord for every move in move_history
+        self.zobrist = 0  # Incremental hash of both boards and pockets, see compute_zobrist
+        self.board_zobrist = [0, 0]  # The same per board; board_zobrist[0] ^ board_zobrist[1] == zobrist
+        self._legal_cache = OrderedDict()  # (board_num, board hash) -> frozenset of UCI moves
         self.reset()
 
     def __copy__(self):
-        ret = BughouseBoard(1200)
+        return self.copy()
+
+    def copy(self, stack: bool = True) -> "BughouseBoard":
+        """
+        Clone the position without going through FEN.
 
-        fen = self.fen()
-        ret.boards[0].set_fen(fen[0])
-        ret.boards[1].set_fen(fen[1])
-        ret.times = self.times.copy()
+        :param stack: Also copy the move history so the clone can pop. Without it the clone
+            is much cheaper (python-chess replays the stack to copy it) but starts with an
+            empty history.
+        :return: The new BughouseBoard.
+        """
+        ret = BughouseBoard.__new__(BughouseBoard)
+        ret.boards = [board.copy(stack=stack) for board in self.boards]
+        ret.times = [list(times) for times in self.times]
+        if stack:
+            ret.board_order = self.board_order[:]
+            ret.move_history = self.move_history[:]
+            ret.undo_stack = self.undo_stack[:]
+        else:
+            ret.board_order = []
+            ret.move_history = []
+            ret.undo_stack = []
+        ret.zobrist = self.zobrist
+        ret.board_zobrist = self.board_zobrist[:]
+        ret._legal_cache = self._legal_cache  # Keyed by hash, so it is valid for every copy
         return ret
 
+    def snapshot(self) -> BoardSnapshot:
+        """
+        Mark the current position so that moves pushed afterwards can be taken back with restore.
+        """
+        return BoardSnapshot(len(self.move_history), self.zobrist)
+
+    def restore(self, snapshot: BoardSnapshot) -> None:
+        """
+        Pop every move pushed since a snapshot was taken.
+
+        :param snapshot: A BoardSnapshot of this board.
+        :raises ValueError: If the history no longer leads back to the snapshot, e.g. because
+            moves before it were popped or the board was reset since.
+        """
+        if snapshot.ply > len(self.move_history):
+            raise ValueError("moves before the snapshot have been popped")
+        while len(self.move_history) > snapshot.ply:
+            self.pop()
+        if self.zobrist != snapshot.zobrist:
+            raise ValueError("position differs from the snapshot")
+
     def result(self):
         if self.boards[0].is_checkmate() or self.boards[0].is_stalemate():
             if self.turn(0) == chess.WHITE:
@@ -47,17 +143,32 @@ class BughouseBoard(object):
             board.set_fen(chess.STARTING_FEN)
             for color in colors:
                 board.pockets[color].reset()
+        self._clear_history()
+        self._rehash()
 
     def reset_board(self, board_num: int) -> None:
         self.boards[board_num].set_fen(chess.STARTING_FEN)
+        # That board's move stack is gone; moves on the other board can still be popped.
+        keep = [i for i, b in enumerate(self.board_order) if b != board_num]
+        self.board_order = [self.board_order[i] for i in keep]
+        self.move_history = [self.move_history[i] for i in keep]
+        self.undo_stack = [self.undo_stack[i] for i in keep]
+        self._rehash()
 
     def set_times(self, times: List[int]) -> None:
         self.times = times
 
     def set_fen(self, fen: str) -> None:
-        fen = fen.split(" | ")
-        self.boards[0].set_fen(fen[0])
-        self.boards[1].set_fen(fen[1])
+        fen = fen.split("|")
+        self.boards[0].set_fen(fen[0].strip())
+        self.boards[1].set_fen(fen[1].strip())
+        self._clear_history()
+        self._rehash()
+
+    def _clear_history(self) -> None:
+        self.board_order = []
+        self.move_history = []
+        self.undo_stack = []
 
     def fen(self):
         return (
@@ -74,6 +185,8 @@ class BughouseBoard(object):
     def swap_boards(self) -> None:
         self.boards = self.boards[::-1]
         self.times = self.times[::-1]
+        self.board_order = [1 - board_num for board_num in self.board_order]
+        self._rehash()
 
     def time_advantage(self, side: chess.Color) -> int:
         return self.times[0][side] - self.times[1][side]
@@ -90,23 +203,37 @@ class BughouseBoard(object):
 
         is_capture = False if move.drop else board.is_capture(move)
         captured = None
+        is_promotion = False
         if is_capture:
             captured = board.piece_type_at(move.to_square)
             if captured is None:
                 captured = chess.PAWN
-            is_promotion = board.promoted & (1 << move.to_square)
+            is_promotion = bool(board.promoted & (1 << move.to_square))
             if is_promotion:
                 captured = chess.PAWN
+        undo = UndoRecord(captured, is_promotion, not board.turn)
+
+        piece_types = [piece_type for piece_type in (move.drop, captured) if piece_type is not None]
+        squares = _touched_squares(move)
+        key = self._squares_key(board_num, squares) ^ self._state_key(board_num) ^ self._pockets_key(board_num, piece_types)
+
+        if is_capture:
             partner_pocket = other.pockets[not board.turn]
+            partner_key = self._pocket_key(not board_num, not board.turn, captured)
             partner_pocket.add(captured)
+            self._update_zobrist(not board_num, partner_key ^ self._pocket_key(not board_num, not board.turn, captured))
 
         board.push(move)
         if is_capture:
             opponent_pocket = board.pockets[not board.turn]
             opponent_pocket.remove(captured)
 
+        key ^= self._squares_key(board_num, squares) ^ self._state_key(board_num) ^ self._pockets_key(board_num, piece_types)
+        self._update_zobrist(board_num, key)
+
         self.move_history.append(move)
         self.board_order.append(board_num)
+        self.undo_stack.append(undo)
 
         return move.uci()
 
@@ -122,20 +249,23 @@ class BughouseBoard(object):
     def pop(self) -> None:
         last_move = self.move_history.pop()
         last_board = self.board_order.pop()
+        undo = self.undo_stack.pop()
 
         board = self.boards[last_board]
         other = self.boards[not last_board]
+        squares = _touched_squares(last_move)
+        # board.pop() restores the whole pocket of that board, so all of it is rehashed.
+        key = self._squares_key(last_board, squares) ^ self._state_key(last_board) ^ self._pockets_key(last_board)
         board.pop()
 
-        if board.is_capture(last_move):
-            captured = board.piece_type_at(last_move.to_square)
-            if captured is None:
-                captured = chess.PAWN
-            is_promotion = board.promoted & (1 << last_move.to_square)
-            if is_promotion:
-                captured = chess.PAWN
-            partner_pocket = other.pockets[not board.turn]
-            partner_pocket.remove(captured)
+        if undo.captured is not None:
+            partner_pocket = other.pockets[undo.partner_color]
+            partner_key = self._pocket_key(not last_board, undo.partner_color, undo.captured)
+            partner_pocket.remove(undo.captured)
+            self._update_zobrist(not last_board, partner_key ^ self._pocket_key(not last_board, undo.partner_color, undo.captured))
+
+        key ^= self._squares_key(last_board, squares) ^ self._state_key(last_board) ^ self._pockets_key(last_board)
+        self._update_zobrist(last_board, key)
 
     def parse_uci(self, board_num: int, move_uci: str) -> chess.Move:
         return self.boards[board_num].parse_uci(move_uci)
@@ -173,7 +303,9 @@ class BughouseBoard(object):
             pocket = self.boards[board_num].pockets[self.turn(board_num)]
             # If the piece to be dropped is not available in the pocket, add it first.
             if pocket.count(move.drop) < 1:
+                key = self._pocket_key(board_num, self.turn(board_num), move.drop)
                 pocket.add(move.drop)
+                self._update_zobrist(board_num, key ^ self._pocket_key(board_num, self.turn(board_num), move.drop))
 
         # Play the move as normal (drop or standard move).
         self.push(board_num, move)
@@ -207,8 +339,10 @@ class BughouseBoard(object):
         black_pocket = CrazyhousePocket(black_symbols)
 
         # Update the board's pockets for white and black.
+        key = self._pockets_key(board_num)
         board.pockets[chess.WHITE] = white_pocket
         board.pockets[chess.BLACK] = black_pocket
+        self._update_zobrist(board_num, key ^ self._pockets_key(board_num))
 
     def get_hand(self, board_num: int) -> str:
         hand = ""
@@ -218,8 +352,155 @@ class BughouseBoard(object):
             hand += symbols[piece] * self.boards[board_num].pockets[chess.BLACK].count(piece)
         return hand
 
-    def is_legal(self, board_num: int, move: str) -> bool:
-        return chess.Move.from_uci(move) in self.boards[board_num].legal_moves
+    def is_legal(self, board_num: int, move) -> bool:
+        """
+        Check a single move.
+
+        If the legal moves of the position were listed before, the answer comes from that
+        cached set. Otherwise only this move is checked, with python-chess's bitboard tests
+        (pocket, occupancy and check mask for drops, pins and king safety for other moves),
+        so no other move is generated.
+
+        :param move: A chess.Move or a UCI string such as "e2e4" or "P@e5".
+        """
+        cached = self._legal_cache.get((board_num, self.board_zobrist[board_num]))
+        if isinstance(move, str):
+            if cached is not None:
+                if len(move) > 1 and move[1] == '@':
+                    move = move[0].upper() + move[1:]
+                return move in cached
+            try:
+                move = chess.Move.from_uci(move)
+            except ValueError:
+                return False
+        elif cached is not None:
+            return move.uci() in cached
+        return self.boards[board_num].is_legal(move)
+
+    def legal_moves(self, board_num: int) -> frozenset:
+        """
+        The legal moves on a board as UCI strings, cached by the board's hash.
+
+        Only the hash of that board and its pockets is used, so moves on the other board
+        do not invalidate the entry unless they change this board's pockets.
+        """
+        key = (board_num, self.board_zobrist[board_num])
+        moves = self._legal_cache.get(key)
+        if moves is None:
+            moves = frozenset(move.uci() for move in self.boards[board_num].legal_moves)
+            self._legal_cache[key] = moves
+            if len(self._legal_cache) > LEGAL_CACHE_SIZE:
+                self._legal_cache.popitem(last=False)
+        return moves
+
+    def likely_captures(self, board_num: int) -> List[tuple]:
+        """
+        Rank the captures available to the side to move on a board, most likely first.
+
+        A capture scores the value of the captured piece, minus the value of the capturing
+        piece when the target square is defended, so free pieces come first.
+
+        :return: A list of (score, move) tuples.
+        """
+        board = self.boards[board_num]
+        captures = []
+        for move in board.generate_legal_captures():
+            captured = board.piece_type_at(move.to_square) or chess.PAWN  # en passant
+            score = PIECE_VALUES[captured]
+            if board.is_attacked_by(not board.turn, move.to_square):
+                score -= PIECE_VALUES[board.piece_type_at(move.from_square)]
+            captures.append((score, move))
+        captures.sort(key=lambda capture: capture[0], reverse=True)
+        return captures
+
+    def mating_move(self, board_num: int):
+        """
+        Find a move that checkmates on a board whatever the partner of the mated side sends.
+
+        A mate only counts if it cannot be blocked: by a double check or a contact or
+        knight check, since a piece arriving from the other board could be dropped on any
+        empty square between the king and a sliding checker.
+
+        :return: The mating move in UCI format, or None.
+        """
+        board = self.boards[board_num]
+        king = board.king(not board.turn)
+        if king is None:
+            return None
+        checking = checking_squares(board, king)
+        for uci in self.legal_moves(board_num):
+            move = chess.Move.from_uci(uci)
+            if not _may_give_check(board, move, king, checking) or not board.gives_check(move):
+                continue
+            board.push(move)
+            try:
+                if board.is_checkmate() and not _can_block(board):
+                    return uci
+            finally:
+                board.pop()
+        return None
+
+    def compute_zobrist(self, board_num: int = None) -> int:
+        """
+        Hash the position from scratch.
+
+        The hash covers the pieces and promoted-piece masks of both boards, every pocket,
+        castling rights, the en passant file (only when en passant is legal, as in the FEN)
+        and the side to move on each board. push, pop, update_hand and the other mutators
+        keep self.zobrist equal to this value incrementally, and self.board_zobrist to the
+        hash of each board on its own; the move counters are not part of the hash.
+
+        :param board_num: Hash only this board and its pockets, or None for both boards.
+        :return: The 64-bit hash.
+        """
+        if board_num is None:
+            return self.compute_zobrist(0) ^ self.compute_zobrist(1)
+        return self._squares_key(board_num, chess.SQUARES) ^ self._state_key(board_num) ^ self._pockets_key(board_num)
+
+    def _rehash(self) -> None:
+        self.board_zobrist = [self.compute_zobrist(0), self.compute_zobrist(1)]
+        self.zobrist = self.board_zobrist[0] ^ self.board_zobrist[1]
+
+    def _update_zobrist(self, board_num: int, key: int) -> None:
+        self.board_zobrist[board_num] ^= key
+        self.zobrist ^= key
+
+    def _squares_key(self, board_num: int, squares) -> int:
+        board = self.boards[board_num]
+        pieces = ZOBRIST_PIECES[board_num]
+        promoted = ZOBRIST_PROMOTED[board_num]
+        key = 0
+        for square in squares:
+            piece_type = board.piece_type_at(square)
+            if piece_type:
+                key ^= pieces[board.color_at(square)][piece_type][square]
+                if board.promoted & chess.BB_SQUARES[square]:
+                    key ^= promoted[square]
+        return key
+
+    def _state_key(self, board_num: int) -> int:
+        board = self.boards[board_num]
+        key = 0 if board.turn == chess.WHITE else ZOBRIST_BLACK_TO_MOVE[board_num]
+        castling = ZOBRIST_CASTLING[board_num]
+        for square in chess.scan_forward(board.castling_rights):
+            key ^= castling[square]
+        if board.ep_square is not None and board.has_legal_en_passant():
+            key ^= ZOBRIST_EP[board_num][chess.square_file(board.ep_square)]
+        return key
+
+    def _pocket_key(self, board_num: int, color: chess.Color, piece_type: chess.PieceType) -> int:
+        count = self.boards[board_num].pockets[color].count(piece_type)
+        return ZOBRIST_POCKETS[board_num][color][piece_type][min(count, ZOBRIST_POCKET_LIMIT)]
+
+    def _pockets_key(self, board_num: int, piece_types=POCKET_PIECE_TYPES) -> int:
+        key = 0
+        for color in chess.COLORS:
+            keys = ZOBRIST_POCKETS[board_num][color]
+            pocket = self.boards[board_num].pockets[color]
+            for piece_type in piece_types:
+                count = pocket.count(piece_type)
+                key ^= keys[piece_type][count if count < ZOBRIST_POCKET_LIMIT else ZOBRIST_POCKET_LIMIT]
+        return key
 
     def can_drop(self, board_num: int, move: chess.Move) -> bool:
         if move.drop is not None:
@@ -231,6 +512,77 @@ class BughouseBoard(object):
         return True
 
 
+def _touched_squares(move: chess.Move):
+    """
+    Squares whose contents a move can change: a superset, so that it can be computed
+    from the move alone both before a push and before a pop. Every square appears once,
+    since hashing one twice would cancel it out.
+    """
+    if move.drop:
+        return (move.to_square,)
+    squares = {move.from_square, move.to_square}
+    if chess.BB_SQUARES[move.from_square] & chess.BB_BACKRANKS:
+        # Castling moves the rook as well.
+        rank = chess.square_rank(move.from_square) * 8
+        squares.update(range(rank, rank + 8))
+    if chess.square_rank(move.to_square) in (2, 5):
+        # En passant removes the pawn behind the target square.
+        squares.update((move.to_square - 8, move.to_square + 8))
+    return squares
+
+
+def checking_squares(board: CrazyhouseBoard, king: chess.Square) -> dict:
+    """
+    Squares from which each piece type of the side to move attacks the enemy king.
+
+    :return: A dict of piece type -> bitboard.
+    """
+    occupied = board.occupied
+    diagonal = chess.BB_DIAG_ATTACKS[king][chess.BB_DIAG_MASKS[king] & occupied]
+    straight = (chess.BB_RANK_ATTACKS[king][chess.BB_RANK_MASKS[king] & occupied]
+                | chess.BB_FILE_ATTACKS[king][chess.BB_FILE_MASKS[king] & occupied])
+    return {
+        chess.PAWN: chess.BB_PAWN_ATTACKS[not board.turn][king],
+        chess.KNIGHT: chess.BB_KNIGHT_ATTACKS[king],
+        chess.BISHOP: diagonal,
+        chess.ROOK: straight,
+        chess.QUEEN: diagonal | straight,
+    }
+
+
+def _may_give_check(board: CrazyhouseBoard, move: chess.Move, king: chess.Square, checking: dict) -> bool:
+    """
+    Cheap test that only lets through moves that might give check, so that the exact
+    (and much slower) gives_check runs on a few moves instead of all of them.
+    """
+    to_mask = chess.BB_SQUARES[move.to_square]
+    if move.drop:
+        # A drop cannot uncover a check, so the dropped piece has to give it.
+        return bool(checking[move.drop] & to_mask)
+    if chess.BB_RAYS[king][move.from_square]:
+        return True  # The move may uncover a check, or slide along the line to the king.
+    piece_type = move.promotion or board.piece_type_at(move.from_square)
+    if piece_type == chess.KING:
+        return board.is_castling(move)  # The castled rook may give check.
+    if piece_type == chess.PAWN:
+        return bool(checking[chess.PAWN] & to_mask) or board.is_en_passant(move)
+    if piece_type == chess.KNIGHT:
+        return bool(checking[chess.KNIGHT] & to_mask)
+    # Leaving from_square may open a line to to_square, so the occupancy above does not apply.
+    return bool(chess.BB_RAYS[king][move.to_square])
+
+
+def _can_block(board: CrazyhouseBoard) -> bool:
+    """
+    Whether the check on the side to move could be blocked by dropping a piece.
+    """
+    king = board.king(board.turn)
+    checkers = board.checkers_mask()
+    if king is None or chess.popcount(checkers) != 1:
+        return False
+    return bool(chess.between(king, chess.msb(checkers)) & ~board.occupied)
+
+
 def clean_fen(extended_fen):
     # Split the FEN string by whitespace into its components.
     parts = extended_fen.split()
@@ -252,6 +604,11 @@ def clean_fen(extended_fen):
     clean = f"{board_field} {active_color} {castling} {en_passant}"
     return clean
 
+
+def sort_hand(hand):
+    return ''.join(sorted(hand))
+
+
 if __name__ == "__main__":
     board = BughouseBoard()
     board.update_hand(0, "pQqq")
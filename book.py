@@ -0,0 +1,323 @@
+import json
+import mmap
+import os
+import pickle
+import random
+import struct
+import sys
+
+from chess.variant import CrazyhouseBoard
+
+from board import BughouseBoard
+
+# File layout, all little-endian:
+#   header   MAGIC, version, entry count, move count, reserved, offset of the index
+#   moves    move records of every entry, entry after entry
+#   index    entry count sorted 64-bit keys, then entry count + 1 offsets into the moves
+# The index is at the end so that a writer can stream the moves of sorted entries without
+# knowing how many there will be.
+MAGIC = b"NACHBOOK"
+VERSION = 1
+_HEADER = struct.Struct("<8sIIIIQ")
+_MOVE = struct.Struct("<8sIIf")  # UCI move, NUL padded; weight; games; score
+_KEY = struct.Struct("<Q")
+_OFFSET = struct.Struct("<I")
+
+
+class BookMove:
+    __slots__ = ('move', 'weight', 'games', 'score')
+
+    def __init__(self, move, weight, games=0, score=0.5):
+        self.move = move  # UCI move on its own board, e.g. "e2e4" or "P@e4"
+        self.weight = weight  # Relative probability of playing the move
+        self.games = games  # Games the move was seen in
+        self.score = score  # Average result of those games for the side to move, 0 to 1
+
+    def __repr__(self):
+        return f"BookMove({self.move!r}, weight={self.weight}, games={self.games}, score={self.score:.3f})"
+
+
+def book_key(board, board_num):
+    """
+    Key of one board of a bughouse position: its Zobrist hash, pockets included,
+    computed with the keys of board 1 so that a position has the same key on either board.
+
+    :param board: The BughouseBoard.
+    :param board_num: The board, 0 or 1.
+    :return: The 64-bit key.
+    """
+    if board_num == 0:
+        return board.board_zobrist[0]
+    view = BughouseBoard.__new__(BughouseBoard)
+    view.boards = [board.boards[board_num]]
+    return view.compute_zobrist(0)
+
+
+def fen_key(fen):
+    """
+    Key of a single-board crazyhouse FEN, as book_key. Pockets may be given in brackets
+    after the pieces or as an extra field of piece letters after the en passant square.
+    Move counters are optional and ignored.
+
+    :return: The 64-bit key.
+    """
+    view = BughouseBoard.__new__(BughouseBoard)
+    view.boards = [_fen_board(fen)]
+    return view.compute_zobrist(0)
+
+
+def _fen_board(fen):
+    parts = fen.split()
+    if len(parts) > 4 and not parts[4].isdigit() and '[' not in parts[0]:
+        parts[0] += f"[{parts[4]}]"
+        del parts[4]
+    return CrazyhouseBoard(" ".join(parts[:4]) + " 0 1")
+
+
+class OpeningBook:
+    """
+    Read-only opening book in a memory-mapped file.
+
+    Opening a book only reads its header; entries are found by binary search over the
+    mapped index, so a probe touches a handful of pages and nothing is loaded up front.
+    The mapping is shared, so every server process opening the same file reads it through
+    one copy in the page cache.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: A book written by BookWriter.
+        :raises ValueError: If the file is not a book of this version.
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, self.entries, self.moves, _, index = _HEADER.unpack_from(self._map)
+        except struct.error:
+            self._map.close()
+            raise ValueError(f"{path} is not an opening book") from None
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            raise ValueError(f"{path} is not an opening book of version {VERSION}")
+        self._keys = index
+        self._offsets = index + self.entries * _KEY.size
+
+    def __len__(self):
+        return self.entries
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def probe(self, key):
+        """
+        Look up a position.
+
+        :param key: The book_key of the position.
+        :return: The BookMoves of the position, by descending weight; empty if it is not in the book.
+        """
+        i = self._find(key)
+        if i < 0:
+            return []
+        start, end = struct.unpack_from("<II", self._map, self._offsets + i * _OFFSET.size)
+        moves = []
+        for offset in range(_HEADER.size + start * _MOVE.size, _HEADER.size + end * _MOVE.size, _MOVE.size):
+            move, weight, games, score = _MOVE.unpack_from(self._map, offset)
+            moves.append(BookMove(move.rstrip(b"\0").decode(), weight, games, score))
+        return moves
+
+    def lookup(self, board, board_num):
+        """
+        Book moves of one board of a bughouse position.
+
+        :return: The BookMoves, as probe.
+        """
+        return self.probe(book_key(board, board_num))
+
+    def choose(self, board, board_num, rng=random):
+        """
+        Pick a book move for one board, at random in proportion to the weights.
+
+        :return: The UCI move, or None if the position is not in the book.
+        """
+        moves = [move for move in self.lookup(board, board_num) if move.weight > 0]
+        if not moves:
+            return None
+        return rng.choices([move.move for move in moves], weights=[move.weight for move in moves])[0]
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _find(self, key):
+        lo, hi = 0, self.entries
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found = _KEY.unpack_from(self._map, self._keys + mid * _KEY.size)[0]
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                return mid
+        return -1
+
+
+class BookWriter:
+    """
+    Streams entries into a book file in ascending key order.
+
+    The book is written next to the target and moved into place on close, so processes
+    that have the previous book mapped keep reading a consistent file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = 0
+        self.moves = 0
+        self._tmp = path + ".tmp"
+        self._file = open(self._tmp, 'wb')
+        self._file.write(bytes(_HEADER.size))
+        self._keys = bytearray()
+        self._offsets = bytearray(_OFFSET.pack(0))
+        self._last = -1
+
+    def add(self, key, moves):
+        """
+        Append a position.
+
+        :param key: Its book_key, greater than the key of the previous entry.
+        :param moves: Its BookMoves.
+        """
+        if key <= self._last:
+            raise ValueError(f"book keys must be added in ascending order, {key:#x} after {self._last:#x}")
+        if not moves:
+            return
+        self._last = key
+        records = bytearray()
+        for move in sorted(moves, key=lambda move: move.weight, reverse=True):
+            records += _MOVE.pack(move.move.encode(), move.weight, move.games, move.score)
+        self._file.write(records)
+        self.entries += 1
+        self.moves += len(moves)
+        self._keys += _KEY.pack(key)
+        self._offsets += _OFFSET.pack(self.moves)
+
+    def close(self):
+        """
+        Write the index and header and move the book into place.
+        """
+        if self._file.closed:
+            return
+        index = _HEADER.size + self.moves * _MOVE.size
+        self._file.write(self._keys)
+        self._file.write(self._offsets)
+        self._file.seek(0)
+        self._file.write(_HEADER.pack(MAGIC, VERSION, self.entries, self.moves, 0, index))
+        self._file.close()
+        os.replace(self._tmp, self.path)
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._tmp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_book(path, entries):
+    """
+    Write a book from a mapping of book_key to BookMoves.
+    """
+    with BookWriter(path) as writer:
+        for key in sorted(entries):
+            writer.add(key, entries[key])
+
+
+def open_book(path):
+    """
+    Open a book if there is one.
+
+    :return: The OpeningBook, or None if the file does not exist or is not a book.
+    """
+    try:
+        return OpeningBook(path)
+    except (OSError, ValueError) as e:
+        print(f"[BOOK] No opening book loaded: {e}")
+        return None
+
+
+def _legacy_moves(fen, value):
+    # A legacy value is a move, a list of moves, or a dict of move -> weight or stats.
+    if isinstance(value, str):
+        value = [value]
+    if isinstance(value, (list, tuple)):
+        value = {move: 1 for move in value}
+    board = _fen_board(fen)
+    moves = []
+    for move, stats in value.items():
+        if not isinstance(stats, dict):
+            stats = {'weight': stats}
+        try:
+            uci = board.parse_uci(move).uci()
+        except ValueError:
+            uci = board.parse_san(move).uci()
+        games = int(stats.get('games', 0))
+        moves.append(BookMove(uci, int(stats.get('weight', games or 1)), games, float(stats.get('score', 0.5))))
+    return moves
+
+
+def convert_book(source, path):
+    """
+    Convert a legacy book (the pickled dict of book.pkl, or a JSON object such as
+    chessbot/book.json) keyed by FEN into a book file. Entries that do not parse are
+    skipped with a message.
+
+    :param source: The .pkl or .json file.
+    :param path: The book file to write.
+    :return: The number of positions written.
+    """
+    if source.endswith(".json"):
+        with open(source) as f:
+            legacy = json.load(f)
+    else:
+        with open(source, 'rb') as f:
+            legacy = pickle.load(f)
+
+    entries = {}
+    for fen, value in legacy.items():
+        try:
+            key = fen_key(fen)
+            moves = _legacy_moves(fen, value)
+        except (ValueError, AttributeError, TypeError) as e:
+            print(f"[BOOK] Skipping {fen!r}: {e}")
+            continue
+        merged = {move.move: move for move in entries.get(key, [])}
+        for move in moves:
+            if move.move in merged:
+                merged[move.move].weight += move.weight
+                merged[move.move].games += move.games
+            else:
+                merged[move.move] = move
+        entries[key] = list(merged.values())
+    write_book(path, entries)
+    return len(entries)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("usage: python book.py <book.pkl|book.json> <book.bin>")
+        sys.exit(2)
+    count = convert_book(sys.argv[1], sys.argv[2])
+    print(f"[BOOK] Wrote {count} positions to {sys.argv[2]}")
@@ -0,0 +1,292 @@
+import argparse
+import concurrent.futures
+import gzip
+import heapq
+import json
+import os
+import struct
+import tempfile
+import time
+from itertools import islice
+
+import chess
+
+from board import BughouseBoard
+from book import BookMove, BookWriter, book_key
+from engine import interleave_moves
+
+# Moves per board recorded from the start of each game.
+MAX_PLIES = 20
+# Moves seen in fewer games are left out of the book.
+MIN_GAMES = 2
+# Games handed to a worker at a time.
+CHUNK_GAMES = 500
+# (position, move) pairs aggregated in memory before they are spilled to a sorted run.
+SPILL_ENTRIES = 1_000_000
+# Runs merged in one pass; more runs are merged in several passes.
+MERGE_FAN_IN = 64
+
+# Score of team A (white on board 1, black on board 2), in half points.
+RESULT_HALF_POINTS = {"1-0": 2, "0-1": 0, "1/2-1/2": 1}
+
+# Run record: key, move, games, half points scored by the side that played the move.
+_RECORD = struct.Struct("<Q8sIQ")
+_READ_RECORDS = 4096
+
+
+def read_games(path):
+    """
+    Stream the games of an archive: one JSON object per line with the TCN move strings
+    of both boards, as the client receives them, and the result for team A.
+
+        {"moves": ["<tcn board 1>", "<tcn board 2>"], "result": "1-0"}
+
+    Files ending in .gz are decompressed on the fly.
+
+    :return: A generator of the raw lines.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, 'rt') as f:
+        for line in f:
+            if line.strip():
+                yield line
+
+
+def replay_games(lines, max_plies=MAX_PLIES):
+    """
+    Map step: replay games and count every (position, move) of their openings.
+
+    :param lines: Archive lines, see read_games.
+    :param max_plies: Moves recorded per board.
+    :return: ({(book_key, move): [games, half points]}, games replayed, games skipped).
+    """
+    counts = {}
+    replayed = skipped = 0
+    for line in lines:
+        try:
+            game = json.loads(line)
+            tcn_moves = game["moves"]
+            result = RESULT_HALF_POINTS[game["result"]]
+        except (ValueError, KeyError, TypeError):
+            skipped += 1
+            continue
+        board = BughouseBoard()
+        plies = [0, 0]
+        game_counts = {}
+        try:
+            for board_num, move in interleave_moves(board, tcn_moves):
+                if plies[board_num] < max_plies:
+                    # Team A is white on board 1 and black on board 2.
+                    team_a = (board.turn(board_num) == chess.WHITE) == (board_num == 0)
+                    entry = game_counts.setdefault((book_key(board, board_num), move.uci().encode()), [0, 0])
+                    entry[0] += 1
+                    entry[1] += result if team_a else 2 - result
+                    plies[board_num] += 1
+                elif plies[1 - board_num] >= max_plies:
+                    break
+                board.push(board_num, move)
+        except (ValueError, KeyError, IndexError, AssertionError):
+            # Corrupt move strings; a game only counts if it replays to the end.
+            skipped += 1
+            continue
+        merge_counts(counts, game_counts)
+        replayed += 1
+    return counts, replayed, skipped
+
+
+def merge_counts(into, counts):
+    """
+    Reduce step: add the counts of one map step to another.
+    """
+    for item, (games, half_points) in counts.items():
+        entry = into.get(item)
+        if entry is None:
+            into[item] = [games, half_points]
+        else:
+            entry[0] += games
+            entry[1] += half_points
+
+
+def write_run(path, counts):
+    """
+    Spill aggregated counts to a run file, sorted by position and move.
+    """
+    with open(path, 'wb') as f:
+        buffer = bytearray()
+        for (key, move), (games, half_points) in sorted(counts.items()):
+            buffer += _RECORD.pack(key, move, games, half_points)
+            if len(buffer) >= _RECORD.size * _READ_RECORDS:
+                f.write(buffer)
+                buffer.clear()
+        f.write(buffer)
+
+
+def read_run(path):
+    """
+    :return: A generator of the (key, move, games, half points) records of a run file.
+    """
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(_RECORD.size * _READ_RECORDS)
+            if not block:
+                break
+            yield from _RECORD.iter_unpack(block)
+
+
+def merge_runs(paths):
+    """
+    Merge sorted runs, adding up the records of the same position and move.
+
+    :return: A generator of (key, move, games, half points) in sorted order.
+    """
+    current = None
+    for key, move, games, half_points in heapq.merge(*(read_run(path) for path in paths)):
+        if current is not None and current[0] == key and current[1] == move:
+            current[2] += games
+            current[3] += half_points
+            continue
+        if current is not None:
+            yield tuple(current)
+        current = [key, move, games, half_points]
+    if current is not None:
+        yield tuple(current)
+
+
+class BookBuilder:
+    """
+    Builds an opening book from game archives in bounded memory.
+
+    Worker processes replay chunks of games and count the moves played in every
+    position. The counts are merged in memory until SPILL_ENTRIES distinct
+    (position, move) pairs are held, then spilled to a sorted run on disk. At the end
+    the runs are merged, in several passes if there are many, straight into the book.
+    """
+
+    def __init__(self, workers=None, max_plies=MAX_PLIES, min_games=MIN_GAMES, chunk_games=CHUNK_GAMES,
+                 spill_entries=SPILL_ENTRIES, tmp_dir=None):
+        """
+        :param workers: Worker processes, or None for one per CPU.
+        :param max_plies: Moves recorded per board from the start of each game.
+        :param min_games: Moves seen in fewer games are left out of the book.
+        :param chunk_games: Games handed to a worker at a time.
+        :param spill_entries: (position, move) pairs held in memory before spilling a run.
+        :param tmp_dir: Directory for the runs, or None for the system default.
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.max_plies = max_plies
+        self.min_games = min_games
+        self.chunk_games = chunk_games
+        self.spill_entries = spill_entries
+        self.tmp_dir = tmp_dir
+        self.games = 0
+        self.skipped = 0
+        self.runs = 0
+
+    def build(self, archives, path):
+        """
+        Build a book.
+
+        :param archives: Paths of game archives, see read_games.
+        :param path: The book file to write.
+        :return: The number of positions in the book.
+        """
+        started = time.monotonic()
+        with tempfile.TemporaryDirectory(prefix="book-runs-", dir=self.tmp_dir) as tmp:
+            runs = self._map(archives, tmp)
+            while len(runs) > MERGE_FAN_IN:
+                runs = [self._merge_pass(runs[i:i + MERGE_FAN_IN], tmp) for i in range(0, len(runs), MERGE_FAN_IN)]
+            positions = self._write_book(runs, path)
+        print(f"[BOOK] {self.games} games ({self.skipped} skipped), {self.runs} runs, {positions} positions "
+              f"written to {path} in {time.monotonic() - started:.1f} s")
+        return positions
+
+    def _chunks(self, archives):
+        for archive in archives:
+            lines = read_games(archive)
+            while True:
+                chunk = list(islice(lines, self.chunk_games))
+                if not chunk:
+                    break
+                yield chunk
+
+    def _map(self, archives, tmp):
+        runs = []
+        counts = {}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as executor:
+            pending = set()
+            chunks = self._chunks(archives)
+            while True:
+                # Keep a couple of chunks per worker in flight so neither side waits, and
+                # no more, so the archive is never read far ahead of the workers.
+                for chunk in islice(chunks, 2 * self.workers - len(pending)):
+                    pending.add(executor.submit(replay_games, chunk, self.max_plies))
+                if not pending:
+                    break
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    chunk_counts, replayed, skipped = future.result()
+                    merge_counts(counts, chunk_counts)
+                    self.games += replayed
+                    self.skipped += skipped
+                if len(counts) >= self.spill_entries:
+                    runs.append(self._spill(counts, tmp))
+                    counts = {}
+                    print(f"[BOOK] {self.games} games replayed, spilled run {len(runs)}")
+        if counts:
+            runs.append(self._spill(counts, tmp))
+        return runs
+
+    def _spill(self, counts, tmp):
+        path = os.path.join(tmp, f"run-{self.runs}.bin")
+        self.runs += 1
+        write_run(path, counts)
+        return path
+
+    def _merge_pass(self, runs, tmp):
+        path = os.path.join(tmp, f"run-{self.runs}.bin")
+        self.runs += 1
+        with open(path, 'wb') as f:
+            buffer = bytearray()
+            for record in merge_runs(runs):
+                buffer += _RECORD.pack(*record)
+                if len(buffer) >= _RECORD.size * _READ_RECORDS:
+                    f.write(buffer)
+                    buffer.clear()
+            f.write(buffer)
+        for run in runs:
+            os.remove(run)
+        return path
+
+    def _write_book(self, runs, path):
+        with BookWriter(path) as writer:
+            key = None
+            moves = []
+            for record_key, move, games, half_points in merge_runs(runs):
+                if record_key != key:
+                    if moves:
+                        writer.add(key, moves)
+                    key, moves = record_key, []
+                if games >= self.min_games:
+                    moves.append(BookMove(move.rstrip(b"\0").decode(), games, games, half_points / (2 * games)))
+            if moves:
+                writer.add(key, moves)
+            return writer.entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build an opening book from bughouse game archives.")
+    parser.add_argument("archives", nargs="+", help="JSON lines game archives, optionally gzipped")
+    parser.add_argument("-o", "--output", default="book.bin", help="book file to write")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per CPU)")
+    parser.add_argument("--max-plies", type=int, default=MAX_PLIES, help="moves recorded per board")
+    parser.add_argument("--min-games", type=int, default=MIN_GAMES, help="games a move needs to enter the book")
+    parser.add_argument("--chunk", type=int, default=CHUNK_GAMES, help="games per worker task")
+    parser.add_argument("--spill", type=int, default=SPILL_ENTRIES, help="entries held in memory before spilling")
+    parser.add_argument("--tmp", default=None, help="directory for the sorted runs")
+    args = parser.parse_args()
+    builder = BookBuilder(args.workers, args.max_plies, args.min_games, args.chunk, args.spill, args.tmp)
+    builder.build(args.archives, args.output)
+
+
+if __name__ == "__main__":
+    main()
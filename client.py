@@ -5,8 +5,13 @@ import json
 import random
 import websocket
 
+import metrics
+from framing import RECV_SIZE, LineBuffer
 from tcn import tcn_encode
 
+_WS_RECEIVE = metrics.stage("ws_receive")
+_CLIENT_SEND = metrics.stage("client_send")
+
 # --------------------------
 # Client Code
 # --------------------------
@@ -28,6 +33,9 @@ class Client:
         self.ping = random.randint(23,49)
         self.playing = False
         self.ws = None
+        self.forwarded = [None, None]  # TCN string last forwarded per board, None to send the full string
+        self.latest = ["", ""]  # Latest TCN string seen per board
+        self.send_lock = threading.Lock()
 
     def start(self):
         try:
@@ -36,6 +44,8 @@ class Client:
         except ConnectionRefusedError:
             print(f"[CLIENT {self.id}] Connection refused by the server")
             return
+        # Both accounts of a team join the same game session on the server.
+        self.send_message(f"join {self.team_name()} {self.board_num}\n")
 
         # Start a thread to listen for messages from the server
         listener_thread = threading.Thread(target=self.listen_server, daemon=True)
@@ -100,7 +110,9 @@ class Client:
 
     def main_loop(self) -> None:
         while True:
-            message = json.loads(self.ws.recv())[0]
+            raw = self.ws.recv()
+            received = metrics.start_timer()
+            message = json.loads(raw)[0]
             #print(message)
 
             if 'clientId' in message and not self.clientId:
@@ -162,30 +174,74 @@ class Client:
                         if self.board_num == 0:
                             self.send_message(f"side {self.side}\n")
 
-                        self.send_message(f"times {self.board_num} {times[0]} {times[1]}\nmoves {self.board_num} {tcn_moves}\n")
+                        self.send_message(f"times {self.board_num} {times[0]} {times[1]}\n" + self.moves_message(self.board_num, tcn_moves))
                     else:
                         tcn_moves = message['data']['game']['moves']
                         times = message['data']['game']['clocks']
                         self.send_message(
-                            f"times {1 - self.board_num} {times[0]} {times[1]}\nmoves {1 - self.board_num} {tcn_moves}\n")
+                            f"times {1 - self.board_num} {times[0]} {times[1]}\n" + self.moves_message(1 - self.board_num, tcn_moves))
+
+            _WS_RECEIVE.observe_since(received)
+
+    def team_name(self):
+        """
+        Name of our team's game session: the usernames of both partners, sorted.
+        """
+        return "+".join(sorted(name.lower() for name in (self.username, self.partner) if name))
 
     def listen_server(self):
+        # The server sends one move per line.
+        lines = LineBuffer()
         while True:
             try:
-                data = self.client_socket.recv(1024)
+                data = self.client_socket.recv(RECV_SIZE)
                 if not data:
                     break
-                move = data.decode()
-                self.send_move(move)
+                for line in lines.feed(data):
+                    if line.startswith("resync"):
+                        self.resync(int(line.split(" ")[1]))
+                    else:
+                        started = metrics.start_timer()
+                        self.send_move(line)
+                        _CLIENT_SEND.observe_since(started)
             except ConnectionResetError:
                 break
 
     def send_message(self, message):
         try:
-            self.client_socket.sendall(message.encode())
+            with self.send_lock:
+                self.client_socket.sendall(message.encode())
         except BrokenPipeError:
             print(f"[CLIENT {self.id}] Cannot send message, connection broken.")
 
+    def moves_message(self, board_num, tcn_moves):
+        """
+        Build the move update for one board. If the game only grew since the last update,
+        just the new moves are sent as "delta <board> <seq> <tcn>", where seq is the number of
+        moves the server already has. After a takeback, a new game or a resync request the
+        full "moves <board> <tcn>" string is sent instead.
+
+        :return: The command, or "" if nothing changed.
+        """
+        with self.send_lock:
+            self.latest[board_num] = tcn_moves
+            last = self.forwarded[board_num]
+            self.forwarded[board_num] = tcn_moves
+        if last is None or not tcn_moves.startswith(last):
+            return f"moves {board_num} {tcn_moves}\n"
+        if len(tcn_moves) == len(last):
+            return ""
+        return f"delta {board_num} {len(last) // 2} {tcn_moves[len(last):]}\n"
+
+    def resync(self, board_num):
+        """
+        The server lost track of a board: send its full move string.
+        """
+        with self.send_lock:
+            tcn_moves = self.latest[board_num]
+            self.forwarded[board_num] = tcn_moves
+        self.send_message(f"moves {board_num} {tcn_moves}\n")
+
     def send_partnership(self) -> None:
         if not self.partner:
             return
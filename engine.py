@@ -1,11 +1,26 @@
-import re
 import os
 import subprocess
+import threading
+import time
+from collections import deque
 
 import chess
 
 from board import BughouseBoard
 from tcn import tcn_decode
+from uci import SearchInfo, SearchResult, merge_info_lines, parse_bestmove, parse_info
+
+# Info lines kept per search when nobody consumes them live.
+INFO_HISTORY = 64
+# Lines of engine stderr kept for diagnostics.
+STDERR_HISTORY = 200
+
+
+class EngineTerminated(ConnectionError):
+    """
+    The engine process exited while commands or searches were still pending.
+    """
+
 
 class Engine:
     def __init__(self, engine_path):
@@ -25,6 +40,15 @@ class Engine:
             stderr=subprocess.PIPE,
             env = env
         )
+        self.pv = []  # Principal variation of the last search
+        self.ponder_move = None  # Expected reply to the last best move, if known
+        self.last_result = None  # SearchResult of the last search
+        self.stderr = deque(maxlen=STDERR_HISTORY)
+        self.searches = 0  # Searches started; the id of the running or last search
+        self._searching = None  # Id of the search waiting for its bestmove, or None
+        self._write_lock = threading.Lock()
+        # Nobody else reads stderr; without this a chatty engine fills the pipe and blocks.
+        threading.Thread(target=self._drain_stderr, daemon=True).start()
         self._initialize_engine()
 
     def _initialize_engine(self):
@@ -43,19 +67,66 @@ class Engine:
 
         :param command: The command to send.
         """
-        self.engine.stdin.write(command + "\n")
-        self.engine.stdin.flush()
+        with self._write_lock:
+            self._write(command)
+
+    def _write(self, command):
+        # Called with _write_lock held.
+        try:
+            self.engine.stdin.write(command + "\n")
+            self.engine.stdin.flush()
+        except (BrokenPipeError, ValueError) as e:
+            raise EngineTerminated(f"engine exited with code {self.engine.poll()}") from e
 
     def read_output(self):
         """
         Read the output from the hivemind engine.
 
         :return: The output from the engine.
+        :raises EngineTerminated: If the engine closed its output.
         """
-        return self.engine.stdout.readline().strip()
+        line = self.engine.stdout.readline()
+        if not line:
+            raise EngineTerminated("engine closed its output")
+        return line.strip()
 
-    def stop(self):
-        self.send_command("stop")
+    def is_alive(self):
+        return self.engine.poll() is None
+
+    def kill(self):
+        self.engine.kill()
+
+    def _drain_stderr(self):
+        for line in self.engine.stderr:
+            self.stderr.append(line.rstrip())
+
+    def stop(self, search=None):
+        """
+        Stop a search. The check and the write happen under the write lock, and the next
+        search's go is written under the same lock, so a stop meant for a search that has
+        already returned can never end the one after it.
+
+        :param search: Id of the search to stop (self.searches when it was running), or
+            None for whichever search is running.
+        :return: True if stop was sent.
+        """
+        with self._write_lock:
+            if self._searching is None or (search is not None and search != self._searching):
+                return False
+            self._write("stop")
+            return True
+
+    def quit(self, timeout=5):
+        """
+        Ask the engine to exit and wait for the process to terminate.
+
+        :param timeout: Seconds to wait before killing the process.
+        """
+        try:
+            self.send_command("quit")
+            self.engine.wait(timeout=timeout)
+        except (EngineTerminated, subprocess.TimeoutExpired):
+            self.engine.kill()
 
     def set_position(self, fen=None, moves=None):
         """
@@ -75,67 +146,133 @@ class Engine:
     def set_mode(self, mode):
         self.send_command(f"set mode {mode}")
 
-    def get_best_move(self, movetime=1000):
+    def iter_search(self, movetime=1000):
         """
-        Get the best move from the current position.
+        Start a search and yield a SearchInfo for every info line while it runs.
 
-        :param movetime: The depth to search for the best move.
-        :return: The best move in UCI format.
+        The generator returns the SearchResult once bestmove arrives, so callers that need
+        it should drive the generator with next() or use search().
+
+        :param movetime: The time in milliseconds to search for.
+        """
+        started = time.monotonic()
+        self._go(movetime)
+
+        latest = SearchInfo()
+        while True:
+            output = self.read_output()
+            if output.startswith("bestmove"):
+                return self._finish_search(output, latest, movetime, started)
+            if output:
+                info = parse_info(output)
+                latest.update(info)
+                yield info
+
+    def search(self, movetime=1000, on_info=None):
         """
+        Run a search to completion.
 
-        self.send_command(f"go movetime {movetime}")
+        Without on_info the info lines are only buffered while the engine thinks and the
+        newest few are parsed once bestmove arrives.
 
-        q_value = 0
-        nodes = 0
+        :param movetime: The time in milliseconds to search for.
+        :param on_info: Called with each SearchInfo while the search runs.
+        :return: The SearchResult.
+        """
+        if on_info is not None:
+            search = self.iter_search(movetime)
+            while True:
+                try:
+                    info = next(search)
+                except StopIteration as stop:
+                    return stop.value
+                on_info(info)
+
+        started = time.monotonic()
+        self._go(movetime)
+
+        lines = deque(maxlen=INFO_HISTORY)
         while True:
             output = self.read_output()
+            if output.startswith("bestmove"):
+                return self._finish_search(output, merge_info_lines(lines), movetime, started)
+            if output:
+                lines.append(output)
+
+    def _go(self, movetime):
+        with self._write_lock:
+            self.searches += 1
+            self._write(f"go movetime {movetime}")
+            self._searching = self.searches
+
+    def _finish_search(self, output, info, movetime, started):
+        with self._write_lock:
+            self._searching = None
+        best_move, ponder_move = parse_bestmove(output)
+        pv = info.pv or []
+        if ponder_move is None and len(pv) > 1 and pv[0] == best_move:
+            ponder_move = pv[1]
+        result = SearchResult(best_move, ponder_move, info, movetime, time.monotonic() - started)
+        self.last_result = result
+        self.pv = pv
+        self.ponder_move = ponder_move
+        return result
 
-            # Extract Q value
-            q_pattern = r"Q value\s+(-?\d+\.\d+)"
-            q_match = re.search(q_pattern, output)
-            if q_match:
-                q_value = float(q_match.group(1))
+    def get_best_move(self, movetime=1000):
+        """
+        Get the best move from the current position.
 
-            # Extract nodes count
-            nodes_pattern = r"nodes\s+(\d+)"
-            nodes_match = re.search(nodes_pattern, output)
-            if nodes_match:
-                nodes = int(nodes_match.group(1))
+        After it returns, pv holds the last principal variation, ponder_move the expected
+        reply and last_result the full SearchResult.
 
-            if "bestmove" in output:
-                best_move = output.split()[1]
-                return best_move, q_value, nodes
+        :param movetime: The time in milliseconds to search for.
+        :return: The best move in UCI format, the last Q value and the last node count.
+        """
+        result = self.search(movetime)
+        info = result.info
+        return result.best_move, 0 if info.q is None else info.q, 0 if info.nodes is None else info.nodes
 
-def parse_moves(tcn_moves):
-    board = BughouseBoard()
-    moves = ""
 
-    # Use separate indices for board 1 and board 2 move strings.
-    i0 = 0  # index into tcn_moves[0]
-    i1 = 0  # index into tcn_moves[1]
+def interleave_moves(board, tcn_moves):
+    """
+    Yield the moves of both boards of a game in an order they can be played in.
+
+    Board 1 moves come first unless a drop needs a piece that a board 2 capture has not
+    delivered yet. Whether a drop can be played depends on the pockets, so the caller
+    has to push each move on board before asking for the next one.
+
+    :param board: The BughouseBoard the moves are pushed on.
+    :param tcn_moves: The TCN move strings of board 1 and board 2.
+    :return: A generator of (board_num, chess.Move).
+    """
+    # Decode each board's game string once, then walk both move lists.
+    board_moves = [tcn_decode(tcn_moves[0]), tcn_decode(tcn_moves[1])]
+    i0 = 0  # index into board_moves[0]
+    i1 = 0  # index into board_moves[1]
 
     # Process moves from board 1
-    while i0 < len(tcn_moves[0]):
-        segment = tcn_moves[0][i0:i0+2]
-        move = tcn_decode(segment)[0]
+    while i0 < len(board_moves[0]):
+        move = board_moves[0][i0]
 
         if move.drop is not None and not board.can_drop(0, move):
-            segment = tcn_moves[1][i1:i1 + 2]
-            move = tcn_decode(segment)[0]
-            moves += f"2{board.push(1, move)} "
-            i1 += 2
+            yield 1, board_moves[1][i1]
+            i1 += 1
         else:
-            moves += f"1{board.push(0, move)} "
-            i0 += 2
+            yield 0, move
+            i0 += 1
 
     # Process any remaining moves from board 2.
-    while i1 < len(tcn_moves[1]):
-        segment = tcn_moves[1][i1:i1+2]
-        move = tcn_decode(segment)[0]
-        moves += f"2{board.push(1, move)} "
-        i1 += 2
+    while i1 < len(board_moves[1]):
+        yield 1, board_moves[1][i1]
+        i1 += 1
+
 
-    return board, moves.strip()
+def parse_moves(tcn_moves):
+    board = BughouseBoard()
+    moves = []
+    for board_num, move in interleave_moves(board, tcn_moves):
+        moves.append(f"{board_num + 1}{board.push(board_num, move)}")
+    return board, " ".join(moves)
 
 
 # Example usage:
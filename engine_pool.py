@@ -0,0 +1,83 @@
+import queue
+from contextlib import contextmanager
+
+from engine import Engine
+from supervisor import EngineSupervisor
+
+
+class EnginePool:
+    """
+    The engine processes of a server. Jobs are run on them by EngineScheduler, which
+    checks engines out and in; the pool only hands out idle engines.
+    """
+
+    def __init__(self, engine_path, size=2, standby=1):
+        """
+        Start a pool of hivemind engines.
+
+        Every engine finishes its uci handshake before the pool is returned, so the
+        first job never pays for process startup.
+
+        :param engine_path: Path to the hivemind executable.
+        :param size: Number of engine processes to run.
+        :param standby: Warm standby engines shared by the pool for failover. With 0 the
+            engines are not supervised.
+        """
+        self.supervisor = None
+        self.engines = [Engine(engine_path) for _ in range(size)]
+        if standby > 0:
+            self.supervisor = EngineSupervisor(engine_path, standby)
+            self.engines = [self.supervisor.supervise(engine) for engine in self.engines]
+        self._idle = queue.Queue()
+        for engine in self.engines:
+            self._idle.put(engine)
+
+    def __len__(self):
+        return len(self.engines)
+
+    def idle_count(self):
+        return self._idle.qsize()
+
+    def checkout(self, timeout=None):
+        """
+        Take an idle engine out of the pool.
+
+        :param timeout: Seconds to wait for an engine, or None to wait forever.
+        :return: The engine. It must be given back with checkin.
+        :raises TimeoutError: If no engine became idle in time.
+        """
+        try:
+            return self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError("no idle engine available") from None
+
+    def checkin(self, engine):
+        """
+        Return an engine to the pool. Its last search must have been drained up to bestmove.
+
+        :param engine: The engine taken with checkout.
+        """
+        self._idle.put(engine)
+
+    @contextmanager
+    def engine(self, timeout=None):
+        """
+        Context manager around checkout/checkin.
+
+        :param timeout: Seconds to wait for an engine, or None to wait forever.
+        """
+        engine = self.checkout(timeout)
+        try:
+            yield engine
+        finally:
+            self.checkin(engine)
+
+    def close(self):
+        """
+        Shut the engine processes down. Searches must have been stopped and the engines
+        checked in, see EngineScheduler.close.
+        """
+        for engine in self.engines:
+            engine.quit()
+        if self.supervisor is not None:
+            self.supervisor.close()
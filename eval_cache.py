@@ -0,0 +1,189 @@
+import hashlib
+import queue
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import chess
+
+
+def _label_key(label):
+    # Stable across processes, unlike hash(), because keys are persisted.
+    return int.from_bytes(hashlib.blake2b(label.encode(), digest_size=8).digest(), "little")
+
+
+# Rows written per transaction at most; a busy writer commits once per batch instead of per search.
+WRITE_BATCH = 256
+
+_TEAM_KEYS = {chess.WHITE: _label_key("team white"), chess.BLACK: _label_key("team black")}
+_MODE_KEYS = {}
+
+
+def position_key(board, side, mode):
+    """
+    Normalized key of a bughouse search: the board's Zobrist hash (both boards without
+    move counters and both pockets) combined with our team and the engine mode.
+
+    :param board: The BughouseBoard.
+    :param side: Our team, as passed to Engine.set_side.
+    :param mode: The engine mode, as passed to Engine.set_mode.
+    :return: The 64-bit key.
+    """
+    mode_key = _MODE_KEYS.get(mode)
+    if mode_key is None:
+        mode_key = _MODE_KEYS[mode] = _label_key("mode " + mode)
+    return board.zobrist ^ _TEAM_KEYS[side] ^ mode_key
+
+
+def _db_key(key):
+    # sqlite integers are signed 64-bit.
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+
+class CacheEntry:
+    def __init__(self, best_move, q, nodes, movetime):
+        self.best_move = best_move
+        self.q = q
+        self.nodes = nodes
+        self.movetime = movetime  # Milliseconds the search actually ran
+
+    def __repr__(self):
+        return f"CacheEntry({self.best_move!r}, q={self.q}, nodes={self.nodes}, movetime={self.movetime})"
+
+
+class EvalCache:
+    """
+    Search results keyed by position_key, in an in-memory LRU backed by sqlite.
+
+    An entry answers a request only if it was searched for at least as long as the
+    request's movetime. Writes keep the deeper of the old and new result. All methods
+    are safe to call from several engine threads.
+
+    Writes reach sqlite through a background thread with its own connection, which
+    commits whatever rows arrived since its last commit in one transaction. A put only
+    updates memory and queues the row, so no lookup ever waits behind a commit.
+    """
+
+    def __init__(self, path=None, capacity=100000):
+        """
+        :param path: sqlite file for the persistent store, or None for memory only.
+        :param capacity: Number of entries kept in memory.
+        """
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._writes = None
+        self._writer = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS search_results ("
+                "key INTEGER PRIMARY KEY, best_move TEXT NOT NULL, q REAL NOT NULL, "
+                "nodes INTEGER NOT NULL, movetime REAL NOT NULL)"
+            )
+            self._db.commit()
+            self._writes = queue.Queue()
+            self._writer = threading.Thread(target=self._write, args=(sqlite3.connect(path, check_same_thread=False),),
+                                            name="eval-cache-writer", daemon=True)
+            self._writer.start()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, movetime=0):
+        """
+        Look up a position.
+
+        :param key: The position_key.
+        :param movetime: The search budget in milliseconds the entry has to match.
+        :return: The CacheEntry, or None if there is none that was searched long enough.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            elif self._db is not None:
+                row = self._db.execute(
+                    "SELECT best_move, q, nodes, movetime FROM search_results WHERE key = ?", (_db_key(key),)
+                ).fetchone()
+                if row is not None:
+                    entry = CacheEntry(*row)
+                    self._remember(key, entry)
+
+            if entry is None or entry.movetime < movetime:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry
+
+    def put(self, key, best_move, q, nodes, movetime):
+        """
+        Store a search result unless a longer search of the same position is already known.
+
+        :param key: The position_key.
+        :param best_move: The best move in UCI format.
+        :param q: The Q value of the search.
+        :param nodes: The node count of the search.
+        :param movetime: Milliseconds the search ran.
+        """
+        entry = CacheEntry(best_move, q, nodes, movetime)
+        with self._lock:
+            old = self._entries.get(key)
+            if old is not None and old.movetime > movetime:
+                return
+            self._remember(key, entry)
+        if self._writes is not None:
+            self._writes.put((_db_key(key), best_move, q, nodes, movetime))
+
+    def close(self):
+        """
+        Write the queued results and close the database.
+        """
+        if self._writer is not None:
+            self._writes.put(None)
+            self._writer.join()
+            self._writer = None
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _write(self, db):
+        # Runs on the writer thread, which owns db.
+        closing = False
+        while not closing:
+            rows = [self._writes.get()]
+            while len(rows) < WRITE_BATCH:
+                try:
+                    rows.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            if rows[-1] is None:
+                closing = True
+                rows.pop()
+            if not rows:
+                continue
+            try:
+                db.executemany(
+                    "INSERT INTO search_results (key, best_move, q, nodes, movetime) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET best_move = excluded.best_move, q = excluded.q, "
+                    "nodes = excluded.nodes, movetime = excluded.movetime WHERE excluded.movetime >= search_results.movetime",
+                    rows
+                )
+                db.commit()
+            except sqlite3.Error as e:
+                # The results are still in memory; only their persistence is lost.
+                print(f"[CACHE] Could not write {len(rows)} results: {e}")
+                db.rollback()
+        db.close()
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
@@ -0,0 +1,137 @@
+import asyncio
+
+# Bytes read per receive, and the initial size of a connection's receive buffer.
+RECV_SIZE = 4096
+# Longest command accepted. A full game of TCN moves is a few kilobytes.
+MAX_COMMAND_BYTES = 1 << 20
+
+
+class CommandTooLong(ValueError):
+    pass
+
+
+class LineBuffer:
+    """
+    Splits a byte stream into newline-terminated commands.
+
+    Data is received straight into one bytearray that is reused for the lifetime of the
+    connection: consumed commands are compacted away and the buffer only grows when a
+    single command does not fit, so commands of any length up to MAX_COMMAND_BYTES are
+    reassembled across reads.
+    """
+
+    def __init__(self, size=RECV_SIZE, max_command=MAX_COMMAND_BYTES):
+        self.buffer = bytearray(size)
+        self.max_command = max_command
+        self._start = 0  # First byte of the command being received
+        self._end = 0  # End of the received data
+
+    def get_buffer(self):
+        """
+        :return: A writable view of the free space at the end of the buffer.
+        :raises CommandTooLong: If a command would exceed max_command bytes.
+        """
+        if self._end == len(self.buffer):
+            pending = self._end - self._start
+            if self._start > 0:
+                self.buffer[:pending] = self.buffer[self._start:self._end]
+                self._start, self._end = 0, pending
+            elif pending >= self.max_command:
+                raise CommandTooLong(f"command longer than {self.max_command} bytes")
+            else:
+                self.buffer.extend(bytes(min(len(self.buffer), self.max_command - pending)))
+        return memoryview(self.buffer)[self._end:]
+
+    def buffer_updated(self, nbytes):
+        """
+        Account for nbytes written into the view from get_buffer.
+
+        :return: The complete commands received, without their line endings. Empty lines are dropped.
+        """
+        scan = self._end
+        self._end += nbytes
+        commands = []
+        while True:
+            newline = self.buffer.find(b"\n", scan, self._end)
+            if newline < 0:
+                break
+            command = self.buffer[self._start:newline].decode(errors='replace').rstrip("\r")
+            if command:
+                commands.append(command)
+            self._start = scan = newline + 1
+        if self._start == self._end:
+            self._start = self._end = 0
+        return commands
+
+    def feed(self, data):
+        """
+        Copy received bytes into the buffer, for readers that do not receive into it directly.
+
+        :return: The complete commands received.
+        """
+        commands = []
+        data = memoryview(data)
+        while data:
+            view = self.get_buffer()
+            n = min(len(view), len(data))
+            view[:n] = data[:n]
+            view.release()
+            data = data[n:]
+            commands.extend(self.buffer_updated(n))
+        return commands
+
+
+class CommandProtocol(asyncio.BufferedProtocol):
+    """
+    asyncio protocol that receives into a LineBuffer and hands every complete command to
+    a callback.
+    """
+
+    def __init__(self, on_command, on_connect=None, on_disconnect=None):
+        """
+        :param on_command: Called with (protocol, command) for each command.
+        :param on_connect: Called with the protocol once the connection is up.
+        :param on_disconnect: Called with the protocol when the connection is gone.
+        """
+        self.on_command = on_command
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.lines = LineBuffer()
+        self.transport = None
+        self.peer = None
+        self._aborted = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info('peername')
+        if self.on_connect is not None:
+            self.on_connect(self)
+
+    def get_buffer(self, sizehint):
+        try:
+            return self.lines.get_buffer()
+        except CommandTooLong as e:
+            print(f"[SERVER] Closing connection to {self.peer}: {e}")
+            self._aborted = True
+            self.transport.abort()
+            return bytearray(RECV_SIZE)
+
+    def buffer_updated(self, nbytes):
+        if self._aborted:
+            return
+        for command in self.lines.buffer_updated(nbytes):
+            self.on_command(self, command)
+
+    def connection_lost(self, exc):
+        if self.on_disconnect is not None:
+            self.on_disconnect(self)
+
+    def send(self, text):
+        """
+        Queue text for the peer. Must be called on the event loop.
+        """
+        if not self.transport.is_closing():
+            self.transport.write(text.encode())
+
+    def close(self):
+        self.transport.close()
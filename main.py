@@ -1,38 +1,335 @@
+import configparser
+import multiprocessing
+import os
+import queue
 import threading
 import time
-import configparser
 
 from server import Server
 from client import Client
 
-NUM_CLIENTS = 2  # Number of clients to start
+CONFIG_PATH = 'config.ini'
+# Port of the first worker's server; worker i listens on BASE_PORT + i.
+BASE_PORT = 12345
+# Teams sharing one worker process, and so one server and one engine pool.
+TEAMS_PER_WORKER = 1
+# Engines per worker.
+NUM_ENGINES = 2
+ENGINE_PATH = "./hivemind"
+# Evaluation cache of each worker; every worker writes its own file so their commits never contend.
+CACHE_PATH = "eval_cache-{index}.sqlite"
+# Seconds between health reports of the workers.
+HEALTH_INTERVAL = 30
+# A crashed worker is restarted after RESTART_BACKOFF seconds, doubled on every crash
+# in a row up to MAX_BACKOFF. A worker that stayed up for STABLE_SECONDS starts over.
+RESTART_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+STABLE_SECONDS = 300
+
 
 # --------------------------
-# Main Code: Start server and multiple clients
+# Configuration
 # --------------------------
-def main():
-    # Start the server
-    server = Server(host='localhost', port=12345)
-    server.start()
+def read_teams(config):
+    """
+    Read the team credentials. Every [team <name>] section is one team:
 
-    # Give the server a moment to start up
-    time.sleep(1)
+        [team alpha]
+        username1 = ...
+        phpsessid1 = ...
+        username2 = ...
+        phpsessid2 = ...
+
+    A config with only the old [credentials] section is read as a single team.
+
+    :param config: The ConfigParser.
+    :return: A list of (name, [(username, phpsessid) for boards 1 and 2]).
+    """
+    sections = [section for section in config.sections() if section.startswith('team ')]
+    if not sections and config.has_section('credentials'):
+        sections = ['credentials']
+    teams = []
+    for section in sections:
+        accounts = [(config.get(section, f'username{i}'), config.get(section, f'phpsessid{i}')) for i in (1, 2)]
+        teams.append((section[len('team '):].strip() if section != 'credentials' else accounts[0][0], accounts))
+    return teams
+
+
+def parse_cpus(text):
+    """
+    Parse a CPU list such as "0-3,8".
+
+    :return: The set of CPU numbers.
+    """
+    cpus = set()
+    for part in text.split(','):
+        part = part.strip()
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.update(range(int(first), int(last) + 1))
+        elif part:
+            cpus.add(int(part))
+    return cpus
+
+
+def split_cpus(cpus, count):
+    """
+    Split the CPUs into count disjoint sets as even as possible. With fewer CPUs than
+    workers the sets wrap around and are shared.
+    """
+    cpus = sorted(cpus)
+    if len(cpus) < count:
+        return [{cpus[i % len(cpus)]} for i in range(count)]
+    size, extra = divmod(len(cpus), count)
+    sets = []
+    start = 0
+    for i in range(count):
+        end = start + size + (i < extra)
+        sets.append(set(cpus[start:end]))
+        start = end
+    return sets
+
+
+# --------------------------
+# Worker processes
+# --------------------------
+def run_worker(index, teams, port, settings, health_queue):
+    """
+    Worker process: one Server and a pair of clients per team, pinned to its CPUs.
+
+    The engines are started after the worker is pinned, so they inherit its CPU set.
+    The worker exits as soon as one of its clients stops, and the supervisor restarts it.
+
+    :param index: The worker number.
+    :param teams: The (name, accounts) of its teams, see read_teams.
+    :param port: The port of its server.
+    :param settings: engine_path, engines, cache_path, cpus (a set, or None to run anywhere)
+        and metrics_port (None to run without metrics).
+    :param health_queue: multiprocessing.Queue the worker reports (index, pid, health) on.
+    """
+    if settings['cpus'] and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, settings['cpus'])
+    server = Server(host='localhost', port=port, engine_path=settings['engine_path'], num_engines=settings['engines'],
+                    cache_path=settings['cache_path'], metrics_port=settings['metrics_port'])
+    server.start()
 
-    # Start multiple client threads
-    config = configparser.ConfigParser()
-    config.read('config.ini')
     client_threads = []
-    for i in range(NUM_CLIENTS):
-        client = Client(host='localhost', port=12345, username=config.get('credentials', f'username{i+1}'),  phpsessid=config.get('credentials', f'phpsessid{i+1}'), partner=config.get('credentials', f'username{[2, 1][i]}'), board_num=i)
-        t = threading.Thread(target=client.start, daemon=True)
-        client_threads.append(t)
-        t.start()
+    for _, accounts in teams:
+        for i, (username, phpsessid) in enumerate(accounts):
+            client = Client(host='localhost', port=port, username=username, phpsessid=phpsessid,
+                            partner=accounts[1 - i][0], board_num=i)
+            t = threading.Thread(target=client.start, daemon=True)
+            client_threads.append(t)
+            t.start()
 
-    # Wait for all client threads to complete
-    for t in client_threads:
-        t.join()
+    last_report = 0
+    while all(t.is_alive() for t in client_threads):
+        if time.monotonic() - last_report >= HEALTH_INTERVAL:
+            try:
+                health = server.health()
+            except TimeoutError:
+                health = None  # The state task is stuck; the supervisor reports the worker as unresponsive.
+            health_queue.put((index, os.getpid(), health))
+            last_report = time.monotonic()
+        time.sleep(1)
+    print(f"[WORKER {index}] A client has stopped, exiting so the worker is restarted.")
+    server.scheduler.close()
+    server.cache.close()
+    os._exit(1)
+
+
+class Worker:
+    """
+    The supervisor's handle on one worker process and its restart bookkeeping.
+    """
+
+    def __init__(self, index, teams, port, cpus):
+        self.index = index
+        self.teams = teams
+        self.port = port
+        self.cpus = cpus
+        self.process = None
+        self.started = 0
+        self.restarts = 0
+        self.backoff = RESTART_BACKOFF
+        self.restart_at = None  # Time the process is due to be restarted after a crash
+        self.health = None  # Last health report
+        self.reported = 0  # Time of the last health report
+
+    def names(self):
+        return ", ".join(name for name, _ in self.teams)
+
+
+class TeamSupervisor:
+    """
+    Runs the configured teams in worker processes, so that the teams are spread over the
+    cores instead of sharing one interpreter.
+
+    Every worker runs its own server, with its own port, engines and CPU set, for a group
+    of teams. Workers that crash are restarted with exponential backoff, and their health
+    reports are aggregated into one log line.
+    """
+
+    def __init__(self, teams, teams_per_worker=TEAMS_PER_WORKER, base_port=BASE_PORT, engine_path=ENGINE_PATH,
+                 engines=NUM_ENGINES, cpu_sets=None, metrics_port=None):
+        """
+        :param teams: The (name, accounts) of every team, see read_teams.
+        :param teams_per_worker: Teams sharing one worker process.
+        :param base_port: Port of the first worker's server.
+        :param engine_path: Path to the hivemind executable.
+        :param engines: Engines per worker.
+        :param cpu_sets: One set of CPUs per worker, or None to split the available CPUs evenly.
+        :param metrics_port: Port of the first worker's metrics endpoint; worker i serves on
+            metrics_port + i. None runs without metrics.
+        """
+        groups = [teams[i:i + teams_per_worker] for i in range(0, len(teams), teams_per_worker)]
+        if cpu_sets is None and hasattr(os, 'sched_getaffinity'):
+            cpu_sets = split_cpus(os.sched_getaffinity(0), len(groups))
+        self.workers = [Worker(i, group, base_port + i, cpu_sets[i % len(cpu_sets)] if cpu_sets else None)
+                        for i, group in enumerate(groups)]
+        self.engine_path = engine_path
+        self.engines = engines
+        self.metrics_port = metrics_port
+        # Spawn rather than fork, so a restarted worker never inherits the supervisor's state.
+        self.context = multiprocessing.get_context('spawn')
+        self.health_queue = self.context.Queue()
+
+    def run(self):
+        """
+        Start every worker and keep them running until interrupted.
+        """
+        for worker in self.workers:
+            self.start_worker(worker)
+        last_report = time.monotonic()
+        try:
+            while True:
+                self.collect_health(1.0)
+                self.check_workers()
+                if time.monotonic() - last_report >= HEALTH_INTERVAL:
+                    self.report()
+                    last_report = time.monotonic()
+        except KeyboardInterrupt:
+            print("[MAIN] Stopping workers.")
+        finally:
+            self.stop()
+
+    def start_worker(self, worker):
+        settings = {'engine_path': self.engine_path, 'engines': self.engines, 'cpus': worker.cpus,
+                    'cache_path': CACHE_PATH.format(index=worker.index),
+                    'metrics_port': None if self.metrics_port is None else self.metrics_port + worker.index}
+        worker.process = self.context.Process(
+            target=run_worker, args=(worker.index, worker.teams, worker.port, settings, self.health_queue),
+            name=f"worker-{worker.index}", daemon=True
+        )
+        worker.process.start()
+        worker.started = time.monotonic()
+        worker.restart_at = None
+        cpus = ",".join(map(str, sorted(worker.cpus))) if worker.cpus else "any"
+        print(f"[MAIN] Worker {worker.index} (pid {worker.process.pid}, port {worker.port}, cpus {cpus}) "
+              f"playing {worker.names()}")
+
+    def check_workers(self):
+        """
+        Schedule restarts of workers that exited and start those that are due.
+        """
+        now = time.monotonic()
+        for worker in self.workers:
+            if worker.restart_at is not None:
+                if now >= worker.restart_at:
+                    worker.restarts += 1
+                    self.start_worker(worker)
+                continue
+            if worker.process.is_alive():
+                continue
+            if now - worker.started >= STABLE_SECONDS:
+                worker.backoff = RESTART_BACKOFF
+            worker.restart_at = now + worker.backoff
+            print(f"[MAIN] Worker {worker.index} exited with code {worker.process.exitcode}, "
+                  f"restarting in {worker.backoff:.0f} s")
+            worker.backoff = min(worker.backoff * 2, MAX_BACKOFF)
+            worker.health = None
+
+    def collect_health(self, timeout):
+        """
+        Take the health reports the workers sent, waiting up to timeout seconds for the first.
+        """
+        try:
+            report = self.health_queue.get(timeout=timeout)
+            while True:
+                index, pid, health = report
+                worker = self.workers[index]
+                if worker.process is not None and worker.process.pid == pid:
+                    worker.health = health
+                    worker.reported = time.monotonic()
+                report = self.health_queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def report(self):
+        """
+        Log the health of all workers together.
+        """
+        now = time.monotonic()
+        up = sessions = engines = idle = failovers = 0
+        fast_path_counts = {}
+        problems = []
+        for worker in self.workers:
+            if worker.restart_at is not None or not worker.process.is_alive():
+                problems.append(f"worker {worker.index} down")
+                continue
+            up += 1
+            health = worker.health
+            if health is None or now - worker.reported > 2 * HEALTH_INTERVAL:
+                if now - worker.started > HEALTH_INTERVAL:
+                    problems.append(f"worker {worker.index} unresponsive")
+                continue
+            sessions += sum(1 for session in health['sessions'].values() if session['clients'])
+            engines += health['engines']
+            idle += health['idle_engines']
+            failovers += health['failovers']
+            for kind, count in health['fast_path_counts'].items():
+                fast_path_counts[kind] = fast_path_counts.get(kind, 0) + count
+        restarts = sum(worker.restarts for worker in self.workers)
+        moves = ", ".join(f"{kind} {count}" for kind, count in fast_path_counts.items())
+        print(f"[MAIN] {up}/{len(self.workers)} workers up, {restarts} restarts, {sessions} games, "
+              f"{engines - idle}/{engines} engines busy, {failovers} failovers; moves: {moves or 'none'}"
+              + (f"; {', '.join(problems)}" if problems else ""))
+
+    def stop(self):
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.terminate()
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(5)
+
+
+# --------------------------
+# Main Code: Start a supervised worker per group of teams
+# --------------------------
+def main():
+    config = configparser.ConfigParser()
+    config.read(CONFIG_PATH)
+    teams = read_teams(config)
+    if not teams:
+        print(f"[MAIN] No teams in {CONFIG_PATH}")
+        return
 
-    print("[MAIN] All clients have disconnected. Server still running (press Ctrl+C to stop).")
+    settings = config['supervisor'] if config.has_section('supervisor') else {}
+    cpu_sets = None
+    if settings.get('cpus'):
+        # One CPU list per worker, separated by semicolons, e.g. "0-3; 4-7".
+        cpu_sets = [parse_cpus(cpus) for cpus in settings.get('cpus').split(';')]
+    supervisor = TeamSupervisor(
+        teams,
+        teams_per_worker=int(settings.get('teams_per_worker', TEAMS_PER_WORKER)),
+        base_port=int(settings.get('base_port', BASE_PORT)),
+        engine_path=settings.get('engine_path', ENGINE_PATH),
+        engines=int(settings.get('engines', NUM_ENGINES)),
+        cpu_sets=cpu_sets,
+        metrics_port=int(settings['metrics_port']) if settings.get('metrics_port') else None,
+    )
+    supervisor.run()
 
 if __name__ == '__main__':
     main()
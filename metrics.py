@@ -0,0 +1,243 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram buckets in seconds, from sub-millisecond bookkeeping up to long searches.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Instruments record nothing until enable() is called, so that every call site costs one
+# check of this flag when metrics are off.
+_enabled = False
+_registry = []
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def enabled():
+    return _enabled
+
+
+def start_timer():
+    """
+    :return: A start time for Histogram.observe_since, or None while metrics are disabled.
+    """
+    return time.perf_counter() if _enabled else None
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        """
+        :param name: The metric name, e.g. "nachos_searches_started_total".
+        :param help: One line describing it.
+        :param labelnames: Names of its labels; values are given to labels().
+        """
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def labels(self, *values):
+        """
+        :return: The instrument for one combination of label values.
+        """
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in pairs) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self._children.items()):
+            lines.extend(child.render(self, values))
+        return lines
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def render(self, metric, values):
+        return [f"{metric.name}{metric._label_text(values)} {_number(self.value)}"]
+
+
+class _CounterValue(_Value):
+    def inc(self, amount=1):
+        if not _enabled:
+            return
+        with self._lock:
+            self.value += amount
+
+
+class _GaugeValue(_Value):
+    def set(self, value):
+        if _enabled:
+            self.value = value
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last bucket is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        if not _enabled:
+            return
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def observe_since(self, start):
+        """
+        Observe the seconds since a start_timer() time; nothing if the timer was not running.
+        """
+        if start is not None:
+            self.observe(time.perf_counter() - start)
+
+    def render(self, metric, values):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float('inf') else _number(bound)
+            lines.append(f"{metric.name}_bucket{metric._label_text(values, [('le', le)])} {cumulative}")
+        lines.append(f"{metric.name}_sum{metric._label_text(values)} {_number(total)}")
+        lines.append(f"{metric.name}_count{metric._label_text(values)} {cumulative}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeValue()
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+def _escape(text):
+    return text.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+# --------------------------
+# Instruments
+# --------------------------
+STAGE_SECONDS = Histogram(
+    "nachos_stage_seconds", "Time spent in each stage between a game update and our move.", ("stage",))
+SEARCHES_STARTED = Counter(
+    "nachos_searches_started_total", "Engine searches that got an engine, by priority class.", ("priority",))
+SEARCHES_ABORTED = Counter(
+    "nachos_searches_aborted_total", "Engine searches stopped or cancelled before they finished, by priority class.",
+    ("priority",))
+SEARCH_NODES = Counter("nachos_search_nodes_total", "Nodes searched by the engines.")
+SEARCH_NPS = Gauge("nachos_search_nps", "Nodes per second of the last finished search.")
+MOVES_SENT = Counter("nachos_moves_sent_total", "Moves sent to the clients, by how they were found.", ("kind",))
+
+
+def stage(name):
+    """
+    The histogram of one stage. Stages, in the order a move goes through them:
+
+        ws_receive      Client.main_loop handling a websocket message
+        server_receive  a command from its arrival on the server to the state task applying it
+        parse_moves     applying the new moves to the game tracker
+        coalesce        waiting for the coalescing window to close
+        engine_queue    a search waiting for an engine
+        engine_search   the engine searching a position we have to move in
+        send_move       checking and sending a move to its client
+        client_send     Client.listen_server passing a move on to the websocket
+        move            a position update to our move being sent, end to end
+    """
+    return STAGE_SECONDS.labels(name)
+
+
+def render():
+    """
+    :return: Every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # One line per scrape would drown the game log.
+
+
+def serve(port, host='localhost'):
+    """
+    Enable metrics and serve them at http://host:port/metrics from a background thread.
+
+    :return: The HTTP server; shutdown() stops it.
+    """
+    enable()
+    httpd = ThreadingHTTPServer((host, port), _Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name="metrics", daemon=True).start()
+    print(f"[METRICS] Serving metrics on http://{host}:{port}/metrics")
+    return httpd
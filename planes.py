@@ -0,0 +1,118 @@
+import csv
+
+import chess
+import numpy as np
+
+from board import POCKET_PIECE_TYPES, BughouseBoard
+
+# Planes of one board, in order.
+PIECE_PLANES = 12  # White pawn..king, then black pawn..king
+POCKET_PLANES = 10  # White pawn..queen, then black pawn..queen; filled with count / POCKET_SCALE
+PROMOTED_PLANE = PIECE_PLANES + POCKET_PLANES
+TURN_PLANE = PROMOTED_PLANE + 1  # 1 if white is to move
+CLOCK_PLANES = TURN_PLANE + 1  # White clock, black clock; filled with time / CLOCK_SCALE
+BOARD_PLANES = CLOCK_PLANES + 2
+
+# Planes shared by both boards, after the planes of board 2.
+TEAM_PLANE = 2 * BOARD_PLANES  # 1 if our team plays white on board 1
+MODE_PLANE = TEAM_PLANE + 1  # 1 in "sit" mode
+NUM_PLANES = MODE_PLANE + 1
+
+POCKET_SCALE = 16.0
+CLOCK_SCALE = 1800.0  # Clocks are in tenths of a second, as in BughouseBoard.times
+
+# Bitboards gathered per board before unpacking: the six piece types, both colours, promoted.
+_BITBOARDS = 9
+
+
+class PlaneEncoder:
+    """
+    Encodes batches of bughouse positions into NumPy input planes.
+
+    A batch is written into a preallocated float32 array of shape
+    (batch_size, NUM_PLANES, 8, 8); row 0 of a plane is the first rank and column 0 the
+    a-file. The only per-position Python work is reading the bitboards, pocket counts
+    and clocks; the bitboards are unpacked and split by colour for the whole batch at
+    once.
+    """
+
+    def __init__(self, batch_size=1024):
+        """
+        :param batch_size: Largest batch encode accepts.
+        """
+        self.batch_size = batch_size
+        self.planes = np.zeros((batch_size, NUM_PLANES, 8, 8), dtype=np.float32)
+        self._bitboards = np.zeros((batch_size, 2, _BITBOARDS), dtype=np.uint64)
+        self._scalars = np.zeros((batch_size, 2, POCKET_PLANES + 3), dtype=np.float32)
+        self._flags = np.zeros((batch_size, 2), dtype=np.float32)
+
+    def encode(self, positions, out=None):
+        """
+        Encode a batch of positions.
+
+        :param positions: A sequence of (BughouseBoard, side, mode) tuples, where side is
+            our team as passed to Engine.set_side and mode is "go" or "sit".
+        :param out: Array to write into instead of the encoder's own buffer, with at least
+            len(positions) rows.
+        :return: The planes of the batch: a view of the first len(positions) rows of out, or
+            of the encoder's buffer, which the next call overwrites.
+        """
+        n = len(positions)
+        if n > self.batch_size:
+            raise ValueError(f"batch of {n} positions exceeds batch size {self.batch_size}")
+        if out is None:
+            out = self.planes
+        # Gather into Python lists first: one array assignment per batch is much cheaper than
+        # setting array elements one at a time.
+        bitboard_rows = []
+        scalar_rows = []
+        flag_rows = []
+        for board, side, mode in positions:
+            for b in range(2):
+                cb = board.boards[b]
+                white_pocket, black_pocket = cb.pockets[chess.WHITE], cb.pockets[chess.BLACK]
+                bitboard_rows.append((cb.pawns, cb.knights, cb.bishops, cb.rooks, cb.queens, cb.kings,
+                                      cb.occupied_co[chess.WHITE], cb.occupied_co[chess.BLACK], cb.promoted))
+                scalar_rows.append([white_pocket.count(piece_type) for piece_type in POCKET_PIECE_TYPES]
+                                   + [black_pocket.count(piece_type) for piece_type in POCKET_PIECE_TYPES]
+                                   + [cb.turn == chess.WHITE, board.times[b][chess.WHITE], board.times[b][chess.BLACK]])
+            flag_rows.append((side == chess.WHITE, mode == "sit"))
+        bitboards = self._bitboards[:n]
+        scalars = self._scalars[:n]
+        flags = self._flags[:n]
+        bitboards[:] = np.array(bitboard_rows, dtype=np.uint64).reshape(n, 2, _BITBOARDS)
+        scalars[:] = np.array(scalar_rows, dtype=np.float32).reshape(n, 2, POCKET_PLANES + 3)
+        flags[:] = flag_rows
+
+        # (n, 2, 9) uint64 -> (n, 2, 9, 64) bits, square 0 (a1) first.
+        raw = bitboards.astype('<u8', copy=False).view(np.uint8).reshape(n, 2, _BITBOARDS, 8)
+        squares = np.unpackbits(raw, axis=-1, bitorder='little')
+        pieces = squares[:, :, :6, None, :] & squares[:, :, None, 6:8, :]  # (n, 2, type, colour, 64)
+        pieces = pieces.transpose(0, 1, 3, 2, 4).reshape(n, 2, PIECE_PLANES, 8, 8)
+
+        planes = out[:n]
+        for b in range(2):
+            base = b * BOARD_PLANES
+            planes[:, base:base + PIECE_PLANES] = pieces[:, b]
+            planes[:, base + PROMOTED_PLANE] = squares[:, b, 8].reshape(n, 8, 8)
+            planes[:, base + PIECE_PLANES:base + PROMOTED_PLANE] = (scalars[:, b, :POCKET_PLANES] / POCKET_SCALE)[:, :, None, None]
+            planes[:, base + TURN_PLANE] = scalars[:, b, POCKET_PLANES, None, None]
+            planes[:, base + CLOCK_PLANES:base + BOARD_PLANES] = (scalars[:, b, POCKET_PLANES + 1:] / CLOCK_SCALE)[:, :, None, None]
+        planes[:, TEAM_PLANE] = flags[:, 0, None, None]
+        planes[:, MODE_PLANE] = flags[:, 1, None, None]
+        return planes
+
+
+def read_positions(path="positions.csv"):
+    """
+    Load positions in the format of positions.csv (fen, color, mode, move).
+
+    :return: A list of (BughouseBoard, side, mode) tuples, ready for PlaneEncoder.encode.
+    """
+    positions = []
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            board = BughouseBoard()
+            board.set_fen(row["fen"])
+            positions.append((board, row["color"] == "white", row["mode"]))
+    return positions
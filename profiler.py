@@ -0,0 +1,110 @@
+import collections
+import os
+import sys
+import threading
+import time
+
+# Seconds between samples.
+SAMPLE_INTERVAL = 0.005
+# Innermost frames kept per stack.
+MAX_DEPTH = 64
+
+
+class SamplingProfiler:
+    """
+    Wall-clock stack sampler for a live process.
+
+    A background thread looks at the stack of every other thread every interval and
+    counts each distinct stack. The result is in the collapsed format of flamegraph.pl
+    and speedscope, one "thread;outermost;...;innermost count" line per stack. Blocked
+    threads are sampled too, so time spent waiting on an engine or a lock shows up
+    next to time spent computing.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self.started = None
+        self._counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, interval=None):
+        """
+        Start sampling from scratch.
+
+        :param interval: Seconds between samples, or None to keep the current interval.
+        :return: False if the profiler was already running.
+        """
+        if self.running:
+            return False
+        if interval is not None:
+            self.interval = interval
+        self._counts = collections.Counter()
+        self.samples = 0
+        self.started = time.monotonic()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        """
+        Stop sampling. The samples are kept until the next start.
+        """
+        if not self.running:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def collapsed(self, counts=None):
+        """
+        :param counts: A copy of the stack counts, or None for the current ones.
+        :return: The samples as collapsed stacks, most frequent first.
+        """
+        if counts is None:
+            counts = self._counts.copy()
+        return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+    def write(self, path=None, wait=True):
+        """
+        Write the collapsed stacks to a file.
+
+        :param path: The file, or None for profile-<pid>-<time>.folded in the working directory.
+        :param wait: False to copy the samples now and write them from a background thread.
+        :return: The path.
+        """
+        if path is None:
+            path = f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.folded"
+        counts, samples = self._counts.copy(), self.samples
+        if wait:
+            self._write(path, counts, samples)
+        else:
+            threading.Thread(target=self._write, args=(path, counts, samples), daemon=True).start()
+        return path
+
+    def _write(self, path, counts, samples):
+        with open(path, 'w') as f:
+            f.write(self.collapsed(counts))
+        print(f"[PROFILER] Wrote {samples} samples to {path}")
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_DEPTH:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self._counts[";".join(reversed(stack))] += 1
+            self.samples += 1
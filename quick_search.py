@@ -0,0 +1,194 @@
+import time
+
+import chess
+
+from board import PIECE_VALUES, POCKET_PIECE_TYPES, checking_squares
+
+# Default budget of a search in milliseconds.
+QUICK_MOVETIME = 30
+# Deepest iteration tried; in practice the deadline stops the search well before this.
+MAX_DEPTH = 6
+# Captures (or check evasions) followed beyond the nominal depth.
+QUIESCENCE_DEPTH = 4
+MATE_SCORE = 100000
+
+_VALUES = {piece_type: value * 100 for piece_type, value in PIECE_VALUES.items()}
+_PIECE_TYPES = [chess.PAWN, chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN]
+
+
+class _Timeout(Exception):
+    pass
+
+
+class QuickSearch:
+    """
+    Shallow alpha-beta search of one board, run in-process when there is no time for a
+    round trip to the engine.
+
+    The evaluation is material on the board plus the pockets. A capture is played the
+    bughouse way: the captured piece goes to the partner, not to the capturer's pocket.
+    The search deepens iteratively until the deadline, which is checked at every node,
+    and returns the best move of the last finished iteration. If not even the first one
+    finishes, the best-ordered move is returned, so the answer is always a legal move.
+    """
+
+    def __init__(self, max_depth=MAX_DEPTH):
+        self.max_depth = max_depth
+        self.nodes = 0
+        self._deadline = 0
+
+    def search(self, board, board_num, movetime=QUICK_MOVETIME):
+        """
+        Search one board of a bughouse position.
+
+        :param board: The BughouseBoard. It is not modified.
+        :param board_num: The board to move on.
+        :param movetime: Budget in milliseconds.
+        :return: (move in UCI format, score in centipawns for the side to move, depth reached),
+            or None if there is no legal move.
+        """
+        self._deadline = time.perf_counter() + movetime / 1000
+        self.nodes = 0
+        cb = board.boards[board_num].copy(stack=False)
+        moves = self._ordered(cb, list(cb.legal_moves))
+        if not moves:
+            return None
+
+        best_move, best_score, depth_reached = moves[0], None, 0
+        for depth in range(1, self.max_depth + 1):
+            try:
+                best_score, best_move = self._root(cb, moves, depth)
+            except _Timeout:
+                break
+            depth_reached = depth
+            moves.remove(best_move)
+            moves.insert(0, best_move)
+            if abs(best_score) >= MATE_SCORE - self.max_depth:
+                break
+        return best_move.uci(), best_score, depth_reached
+
+    def _root(self, cb, moves, depth):
+        alpha, beta = -MATE_SCORE - 1, MATE_SCORE + 1
+        best_move = moves[0]
+        for move in moves:
+            self._push(cb, move)
+            try:
+                score = -self._negamax(cb, depth - 1, -beta, -alpha, 1)
+            finally:
+                cb.pop()
+            if score > alpha:
+                alpha, best_move = score, move
+        return alpha, best_move
+
+    def _negamax(self, cb, depth, alpha, beta, ply):
+        self._tick()
+        if depth <= 0:
+            return self._quiesce(cb, alpha, beta, ply, QUIESCENCE_DEPTH)
+        moves = list(cb.legal_moves)
+        if not moves:
+            return -(MATE_SCORE - ply) if cb.is_check() else 0
+        for move in self._ordered(cb, moves):
+            self._push(cb, move)
+            try:
+                score = -self._negamax(cb, depth - 1, -beta, -alpha, ply + 1)
+            finally:
+                cb.pop()
+            if score >= beta:
+                return score
+            alpha = max(alpha, score)
+        return alpha
+
+    def _quiesce(self, cb, alpha, beta, ply, depth):
+        self._tick()
+        in_check = cb.is_check()
+        if in_check:
+            # No standing pat in check: every evasion is searched, and none means mate.
+            moves = list(cb.legal_moves)
+            if not moves:
+                return -(MATE_SCORE - ply)
+            if depth <= 0:
+                return evaluate(cb)
+        else:
+            stand = evaluate(cb)
+            if depth <= 0 or stand >= beta:
+                return stand
+            alpha = max(alpha, stand)
+            moves = list(cb.generate_legal_captures())
+        for move in self._ordered(cb, moves):
+            self._push(cb, move)
+            try:
+                score = -self._quiesce(cb, -beta, -alpha, ply + 1, depth - 1)
+            finally:
+                cb.pop()
+            if score >= beta:
+                return score
+            alpha = max(alpha, score)
+        return alpha
+
+    def _tick(self):
+        self.nodes += 1
+        if time.perf_counter() > self._deadline:
+            raise _Timeout()
+
+    @staticmethod
+    def _push(cb, move):
+        captured = None
+        if not move.drop and cb.is_capture(move):
+            captured = cb.piece_type_at(move.to_square) or chess.PAWN  # en passant
+            if cb.promoted & chess.BB_SQUARES[move.to_square]:
+                captured = chess.PAWN
+        cb.push(move)
+        if captured is not None:
+            # python-chess puts it in the capturer's pocket; in bughouse the partner gets it.
+            cb.pockets[not cb.turn].remove(captured)
+
+    @staticmethod
+    def _ordered(cb, moves):
+        """
+        Order moves for the search: captures by victim then attacker, promotions, checks
+        by drop or knight/pawn move, drops near the enemy king; drops onto squares the
+        opponent attacks and we do not defend come last.
+        """
+        king = cb.king(not cb.turn)
+        checking = checking_squares(cb, king) if king is not None else None
+        scored = []
+        for move in moves:
+            to_mask = chess.BB_SQUARES[move.to_square]
+            score = 0
+            if move.drop:
+                if checking is not None and checking[move.drop] & to_mask:
+                    score += 2000
+                if king is not None and chess.square_distance(king, move.to_square) <= 2:
+                    score += 300
+                if cb.is_attacked_by(not cb.turn, move.to_square) and not cb.is_attacked_by(cb.turn, move.to_square):
+                    score -= 5000 + _VALUES[move.drop]
+            else:
+                piece_type = cb.piece_type_at(move.from_square)
+                if cb.is_capture(move):
+                    victim = cb.piece_type_at(move.to_square) or chess.PAWN
+                    score += 10000 + 10 * _VALUES[victim] - _VALUES[piece_type] // 10
+                if move.promotion:
+                    score += 9000 + _VALUES[move.promotion]
+                check_type = move.promotion or piece_type
+                if checking is not None and check_type in checking and checking[check_type] & to_mask:
+                    score += 2000
+            scored.append((score, move))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return [move for _, move in scored]
+
+
+def evaluate(cb):
+    """
+    Material on the board and in the pockets, in centipawns for the side to move.
+
+    :param cb: A CrazyhouseBoard.
+    """
+    us, them = cb.occupied_co[cb.turn], cb.occupied_co[not cb.turn]
+    our_pocket, their_pocket = cb.pockets[cb.turn], cb.pockets[not cb.turn]
+    score = 0
+    for piece_type in _PIECE_TYPES:
+        mask = cb.pieces_mask(piece_type, chess.WHITE) | cb.pieces_mask(piece_type, chess.BLACK)
+        score += _VALUES[piece_type] * (chess.popcount(mask & us) - chess.popcount(mask & them))
+    for piece_type in POCKET_PIECE_TYPES:
+        score += _VALUES[piece_type] * (our_pocket.count(piece_type) - their_pocket.count(piece_type))
+    return score
@@ -0,0 +1,89 @@
+import collections
+import json
+import os
+import threading
+import time
+
+# Events kept; the oldest are dropped first. A game records a few thousand.
+CAPACITY = 32768
+
+
+class FlightRecorder:
+    """
+    Bounded in-memory log of server events, cheap enough to leave on for every game.
+
+    Events go into a deque with a maximum length, whose append is atomic, so any thread
+    records without taking a lock and old events fall out on their own. Each event is
+    stamped with time.monotonic() and the name of the recording thread. A dump writes a
+    snapshot as JSON lines, to reconstruct what the server was doing when a game went wrong.
+    """
+
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self._events = collections.deque(maxlen=capacity)
+        self.dumps = 0
+
+    def __len__(self):
+        return len(self._events)
+
+    def record(self, event, **fields):
+        """
+        Record an event.
+
+        :param event: What happened, e.g. "command", "submit", "bestmove" or "send".
+        :param fields: Plain values describing it.
+        """
+        self._events.append((time.monotonic(), threading.current_thread().name, event, fields))
+
+    def snapshot(self):
+        """
+        :return: The recorded events, oldest first, as (monotonic time, thread, event, fields).
+        """
+        while True:
+            try:
+                return list(self._events)
+            except RuntimeError:
+                continue  # Appended to while being copied; copy again.
+
+    def dump(self, path=None, wait=True):
+        """
+        Write the events to a file: a header line, then one JSON object per event with its
+        monotonic time "t", the wall clock time "wall", "thread", "event" and its fields.
+
+        :param path: The file, or None for flight-<pid>-<time>-<dump number>.jsonl in the working directory.
+        :param wait: False to take the snapshot now and write it from a background thread.
+        :return: The path.
+        """
+        self.dumps += 1
+        if path is None:
+            path = f"flight-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}-{self.dumps}.jsonl"
+        events = self.snapshot()
+        monotonic, wall = time.monotonic(), time.time()
+        if wait:
+            self._write(path, events, monotonic, wall)
+        else:
+            threading.Thread(target=self._write, args=(path, events, monotonic, wall), daemon=True).start()
+        return path
+
+    def _write(self, path, events, monotonic, wall):
+        with open(path, 'w') as f:
+            header = {'pid': os.getpid(), 'monotonic': monotonic, 'wall': wall,
+                      'events': len(events), 'capacity': self.capacity}
+            f.write(json.dumps(header) + "\n")
+            for t, thread, event, fields in events:
+                line = {'t': round(t, 6), 'wall': round(wall - (monotonic - t), 6), 'thread': thread, 'event': event}
+                line.update(fields)
+                f.write(json.dumps(line, default=str) + "\n")
+        print(f"[RECORDER] Wrote {len(events)} events to {path}")
+
+
+# The process-wide recorder every module records to.
+RECORDER = FlightRecorder()
+
+
+def record(event, **fields):
+    RECORDER.record(event, **fields)
+
+
+def dump(path=None, wait=True):
+    return RECORDER.dump(path, wait)
@@ -0,0 +1,333 @@
+import concurrent.futures
+import itertools
+import threading
+import time
+from enum import IntEnum
+
+import metrics
+import recorder
+
+# Engine-seconds used by a session count half as much after USAGE_HALF_LIFE seconds,
+# so fair share follows recent load rather than the whole game.
+USAGE_HALF_LIFE = 60.0
+# Speculative and analysis jobs allowed to wait for an engine beyond the idle ones.
+OVERCOMMIT = 2
+
+_ENGINE_QUEUE = metrics.stage("engine_queue")
+
+
+class Priority(IntEnum):
+    MUST_MOVE = 0  # A search whose move is about to be played
+    PONDER = 1  # The opponent's predicted reply to our last move
+    SPECULATION = 2  # Likely captures on either board
+    ANALYSIS = 3  # Offline work; only runs on engines nobody else wants
+
+
+class Preempted(Exception):
+    """
+    The result of a job whose search was stopped early to free its engine for a
+    must-move search. Its best move so far is not worth playing.
+    """
+
+
+class Job:
+    """
+    A submitted function waiting for, or running on, an engine.
+    """
+
+    def __init__(self, fn, args, kwargs, priority, session, deadline, timeout, seq):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.session = session
+        self.deadline = deadline  # time.monotonic() by which the job is worthless, or None
+        self.timeout = timeout
+        self.seq = seq
+        self.future = concurrent.futures.Future()
+        self.queued = metrics.start_timer()
+        self.engine = None
+        self.search = None  # Id of the engine's next search when the job started, see Engine.stop
+        self.started = None
+        self.preempted = False
+
+
+class EngineScheduler:
+    """
+    Hands the engines of an EnginePool to jobs by priority instead of in submission order.
+
+    Jobs of a better class always start first. Must-move searches start by earliest
+    deadline, so the game with the least time on its clock goes first; within the other
+    classes the session that used the fewest engine-seconds recently goes first, so one
+    busy game cannot starve the others. When a must-move search finds every engine busy,
+    the least important running ponder, speculation or analysis search is stopped and
+    its future fails with Preempted, so a cut-off search is never mistaken for a finished one.
+
+    Ponder, speculation and analysis jobs whose deadline passes while they wait are
+    cancelled. Engine time is accounted per session and class.
+    """
+
+    def __init__(self, pool, overcommit=OVERCOMMIT, half_life=USAGE_HALF_LIFE):
+        """
+        :param pool: The EnginePool. The scheduler runs one thread per engine.
+        :param overcommit: Speculative and analysis jobs allowed to wait beyond the idle engines.
+        :param half_life: Seconds after which a session's engine time counts half for fair share.
+        """
+        self.pool = pool
+        self.overcommit = overcommit
+        self.half_life = half_life
+        self.preemptions = 0
+        self.expired = 0
+        self._cond = threading.Condition()
+        self._queue = []  # Jobs waiting for an engine
+        self._running = {}  # future -> Job on an engine
+        self._usage = {}  # session -> (engine-seconds with decay, time.monotonic() of the last update)
+        self._totals = {}  # session -> {Priority: engine-seconds}
+        self._seq = itertools.count()
+        self._closed = False
+        self._threads = [threading.Thread(target=self._work, name=f"scheduler-{i}", daemon=True)
+                         for i in range(len(pool))]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, fn, *args, priority=Priority.ANALYSIS, session="", deadline=None, timeout=None, **kwargs):
+        """
+        Run fn(engine, *args, **kwargs) on an engine when the job's turn comes.
+
+        :param fn: The job. It receives the engine as its first argument.
+        :param priority: The job's Priority.
+        :param session: Name of the game the job works for, for fair share and accounting.
+        :param deadline: Seconds from now after which the result is of no use. Orders
+            must-move jobs; other jobs still waiting by then are cancelled.
+        :param timeout: Seconds the job may hold the engine before the search is stopped,
+            which makes get_best_move return its current best move.
+        :return: A Future with the job's result.
+        """
+        job = Job(fn, args, kwargs, priority, session,
+                  None if deadline is None else time.monotonic() + deadline, timeout, next(self._seq))
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("scheduler is closed")
+            self._queue.append(job)
+            victim = self._preemption_victim() if priority == Priority.MUST_MOVE else None
+            if victim is not None:
+                victim.engine.stop(victim.search)
+            self._cond.notify()
+        _record("submit", job, fn=fn.__name__, deadline=deadline)
+        if victim is not None:
+            _record("preempt", victim, by=job.seq)
+            print(f"[SCHEDULER] Preempting a {victim.priority.name.lower()} search of "
+                  f"{victim.session or 'the default game'} for a must-move search")
+        return job.future
+
+    def reprioritize(self, future, priority, deadline=None):
+        """
+        Change the class of a job, e.g. when a ponder search turns into the search we move with.
+
+        :param future: A Future returned by submit.
+        :param priority: The new Priority.
+        :param deadline: Seconds from now, as in submit, or None to keep the current deadline.
+        """
+        with self._cond:
+            job = self._running.get(future) or next((job for job in self._queue if job.future is future), None)
+            if job is None:
+                return
+            job.priority = priority
+            if deadline is not None:
+                job.deadline = time.monotonic() + deadline
+            self._cond.notify()
+
+    def stop(self, future):
+        """
+        Abort a job: cancel it if it has not started, otherwise stop its engine's search.
+
+        :param future: A Future returned by submit.
+        """
+        if future.cancel():
+            return  # Dropped from the queue by the next _pick
+        with self._cond:
+            job = self._running.get(future)
+            if job is None:
+                return
+            # Under the lock, so the engine cannot have been handed to another job yet.
+            job.engine.stop(job.search)
+        _aborted(job)
+        _record("stop", job)
+
+    def stop_all(self):
+        """
+        Cancel every waiting job and stop every running search.
+        """
+        with self._cond:
+            queued, self._queue = self._queue, []
+            running = list(self._running.values())
+            for job in running:
+                job.engine.stop(job.search)
+        for job in queued:
+            if job.future.cancel():
+                _aborted(job)
+        for job in running:
+            _aborted(job)
+
+    def available(self, priority=Priority.MUST_MOVE):
+        """
+        Number of jobs of a class that can be submitted without waiting behind the
+        allowed overcommit.
+        """
+        with self._cond:
+            free = len(self._threads) - len(self._running) - sum(not job.future.cancelled() for job in self._queue)
+        if priority >= Priority.SPECULATION:
+            free += self.overcommit
+        return free
+
+    def usage(self):
+        """
+        Engine time per session.
+
+        :return: {session: {'recent': engine-seconds with decay, class name: engine-seconds}}.
+        """
+        now = time.monotonic()
+        with self._cond:
+            return {session: {'recent': round(self._recent(session, now), 3),
+                              **{priority.name.lower(): round(seconds, 3) for priority, seconds in totals.items()}}
+                    for session, totals in self._totals.items()}
+
+    def stats(self):
+        """
+        :return: Queued and running jobs, preemptions, expired jobs and usage, for health reports.
+        """
+        with self._cond:
+            queued = sum(not job.future.cancelled() for job in self._queue)
+            running = len(self._running)
+        return {'queued': queued, 'running': running, 'preemptions': self.preemptions,
+                'expired': self.expired, 'usage': self.usage()}
+
+    def close(self):
+        """
+        Stop all work, end the scheduler threads and close the pool.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self.stop_all()
+        for thread in self._threads:
+            thread.join()
+        self.pool.close()
+
+    def _recent(self, session, now):
+        seconds, updated = self._usage.get(session, (0.0, now))
+        return seconds * 0.5 ** ((now - updated) / self.half_life)
+
+    def _preemption_victim(self):
+        # Called with the lock held, after a must-move job was queued.
+        waiting = sum(job.priority == Priority.MUST_MOVE and not job.future.cancelled() for job in self._queue)
+        idle = len(self._threads) - len(self._running)
+        releasing = sum(job.preempted for job in self._running.values())
+        if waiting <= idle + releasing:
+            return None
+        candidates = [job for job in self._running.values()
+                      if job.priority > Priority.MUST_MOVE and not job.preempted and job.engine is not None]
+        if not candidates:
+            return None
+        # The least important class, and within it the search that started last and so loses least.
+        victim = max(candidates, key=lambda job: (job.priority, job.started))
+        victim.preempted = True
+        self.preemptions += 1
+        _aborted(victim)
+        return victim
+
+    def _pick(self, now):
+        # Called with the lock held. Drops cancelled and expired jobs, then takes the best one.
+        live = []
+        for job in self._queue:
+            if job.future.cancelled():
+                _aborted(job)
+                _record("cancel", job)
+                continue
+            if job.priority > Priority.MUST_MOVE and job.deadline is not None and job.deadline < now:
+                self.expired += 1
+                job.future.cancel()
+                _aborted(job)
+                _record("expire", job)
+                continue
+            live.append(job)
+        self._queue = live
+        if not live:
+            return None
+
+        def key(job):
+            if job.priority == Priority.MUST_MOVE:
+                return job.priority, float('inf') if job.deadline is None else job.deadline, job.seq
+            return job.priority, self._recent(job.session, now), job.seq
+
+        job = min(live, key=key)
+        live.remove(job)
+        return job
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job = None
+                while job is None:
+                    if self._closed:
+                        return
+                    job = self._pick(time.monotonic())
+                    if job is None:
+                        self._cond.wait()
+            engine = self.pool.checkout()
+            with self._cond:
+                if not job.future.set_running_or_notify_cancel():
+                    self.pool.checkin(engine)
+                    continue
+                job.engine = engine
+                job.search = engine.searches + 1
+                job.started = time.monotonic()
+                self._running[job.future] = job
+            _ENGINE_QUEUE.observe_since(job.queued)
+            metrics.SEARCHES_STARTED.labels(job.priority.name.lower()).inc()
+            _record("start", job)
+            self._run(job)
+
+    def _run(self, job):
+        timer = None
+        if job.timeout is not None:
+            timer = threading.Timer(job.timeout, self._timeout, args=(job,))
+            timer.daemon = True
+            timer.start()
+        try:
+            result = job.fn(job.engine, *job.args, **job.kwargs)
+        except BaseException as e:
+            job.future.set_exception(e)
+        else:
+            if job.preempted:
+                job.future.set_exception(Preempted(f"job {job.seq} was preempted"))
+            else:
+                job.future.set_result(result)
+        finally:
+            now = time.monotonic()
+            _record("done", job, ms=round((now - job.started) * 1000, 1))
+            with self._cond:
+                if timer is not None:
+                    timer.cancel()
+                elapsed = now - job.started
+                self._usage[job.session] = (self._recent(job.session, now) + elapsed, now)
+                totals = self._totals.setdefault(job.session, {})
+                totals[job.priority] = totals.get(job.priority, 0.0) + elapsed
+                del self._running[job.future]
+                self.pool.checkin(job.engine)
+                self._cond.notify()
+
+    def _timeout(self, job):
+        # Timer thread. The job may have ended while the timer fired, and its engine
+        # moved on to another job; only stop it while the job still holds it.
+        with self._cond:
+            if self._running.get(job.future) is job:
+                job.engine.stop(job.search)
+
+
+def _aborted(job):
+    metrics.SEARCHES_ABORTED.labels(job.priority.name.lower()).inc()
+
+
+def _record(event, job, **fields):
+    recorder.record(event, job=job.seq, priority=job.priority.name.lower(), session=job.session, **fields)
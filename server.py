@@ -1,15 +1,44 @@
+import asyncio
 import chess
-import socket
 import concurrent.futures
+import os
+import signal
+import socket
 import threading
 import random
-import pickle
-from threading import Lock
-
-from board import BughouseBoard
-from engine import Engine, parse_moves
-
-engine = Engine("./hivemind")
+import time
+
+import metrics
+import recorder
+from book import open_book
+from engine_pool import EnginePool
+from eval_cache import EvalCache, position_key
+from framing import CommandProtocol
+from profiler import SamplingProfiler
+from quick_search import QuickSearch
+from scheduler import EngineScheduler, Preempted, Priority
+from tracker import GameTracker
+
+# Seconds a search may overrun its movetime before the scheduler stops it.
+JOB_TIMEOUT_MARGIN = 1.0
+# Milliseconds past movetime after which a search is reported as slow.
+SLOW_SEARCH_MS = 100
+# Longest search (ms) on the position after the opponent's predicted reply.
+PONDER_MOVETIME = 5000
+# Clock (tenths of a second) below which we move with QuickSearch instead of waiting for the engine.
+QUICK_MOVE_CLOCK = 30
+# Seconds past movetime after which a search that has not answered is replaced by QuickSearch.
+ENGINE_DEADLINE_MARGIN = 0.3
+_SERVER_RECEIVE = metrics.stage("server_receive")
+_PARSE_MOVES = metrics.stage("parse_moves")
+_COALESCE = metrics.stage("coalesce")
+_ENGINE_SEARCH = metrics.stage("engine_search")
+_SEND_MOVE = metrics.stage("send_move")
+_MOVE = metrics.stage("move")
+
+# Seconds position updates are collected before the search is restarted, so that a burst
+# (a capture on one board and a reply on the other) restarts it once. 0 restarts at once.
+COALESCE_WINDOW = 0.010
 
 def clean_fen(extended_fen):
     # Split the FEN string by whitespace into its components.
@@ -62,13 +91,6 @@ def compute_thinking_time(q, min_time, max_time, exponent=1, random_range=200):
     time = max(min(time, max_time), min_time)
     return time
 
-def save_book(book):
-    with open('book.pkl', 'wb') as f:
-        pickle.dump(book, f)
-
-def sort_hand(hand):
-    return ''.join(sorted(hand))
-
 from enum import Enum
 
 
@@ -160,11 +182,43 @@ def compute_thinking_time(q, phase, exponent=1, random_range=500):
 
     return time
 
+class PredictedSearch:
+    """
+    A search on a position we expect to reach: the opponent's predicted reply to our
+    last move (ponder) or a likely capture on either board (speculation).
+    """
+
+    def __init__(self, kind, moves_snapshot, side, clients, movetime):
+        self.kind = kind  # "PONDER" or "SPECULATE", used in log messages
+        self.moves_snapshot = moves_snapshot  # moves_snapshot that counts as a hit
+        self.side = side
+        self.clients = clients
+        self.movetime = movetime
+        self.started = time.monotonic()
+        self.future = None
+        self.hit = False  # Set once the prediction came true; the job then sends its own move
+        self.finished = False  # The search has ended and its result was handed to the state task
+        self.result = None  # (best_move, q_value, ponder_move) if the search ended before the hit
+
+
 # --------------------------
 # Server Code
 # --------------------------
 class Server:
-    def __init__(self, host='localhost', port=12345):
+    """
+    Receives game updates from the clients and answers with engine moves.
+
+    A client joins a GameSession with "join <team> <board>"; one server hosts any number
+    of team games over a shared engine pool, cache and book. Clients that never join are
+    seated in the default session in connection order.
+
+    Networking runs on an asyncio event loop in a background thread. Every command, and
+    every finished engine search, is handed to a single state task that owns the sessions'
+    boards, trackers and prediction bookkeeping, so none of that state needs a lock. The
+    engines run on the EngineScheduler's threads and only ever see snapshots.
+    """
+
+    def __init__(self, host='localhost', port=12345, engine_path="./hivemind", num_engines=2, ponder=True, speculation_width=2, cache_path="eval_cache.sqlite", standby_engines=1, book_path="book.bin", coalesce_window=COALESCE_WINDOW, metrics_port=None):
         self.host = host
         self.port = port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -173,171 +227,913 @@ class Server:
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen()
         print(f"[SERVER] Listening on {self.host}:{self.port}")
+        self.pool = EnginePool(engine_path, num_engines, standby=standby_engines)
+        # Every search goes through the scheduler, so sessions and search kinds share the engines by priority.
+        self.scheduler = EngineScheduler(self.pool)
+        self.loop = None
+        self.events = None  # (function, args) queue consumed by the state task
+        self.pondering = ponder
+        self.speculation_width = speculation_width
+        self.coalesce_window = coalesce_window
+        # Without a port nothing is measured; with one, latencies and counters are served there.
+        self.metrics = None if metrics_port is None else metrics.serve(metrics_port)
+        self.profiler = SamplingProfiler()
+        self.install_signal_handlers()
+        self.cache = EvalCache(cache_path)
+        # Memory-mapped, so it costs nothing until probed; convert an old book.pkl with book.py.
+        self.book = open_book(book_path)
+        self.quick_search = QuickSearch()
+        self.sessions = {}  # team name -> GameSession
+        self.client_sessions = {}  # CommandProtocol -> the GameSession it plays in
+
+    def start(self):
+        """
+        Run the server on an event loop in a background thread. Returns once it accepts connections.
+        """
+        ready = threading.Event()
+        thread = threading.Thread(target=lambda: asyncio.run(self.serve(ready)), name="server", daemon=True)
+        thread.start()
+        ready.wait()
+
+    async def serve(self, ready=None):
+        """
+        Accept clients and run the state task until cancelled.
+
+        :param ready: A threading.Event to set once connections are accepted.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.events = asyncio.Queue()
+        server = await self.loop.create_server(
+            lambda: CommandProtocol(self.on_command, self.on_connect, self.on_disconnect),
+            sock=self.server_socket
+        )
+        if ready is not None:
+            ready.set()
+        async with server:
+            await self.run_state()
+
+    def post(self, function, *args):
+        """
+        Have the state task call function(*args). Safe to call from any thread.
+        """
+        self.loop.call_soon_threadsafe(self.events.put_nowait, (function, args))
+
+    async def run_state(self):
+        """
+        The state task: applies commands and search results one at a time, in arrival order.
+        """
+        while True:
+            function, args = await self.events.get()
+            try:
+                function(*args)
+            except Exception as e:
+                print(f"[SERVER] Error in {function.__name__}: {e}")
+
+    def install_signal_handlers(self):
+        """
+        SIGUSR1 dumps the flight recorder and SIGUSR2 starts or stops the profiler. Signal
+        handlers can only be installed from the main thread; elsewhere use the "dump" and
+        "profile" commands.
+        """
+        if not hasattr(signal, 'SIGUSR1') or threading.current_thread() is not threading.main_thread():
+            return
+        signal.signal(signal.SIGUSR1, lambda signum, frame: recorder.dump(wait=False))
+        signal.signal(signal.SIGUSR2, lambda signum, frame: self.toggle_profiler())
+
+    def toggle_profiler(self, interval=None, path=None):
+        """
+        Start the profiler, or stop it and write its collapsed stacks from a background thread.
+
+        :param interval: Seconds between samples when starting.
+        :param path: The file to write when stopping, or None for the default name.
+        """
+        if self.profiler.running:
+            self.profiler.stop()
+            self.profiler.write(path, wait=False)
+        else:
+            self.profiler.start(interval)
+            print(f"[PROFILER] Sampling every {self.profiler.interval * 1000:.1f} ms")
+
+    def handle_debug_command(self, cmd):
+        """
+        "dump [file]" writes the flight recorder; "profile start [interval ms]" and
+        "profile stop [file]" control the profiler. Files are written to the working
+        directory under their base name. Nothing is sent back, since clients pass whatever
+        the server sends on to the game, and a bad command is only logged: it never costs
+        the client its game.
+        """
+        args = cmd.split()
+        try:
+            if args[0] == "dump" and len(args) <= 2:
+                recorder.dump(_debug_path(args[1]) if len(args) > 1 else None, wait=False)
+            elif args[0] == "profile" and args[1:2] == ["start"] and len(args) <= 3:
+                interval = float(args[2]) / 1000 if len(args) > 2 else None
+                if interval is not None and not 0 < interval < float('inf'):
+                    raise ValueError(f"bad interval {args[2]}")
+                if not self.profiler.running:
+                    self.toggle_profiler(interval=interval)
+            elif args[0] == "profile" and args[1:2] == ["stop"] and len(args) <= 3:
+                path = _debug_path(args[2]) if len(args) > 2 else None
+                if self.profiler.running:
+                    self.toggle_profiler(path=path)
+            else:
+                raise ValueError("unknown command")
+        except (ValueError, OSError) as e:
+            print(f"[SERVER] Ignoring debug command {cmd!r}: {e}")
+
+    def health(self, timeout=1.0):
+        """
+        Snapshot of the server's state, taken on the state task. Safe to call from any thread.
+
+        :param timeout: Seconds to wait for the state task.
+        :return: A dict of plain values: engines, idle engines, failovers, cache hits and
+            misses, the scheduler's stats, fast path and update counts summed over the
+            sessions, and per session the boards with a client and the plies played.
+        :raises TimeoutError: If the state task did not answer in time.
+        """
+        future = concurrent.futures.Future()
+
+        def snapshot():
+            fast_path_counts = {}
+            update_counts = {}
+            sessions = {}
+            for name, session in self.sessions.items():
+                for kind, count in session.fast_path_counts.items():
+                    fast_path_counts[kind] = fast_path_counts.get(kind, 0) + count
+                for kind, count in session.update_counts.items():
+                    update_counts[kind] = update_counts.get(kind, 0) + count
+                sessions[name] = {
+                    'clients': sum(client is not None for client in session.clients),
+                    'plies': [len(board.move_stack) for board in session.board.boards],
+                }
+            future.set_result({
+                'engines': len(self.pool),
+                'idle_engines': self.pool.idle_count(),
+                'failovers': 0 if self.pool.supervisor is None else self.pool.supervisor.failovers,
+                'cache_hits': self.cache.hits,
+                'cache_misses': self.cache.misses,
+                'scheduler': self.scheduler.stats(),
+                'fast_path_counts': fast_path_counts,
+                'update_counts': update_counts,
+                'sessions': sessions,
+            })
+
+        self.post(snapshot)
+        return future.result(timeout)
+
+    def on_connect(self, client):
+        print(f"[SERVER] Accepted connection from {client.peer}")
+        self.post(self.add_client, client)
+
+    def on_disconnect(self, client):
+        print(f"[SERVER] Client {client.peer} disconnected")
+        self.post(self.remove_client, client)
+
+    def on_command(self, client, command):
+        self.post(self.handle_command, client, command, metrics.start_timer())
+
+    def session(self, name):
+        """
+        The session of a team, created on first use.
+        """
+        session = self.sessions.get(name)
+        if session is None:
+            session = self.sessions[name] = GameSession(self, name)
+            if name:
+                print(f"[SERVER] Started game session {name} ({len(self.sessions)} sessions)")
+        return session
+
+    def add_client(self, client):
+        session = self.session("")
+        if session.add_client(client) is not None:
+            self.client_sessions[client] = session
+
+    def join(self, client, name, board_num):
+        """
+        Move a client to the session of its team, on the board it plays.
+        """
+        current = self.client_sessions.get(client)
+        if current is not None and current.name == name and current.clients[board_num] is client:
+            return
+        self.remove_client(client)
+        session = self.session(name)
+        replaced = session.clients[board_num]
+        if replaced is not None:
+            self.client_sessions.pop(replaced, None)
+        session.add_client(client, board_num)
+        self.client_sessions[client] = session
+        print(f"[SERVER] Client {client.peer} joined {name} on board {board_num + 1}")
+
+    def remove_client(self, client):
+        session = self.client_sessions.pop(client, None)
+        if session is None:
+            return
+        session.remove_client(client)
+        if session.name and session.is_empty():
+            session.close()
+            del self.sessions[session.name]
+            print(f"[SERVER] Closed game session {session.name} ({len(self.sessions)} sessions)")
+
+    def handle_command(self, client, cmd, received=None):
+        """
+        Route one command from a client to its session. Runs on the state task.
+
+        :param received: metrics.start_timer() time the command arrived at.
+        """
+        _SERVER_RECEIVE.observe_since(received)
+        session = self.client_sessions.get(client)
+        recorder.record("command", session=None if session is None else session.name, cmd=cmd)
+        if cmd.startswith("dump") or cmd.startswith("profile"):
+            self.handle_debug_command(cmd)
+            return
+        try:
+            if cmd.startswith("join"):
+                # "join <team> <board>"
+                _, name, board_num = cmd.split(" ")
+                board_num = int(board_num)
+                if board_num not in (0, 1):
+                    raise ValueError(f"no board {board_num}")
+                self.join(client, name, board_num)
+                return
+            if session is None:
+                print(f"[SERVER] Ignoring command from {client.peer}, which is not in a game")
+                return
+            changed = session.apply_command(client, cmd)
+        except Exception as e:
+            print(f"[SERVER] Error with client {client.peer}: {e}")
+            self.remove_client(client)
+            client.close()
+            return
+
+        if changed:
+            session.schedule_update()
+
+
+# --------------------------
+# Game Sessions
+# --------------------------
+class GameSession:
+    """
+    One team game: both boards, the clocks, our side, the two clients playing for us and
+    the searches and predictions running for the game.
+
+    Sessions share the server's engine scheduler, cache and book. Every method except
+    compute_move and predicted_search, which run on scheduler threads, runs on the server's
+    state task.
+    """
+
+    def __init__(self, server, name):
+        """
+        :param server: The Server hosting the session.
+        :param name: The team name the clients joined with; "" for clients that never joined.
+        """
+        self.server = server
+        self.name = name
+        self.scheduler = server.scheduler
+        self.cache = server.cache
+        self.book = server.book
+        self.quick_search = server.quick_search
+        self.clients = [None, None]  # CommandProtocol playing each board
         self.moves = ["", ""]
         self.moves_snapshot = ""
         self.last_move = ["", ""]
         self.hands = ["", ""]
-        self.clients = []  # List of client sockets
-        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
         self.current_future = None
         self.times = [[1800, 1800], [1800, 1800]]
-        self.board = BughouseBoard()
+        self.tracker = GameTracker()
+        self.board = self.tracker.board
         self.side = chess.WHITE
-        self.mutex = Lock()
         self.positions = []
         self.job_id = 0
         self.q = 0
-        #self.book = {}
-        with open('book.pkl', 'rb') as f:
-            self.book = pickle.load(f)
+        self.pondering = server.pondering
+        self.ponder = None
+        self.ponder_hits = 0
+        self.ponder_misses = 0
+        self.speculation_width = server.speculation_width
+        self.coalesce_window = server.coalesce_window
+        self.update_handle = None  # Pending flush_update while a coalescing window is open
+        self.scheduled_snapshot = None  # moves_snapshot of the last scheduled update
+        self.pending_changes = 0  # Distinct positions seen in the open window
+        self.window_opened = None  # metrics.start_timer() time of the first update in the window
+        self.position_received = None  # The same for the position we have not moved in yet
+        self.flagged = False  # One of our clocks is at zero
+        # updates: positions scheduled; duplicates: updates that carried nothing new;
+        # coalesced: positions merged into a later one; restarts: running searches stopped.
+        self.update_counts = {"updates": 0, "duplicates": 0, "coalesced": 0, "restarts": 0}
+        self.speculation = {}  # predicted moves_snapshot -> PredictedSearch
+        self.speculation_hits = 0
+        self.speculation_misses = 0
+        self.fast_path_counts = {"mate": 0, "forced": 0, "book": 0, "quick": 0, "engine": 0}
+        self.sent_plies = [None, None]  # Length of each board's move stack when we last sent a move on it
+
+    @property
+    def loop(self):
+        return self.server.loop
+
+    def post(self, function, *args):
+        self.server.post(function, *args)
+
+    def add_client(self, client, board_num=None):
+        """
+        Seat a client on a board, replacing whichever client was there.
 
-    def start(self):
-        thread = threading.Thread(target=self.accept_clients, daemon=True)
-        thread.start()
+        :param board_num: The board, or None for the first free one.
+        :return: The board, or None if both are taken.
+        """
+        if board_num is None:
+            if None not in self.clients:
+                return None
+            board_num = self.clients.index(None)
+        self.clients[board_num] = client
+        return board_num
 
-    def accept_clients(self):
-        while True:
-            client_sock, client_addr = self.server_socket.accept()
-            self.clients.append(client_sock)
-            print(f"[SERVER] Accepted connection from {client_addr}")
-            # Start a new thread to handle communication with this client
-            client_thread = threading.Thread(target=self.handle_client, args=(client_sock, client_addr), daemon=True)
-            client_thread.start()
-
-    def handle_client(self, client_sock, client_addr):
-        while True:
-            try:
-                data = client_sock.recv(1024)
-                if not data:
-                    print(f"[SERVER] Client {client_addr} disconnected")
-                    self.clients.remove(client_sock)
-                    client_sock.close()
-                    break
-
-                message = data.decode()
-
-                for cmd in message.split("\n"):
-                    if not cmd:
-                        continue
-
-                    with self.mutex:
-                        if cmd.startswith("side"):
-                            _, side = cmd.split(" ")
-                            self.side = side == "0"
-
-                        elif cmd.startswith("times"):
-                            _, board_num, a, b = cmd.split(" ")
-                            board_num = int(board_num)
-                            self.times[board_num] = [int(a), int(b)]
-
-                        elif cmd.startswith("moves"):
-                            _, board_num, tcn_moves = cmd.split(" ")
-                            board_num = int(board_num)
-
-                            if tcn_moves != self.moves[board_num]:
-                                self.moves[board_num] = tcn_moves
-                                try:
-                                    print(self.moves)
-                                    self.board, self.moves_snapshot = parse_moves(self.moves)
-                                except Exception as e:
-                                    print(e)
-                                    continue
-
-                future_to_wait = None
-                with self.mutex:
-                    if self.moves_snapshot not in self.positions:
-                        self.positions.append(self.moves_snapshot)
-                        while len(self.positions) > 1:
-                            self.positions.pop(0)
-
-                        # Create a snapshot of the current board state and other variables
-                        board_snapshot = self.board.fen()[:]  # Adjust copying as needed
-                        side_snapshot = self.side
-                        clients_snapshot = self.clients[:]  # shallow copy of client list
-                        # Note: If your board is mutable, consider a deep copy.
-
-                        # Calculate time difference etc.
-                        time_difference = self.times[1][self.side] - self.times[0][self.side]
-
-                        # Abort any currently running computation.
-                        if self.current_future is not None and not self.current_future.done():
-                            print("[MAIN LOOP] Stopping previous engine computation.")
-                            # Tell the engine to stop (which internally sends "stop" to the engine).
-                            engine.stop()
-                            self.job_id += 1
-                            future_to_wait = self.current_future
-
-                        phase = get_phase(self.times)
-                        movetime = compute_thinking_time(self.q, phase)
-
-                        # Submit the new job and update the current_future reference.
-                        self.current_future = self.executor.submit(
-                            self.compute_and_send_move,
-                            board_snapshot,
-                            self.moves_snapshot,
-                            time_difference,
-                            movetime,
-                            side_snapshot,
-                            clients_snapshot,
-                            self.job_id
-                        )
-
-                # Release the lock before waiting for the previous future to complete.
-                if future_to_wait is not None:
-                    try:
-                        future_to_wait.result(timeout=50)
-                    except concurrent.futures.TimeoutError:
-                        print("[MAIN LOOP] Previous computation did not finish in time.")
+    def remove_client(self, client):
+        self.clients = [None if c is client else c for c in self.clients]
 
-            except Exception as e:
-                print(f"[SERVER] Error with client {client_addr}: {e}")
-                self.clients.remove(client_sock)
-                client_sock.close()
-                break
+    def is_empty(self):
+        return self.clients == [None, None]
 
-    def compute_and_send_move(self, board_snapshot, moves_snapshot, time_difference, movetime, side, clients, job_id):
+    def close(self):
+        """
+        Stop every search of the session.
         """
-        Runs in a separate thread. It checks that the board state hasn't changed
-        since the snapshot was taken, then sets the engine position based on that snapshot,
-        computes the best move, and sends the move to the appropriate client.
+        if self.current_future is not None:
+            self.scheduler.stop(self.current_future)
+        if self.ponder is not None:
+            self.scheduler.stop(self.ponder.future)
+        for job in self.speculation.values():
+            self.scheduler.stop(job.future)
+        if self.update_handle is not None:
+            self.update_handle.cancel()
+            self.update_handle = None
+        self.job_id += 1
+
+    def apply_command(self, client, cmd):
         """
-        global engine
+        Apply a side, times, moves or delta command from one of the session's clients.
 
-        # First, check that the board state is still what we expect.
-        with self.mutex:
-            current_snapshot = self.board.fen()[:]  # make a copy of the current board state
-        if current_snapshot != board_snapshot:
-            print("[ENGINE THREAD] Board state updated before move calculation. Aborting move.")
+        :return: True if the position may have changed and update_position should run.
+        :raises ValueError: If the command is malformed.
+        """
+        if cmd.startswith("side"):
+            _, side = cmd.split(" ")
+            self.side = side == "0"
+
+        elif cmd.startswith("times"):
+            _, board_num, a, b = cmd.split(" ")
+            board_num = int(board_num)
+            self.times[board_num] = [int(a), int(b)]
+            flagged = any(self.our_clock(n) <= 0 for n in range(2))
+            if flagged and not self.flagged:
+                print(f"[RECORDER] Our clock ran out in {self.name or 'the default game'}, dumping the flight recorder.")
+                recorder.dump(wait=False)
+            self.flagged = flagged
+
+        elif cmd.startswith("moves"):
+            _, board_num, tcn_moves = cmd.split(" ")
+            board_num = int(board_num)
+
+            if tcn_moves == self.moves[board_num]:
+                # Both clients forward both boards, so every update arrives twice.
+                self.update_counts["duplicates"] += 1
+                return False
+            self.moves[board_num] = tcn_moves
+            return self.apply_moves(lambda: self.tracker.update(self.moves))
+
+        elif cmd.startswith("delta"):
+            # "delta <board> <seq> <tcn>": the moves after the first <seq> moves of the board.
+            _, board_num, seq, tcn_moves = cmd.split(" ")
+            board_num, seq = int(board_num), int(seq)
+
+            received = self.tracker.received_plies(board_num)
+            if seq > received:
+                print(f"[SERVER] Gap on board {board_num + 1}: update starts at move {seq}, have {received}. Requesting resync.")
+                client.send(f"resync {board_num}\n")
+                return False
+            # Both clients forward both boards, so part or all of an update may be known already.
+            tcn_moves = tcn_moves[2 * (received - seq):]
+            if not tcn_moves:
+                self.update_counts["duplicates"] += 1
+                return False
+            self.moves[board_num] += tcn_moves
+            return self.apply_moves(lambda: self.tracker.extend(board_num, tcn_moves))
+        return True
+
+    def apply_moves(self, update):
+        """
+        Run a tracker update and adopt the new board.
+
+        :param update: Callable that updates self.tracker and returns whether it is complete.
+        :return: True if every received move is on the board.
+        """
+        try:
+            print(self.moves)
+            started = metrics.start_timer()
+            complete = update()
+            _PARSE_MOVES.observe_since(started)
+            self.board = self.tracker.board
+        except Exception as e:
+            print(e)
+            self.tracker.reset()
+            self.board = self.tracker.board
+            self.moves = ["", ""]
+            for client in self.clients:
+                if client is not None:
+                    client.send("resync 0\nresync 1\n")
+            return False
+        if not complete:
+            print(f"[SERVER] Waiting for partner board, pending moves {self.tracker.pending}")
+            return False
+        self.moves_snapshot = self.tracker.moves_snapshot
+        return True
+
+    def schedule_update(self):
+        """
+        Run update_position when the coalescing window opened by the first of a burst of
+        updates closes, so the burst restarts the search once. Runs on the state task.
+        """
+        if self.moves_snapshot != self.scheduled_snapshot:
+            self.scheduled_snapshot = self.moves_snapshot
+            if not self.pending_changes:
+                self.window_opened = metrics.start_timer()
+            self.pending_changes += 1
+            self.update_counts["updates"] += 1
+        if self.coalesce_window <= 0:
+            self.flush_update()
+        elif self.update_handle is None:
+            self.update_handle = self.loop.call_later(self.coalesce_window, self.post, self.flush_update)
+
+    def flush_update(self):
+        """
+        Close the coalescing window and work on the latest position. Runs on the state task.
+        """
+        self.update_handle = None
+        if self.pending_changes:
+            # Clock and side updates flush too, but only a window opened by a new position is timed.
+            _COALESCE.observe_since(self.window_opened)
+            self.position_received = self.window_opened
+            self.window_opened = None
+        if self.pending_changes > 1:
+            self.update_counts["coalesced"] += self.pending_changes - 1
+            print(f"[SERVER] Coalesced {self.pending_changes} updates into one ({self.update_counts})")
+        self.pending_changes = 0
+        self.update_position()
+
+    def update_position(self):
+        """
+        Start working on the current position if it is new. Runs on the state task.
+        """
+        if self.moves_snapshot in self.positions:
+            return
+        self.positions.append(self.moves_snapshot)
+        while len(self.positions) > 1:
+            self.positions.pop(0)
+
+        # Calculate time difference etc.
+        time_difference = self.times[1][self.side] - self.times[0][self.side]
+
+        phase = get_phase(self.times)
+        movetime = compute_thinking_time(self.q, phase)
+
+        recorder.record("position", session=self.name, plies=[len(board.move_stack) for board in self.board.boards],
+                        clocks=[list(times) for times in self.times], movetime=round(movetime))
+        # Abort any currently running computation, also before a prediction hit takes its place.
+        if self.current_future is not None and not self.current_future.done():
+            print("[MAIN LOOP] Stopping previous engine computation.")
+            self.update_counts["restarts"] += 1
+            recorder.record("restart", session=self.name)
+            # Stop the engine running the previous job; the new job goes to the next idle engine.
+            self.scheduler.stop(self.current_future)
+            self.job_id += 1
+
+        if self.resolve_predictions(time_difference, movetime):
             return
 
-        best_move = None
-        # Compute best move based on the snapshot.
-        should_sit = (time_difference > 10) and self.q < 0.3
+        move_now = self.should_move(time_difference)
+        if self.play_instant_move(move_now):
+            return
 
-        if job_id == self.job_id:
-            if (self.board.turn(0) == self.side and self.board.turn(1) != self.side) or (not should_sit and (self.board.turn(0) == self.side or self.board.turn(1) != self.side)):
-                engine.set_mode("go")
-                #engine.set_mode("sit" if sit else "go")
-                engine.set_side(side)
-                engine.set_position(moves=moves_snapshot)
-                best_move, q_value, nodes = engine.get_best_move(movetime=movetime)
+        if move_now:
+            low_clock = [b for b in self.our_boards() if self.our_clock(b) < QUICK_MOVE_CLOCK]
+            if low_clock and self.play_quick_move(low_clock, "Low clock"):
+                return
+            self.fast_path_counts["engine"] += 1
+            board_snapshot = self.board.zobrist
+            moves_snapshot = self.moves_snapshot
+            side_snapshot = self.side
+            clients_snapshot = self.clients[:]
+            future = self.scheduler.submit(
+                self.compute_move,
+                board_snapshot,
+                moves_snapshot,
+                movetime,
+                side_snapshot,
+                position_key(self.board, side_snapshot, "go"),
+                self.job_id,
+                priority=Priority.MUST_MOVE,
+                session=self.name,
+                deadline=self.move_deadline(movetime),
+                timeout=movetime / 1000 + JOB_TIMEOUT_MARGIN
+            )
+            future.add_done_callback(
+                lambda f: self.post(self.finish_move, f, board_snapshot, moves_snapshot, side_snapshot, clients_snapshot))
+            self.current_future = future
+            self.loop.call_later(movetime / 1000 + ENGINE_DEADLINE_MARGIN, self.post, self.engine_overdue, future, board_snapshot)
+        self.start_speculation(movetime)
+
+    def our_boards(self):
+        """
+        Boards where our team is to move. Boards where the move we sent has not come back
+        yet are left out: a move played there without the engine would answer the position
+        our own move is about to replace.
+        """
+        # Our team is self.side on board 1 and the other colour on board 2.
+        return [b for b in range(2) if (self.board.turn(b) == self.side) == (b == 0)
+                and self.sent_plies[b] != len(self.board.boards[b].move_stack)]
 
-        if best_move is None or best_move == "pass" or best_move == "(none)":
+    def our_clock(self, board_num):
+        """
+        Our clock on a board, in tenths of a second.
+        """
+        return self.times[board_num][self.side if board_num == 0 else not self.side]
+
+    def move_deadline(self, movetime):
+        """
+        Seconds until our move has to be played: the search's budget, or less if our clock
+        on a board where we are to move runs out first.
+        """
+        return min([movetime / 1000 + ENGINE_DEADLINE_MARGIN] + [self.our_clock(b) / 10 for b in self.our_boards()])
+
+    def instant_move(self, move_now):
+        """
+        Find a move that needs no search: a mate in one on either of our boards, and when
+        we are moving at all, the only legal move of a board or a book move.
+
+        :param move_now: Whether should_move decided to play rather than sit.
+        :return: (kind, move) with the move in engine format, or None.
+        """
+        ours = self.our_boards()
+        for b in ours:
+            move = self.board.mating_move(b)
+            if move is not None:
+                return "mate", f"{b + 1}{move}"
+        if not move_now:
+            return None
+        for b in ours:
+            legal = self.board.legal_moves(b)
+            if len(legal) == 1:
+                return "forced", f"{b + 1}{next(iter(legal))}"
+        if self.book is not None:
+            for b in ours:
+                move = self.book.choose(self.board, b)
+                if move is not None:
+                    return "book", f"{b + 1}{move}"
+        return None
+
+    def play_instant_move(self, move_now):
+        """
+        Send the move from instant_move straight to its client. Runs on the state task.
+
+        :return: True if a move was sent and no search is needed.
+        """
+        instant = self.instant_move(move_now)
+        if instant is None:
+            return False
+        kind, move = instant
+        if not self.send_move(move, self.clients, kind):
+            return False
+        self.fast_path_counts[kind] += 1
+        counts = ", ".join(f"{name} {count}" for name, count in self.fast_path_counts.items())
+        print(f"[FAST PATH] Played {kind} move {move} ({counts})")
+        return True
+
+    def play_quick_move(self, boards, reason):
+        """
+        Search with QuickSearch in-process and send its move, for when waiting for the
+        engine could cost the game on time. Runs on the state task, which it holds for at
+        most the QuickSearch movetime.
+
+        :param boards: Boards to try, in order.
+        :param reason: Why the engine is bypassed, for the log.
+        :return: True if a move was sent.
+        """
+        for b in boards:
+            result = self.quick_search.search(self.board, b)
+            if result is None:
+                continue
+            move, score, depth = result
+            if self.send_move(f"{b + 1}{move}", self.clients, "quick"):
+                self.fast_path_counts["quick"] += 1
+                print(f"[QUICK] {reason}: played {b + 1}{move} (score {score}, depth {depth}, {self.quick_search.nodes} nodes)")
+                return True
+        return False
+
+    def engine_overdue(self, future, board_snapshot):
+        """
+        Fall back to QuickSearch if a search has not answered by its deadline and nothing
+        was played in its position since. Runs on the state task.
+        """
+        if future is not self.current_future or self.board.zobrist != board_snapshot:
             return
+        recorder.record("overdue", session=self.name)
+        self.scheduler.stop(future)
+        self.current_future = None
+        self.play_quick_move(self.our_boards(), "Engine missed its deadline")
 
-        with self.mutex:
-            self.q = q_value
+    def compute_move(self, engine, board_snapshot, moves_snapshot, movetime, side, cache_key, job_id):
+        """
+        Runs on a scheduler thread with an engine checked out for it. Searches the snapshot
+        position unless the board has already moved on; finish_move then sends the result
+        from the state task.
+
+        :return: (best_move, q_value, ponder_move), or None if there was nothing to search.
+        """
+        # Only an early exit: finish_move checks the board again before anything is sent.
+        if self.board.zobrist != board_snapshot:
+            print("[ENGINE THREAD] Board state updated before move calculation. Aborting move.")
+            return None
+        if job_id != self.job_id:
+            return None
+
+        entry = self.cache.get(cache_key, movetime)
+        if entry is not None:
+            print(f"[ENGINE THREAD] Cache hit: {entry}")
+            recorder.record("bestmove", session=self.name, move=entry.best_move, q=entry.q, cached=True)
+            return entry.best_move, entry.q, None
+
+        engine.set_mode("go")
+        #engine.set_mode("sit" if sit else "go")
+        engine.set_side(side)
+        engine.set_position(moves=moves_snapshot)
+        started = metrics.start_timer()
+        best_move, q_value, nodes = engine.get_best_move(movetime=movetime)
+        _ENGINE_SEARCH.observe_since(started)
+        result = engine.last_result
+        _count_nodes(result)
+        recorder.record("bestmove", session=self.name, move=best_move, q=q_value, nodes=nodes,
+                        ms=round(result.elapsed * 1000, 1), movetime=round(movetime))
+        if result.overrun > SLOW_SEARCH_MS:
+            print(f"[ENGINE THREAD] Slow search: {result.elapsed * 1000:.0f} ms for movetime {movetime:.0f}, {result.info}")
+        if best_move not in (None, "pass", "(none)"):
+            # A preempted search only counts for the time it actually ran.
+            self.cache.put(cache_key, best_move, q_value, nodes, min(movetime, result.elapsed * 1000))
+        return best_move, q_value, engine.ponder_move
+
+    def finish_move(self, future, board_snapshot, moves_snapshot, side, clients):
+        """
+        Send the result of compute_move if the board is still the one that was searched.
+        Runs on the state task.
+        """
+        if future is not self.current_future:
+            return  # Superseded by a newer search or by engine_overdue
+        result = _search_result(future)
+        if result is None:
+            return
+        # The engine answered; a failed search is left to engine_overdue.
+        self.current_future = None
+        best_move, q_value, ponder_move = result
+        if best_move is None or best_move == "pass" or best_move == "(none)":
+            return
 
+        self.q = q_value
         print(q_value)
 
         # Check again that the board state hasn't changed during calculation.
-        with self.mutex:
-            current_snapshot = self.board.fen()[:]
-        if current_snapshot != board_snapshot:
+        if self.board.zobrist != board_snapshot:
             print("[ENGINE THREAD] Board state updated after move calculation. Aborting move.")
             return
 
-        # Send the move to the appropriate client.
+        if self.send_move(best_move, clients, "engine"):
+            self.start_ponder(moves_snapshot, best_move, ponder_move, side, clients)
+
+    def should_move(self, time_difference):
+        """
+        Decide whether we play in the current position or sit and wait for pieces.
+        """
+        should_sit = (time_difference > 10) and self.q < 0.3
+        return (self.board.turn(0) == self.side and self.board.turn(1) != self.side) or (not should_sit and (self.board.turn(0) == self.side or self.board.turn(1) != self.side))
+
+    def send_move(self, best_move, clients, kind):
+        """
+        Send an engine move to the client playing that board, unless it is not legal in the
+        current position. Runs on the state task.
+
+        :param kind: How the move was found ("engine", "ponder", "book", ...), for the metrics.
+        :return: True if the move was sent.
+        """
+        started = metrics.start_timer()
         client_index = int(best_move[0]) - 1
-        clients[client_index].sendall(best_move[1:].encode())
-        print(f"Sent move {best_move} to client {client_index + 1}")
\ No newline at end of file
+        if clients[client_index] is None:
+            print(f"[SERVER] No client on board {client_index + 1} for move {best_move}.")
+            return False
+        if not self.board.is_legal(client_index, best_move[1:]):
+            print(f"[SERVER] Engine move {best_move} is not legal in the current position, not sending it.")
+            return False
+        clients[client_index].send(best_move[1:] + "\n")
+        self.sent_plies[client_index] = len(self.board.boards[client_index].move_stack)
+        print(f"Sent move {best_move} to client {client_index + 1}")
+        recorder.record("send", session=self.name, move=best_move, kind=kind)
+        _SEND_MOVE.observe_since(started)
+        _MOVE.observe_since(self.position_received)
+        self.position_received = None
+        metrics.MOVES_SENT.labels(kind).inc()
+        return True
+
+    def start_ponder(self, moves_snapshot, best_move, ponder_move, side, clients):
+        """
+        Start searching the position after the opponent's predicted reply to the move we
+        just sent. Runs on the state task.
+        """
+        if self.ponder is not None:
+            self.scheduler.stop(self.ponder.future)
+            self.ponder = None
+        if not self.pondering or ponder_move is None:
+            return
+
+        predicted = " ".join(move for move in (moves_snapshot, best_move, ponder_move) if move)
+        self.ponder = self.submit_prediction("PONDER", predicted, side, clients, PONDER_MOVETIME)
+        print(f"[PONDER] Pondering on {ponder_move}")
+
+    def start_speculation(self, movetime):
+        """
+        Search the positions after the opponent's most likely captures on each board, since
+        a capture on one board changes the pockets on the other. Only idle engines are used,
+        so speculation never queues in front of a real search. Runs on the state task.
+        """
+        budget = min(self.speculation_width, self.scheduler.available(Priority.SPECULATION))
+        if budget <= 0:
+            return
+
+        candidates = []
+        for board_num in range(2):
+            # Our team is self.side on board 1 and the other colour on board 2.
+            if (self.board.turn(board_num) == self.side) != (board_num == 0):
+                candidates.extend((score, board_num, move) for score, move in self.board.likely_captures(board_num))
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+
+        for score, board_num, move in candidates:
+            if len(self.speculation) >= budget:
+                break
+            predicted = " ".join(m for m in (self.moves_snapshot, f"{board_num + 1}{move.uci()}") if m)
+            if predicted in self.speculation or (self.ponder is not None and self.ponder.moves_snapshot == predicted):
+                continue
+            self.speculation[predicted] = self.submit_prediction("SPECULATE", predicted, self.side, self.clients[:], movetime)
+
+    def submit_prediction(self, kind, moves_snapshot, side, clients, movetime):
+        job = PredictedSearch(kind, moves_snapshot, side, clients, movetime)
+        if kind == "PONDER":
+            priority, deadline = Priority.PONDER, None
+        else:
+            # A capture that has not been searched within the movetime is probably stale.
+            priority, deadline = Priority.SPECULATION, movetime / 1000
+        job.future = self.scheduler.submit(self.predicted_search, job, priority=priority, session=self.name,
+                                           deadline=deadline, timeout=movetime / 1000 + JOB_TIMEOUT_MARGIN)
+        job.future.add_done_callback(lambda f: self.post(self.finish_prediction, job, f))
+        return job
+
+    def resolve_predictions(self, time_difference, movetime):
+        """
+        Compare a new position against the pending ponder and speculative searches.
+        Runs on the state task.
+
+        :return: True on a hit that has been (or is being) answered by a predicted search.
+        """
+        hit = None
+
+        ponder, self.ponder = self.ponder, None
+        if ponder is not None:
+            if ponder.moves_snapshot.startswith(f"{self.moves_snapshot} ") or not self.moves_snapshot:
+                # Our own move (or part of the predicted line) arrived first; keep waiting.
+                self.ponder = ponder
+            elif ponder.moves_snapshot == self.moves_snapshot:
+                hit = ponder
+            else:
+                self.scheduler.stop(ponder.future)
+                self.ponder_misses += 1
+                print(f"[PONDER] Miss ({self.ponder_hits} hits, {self.ponder_misses} misses)")
+
+        # Speculation always branches off the previous position, so every other entry is stale now.
+        speculation, self.speculation = self.speculation, {}
+        for moves_snapshot, job in speculation.items():
+            if moves_snapshot == self.moves_snapshot and hit is None:
+                hit = job
+            else:
+                self.scheduler.stop(job.future)
+        if speculation and hit is None:
+            self.speculation_misses += 1
+
+        if hit is None:
+            return False
+        if not self.should_move(time_difference) or (hit.result is None and hit.finished):
+            # Not our move, or the search ended without a usable move; search normally.
+            self.scheduler.stop(hit.future)
+            return False
+
+        if hit.kind == "PONDER":
+            self.ponder_hits += 1
+            print(f"[PONDER] Hit ({self.ponder_hits} hits, {self.ponder_misses} misses)")
+        else:
+            self.speculation_hits += 1
+            print(f"[SPECULATE] Hit ({self.speculation_hits} hits, {self.speculation_misses} misses)")
+
+        if hit.result is not None:
+            best_move, q_value, ponder_move = hit.result
+            if not self.send_move(best_move, hit.clients, hit.kind.lower()):
+                return False
+            self.q = q_value
+            self.start_ponder(hit.moves_snapshot, best_move, ponder_move, hit.side, hit.clients)
+            return True
+
+        # Keep the running search and give it what is left of this move's thinking time.
+        hit.hit = True
+        self.current_future = hit.future
+        remaining = movetime / 1000 - (time.monotonic() - hit.started)
+        self.scheduler.reprioritize(hit.future, Priority.MUST_MOVE, self.move_deadline(max(remaining, 0) * 1000))
+        self.loop.call_later(max(remaining, 0), self.scheduler.stop, hit.future)
+        return True
+
+    def predicted_search(self, engine, job):
+        """
+        Runs on a scheduler thread. Searches the predicted position; finish_prediction decides
+        what to do with the result.
+
+        :return: (best_move, q_value, ponder_move), or None without a usable move.
+        """
+        engine.set_mode("go")
+        engine.set_side(job.side)
+        engine.set_position(moves=job.moves_snapshot)
+        best_move, q_value, nodes = engine.get_best_move(movetime=job.movetime)
+        _count_nodes(engine.last_result)
+        recorder.record("bestmove", session=self.name, kind=job.kind.lower(), move=best_move, q=q_value, nodes=nodes,
+                        ms=round(engine.last_result.elapsed * 1000, 1), movetime=round(job.movetime))
+
+        if best_move is None or best_move == "pass" or best_move == "(none)":
+            return None
+        return best_move, q_value, engine.ponder_move
+
+    def finish_prediction(self, job, future):
+        """
+        Keep a predicted search's result for a later hit or, if the hit already happened,
+        send its move. Runs on the state task.
+        """
+        job.finished = True
+        result = _search_result(future)
+        if result is None:
+            if job.hit and future is self.current_future and self.moves_snapshot == job.moves_snapshot:
+                # The hit was preempted or failed before it found a move; search the position normally.
+                print(f"[{job.kind}] Search ended without a usable move after the hit. Searching again.")
+                self.current_future = None
+                self.positions.clear()
+                self.update_position()
+            return
+        if not job.hit:
+            job.result = result
+            return
+        if self.moves_snapshot != job.moves_snapshot:
+            print(f"[{job.kind}] Board state updated after hit. Aborting move.")
+            return
+
+        best_move, q_value, ponder_move = result
+        self.q = q_value
+        print(q_value)
+        if self.send_move(best_move, job.clients, job.kind.lower()):
+            self.start_ponder(job.moves_snapshot, best_move, ponder_move, job.side, job.clients)
+
+
+def _count_nodes(result):
+    """
+    Add a finished search to the node counter and the NPS gauge.
+    """
+    if result is None or result.info.nodes is None:
+        return
+    metrics.SEARCH_NODES.inc(result.info.nodes)
+    if result.info.nps is not None:
+        metrics.SEARCH_NPS.set(result.info.nps)
+    elif result.elapsed > 0:
+        metrics.SEARCH_NPS.set(result.info.nodes / result.elapsed)
+
+
+def _debug_path(name):
+    """
+    The file a debug command may write: the base name of name, in the working directory.
+
+    :raises ValueError: If name has no usable base name.
+    """
+    path = os.path.basename(name)
+    if path in ("", ".", ".."):
+        raise ValueError(f"bad file name {name!r}")
+    return path
+
+
+def _search_result(future):
+    """
+    The value of a finished pool job, or None if it was cancelled, preempted or failed.
+    """
+    try:
+        return future.result()
+    except (concurrent.futures.CancelledError, Preempted):
+        return None
+    except Exception as e:
+        print(f"[ENGINE THREAD] Search failed: {e}")
+        return None
@@ -0,0 +1,237 @@
+import queue
+import threading
+import time
+
+from engine import Engine, EngineTerminated
+
+# Seconds past movetime before a search counts as hung and is sent "stop".
+HUNG_GRACE = 1.0
+# Failovers tried within one search before giving up.
+MAX_FAILOVERS = 2
+# Shortest search (ms) started on a standby that replaces a failed engine.
+MIN_RESUME_MOVETIME = 50
+
+
+class EngineSupervisor:
+    """
+    Keeps pre-warmed standby engines ready to replace engines that crash or hang.
+
+    Standbys have already finished their uci handshake, so a failover only costs the
+    commands needed to replay the position. A replacement standby is started in the
+    background after each failover.
+    """
+
+    def __init__(self, engine_path, standby=1):
+        """
+        :param engine_path: Path to the hivemind executable.
+        :param standby: Number of standby engines to keep warm.
+        """
+        self.engine_path = engine_path
+        self.failovers = 0
+        self._standby = queue.Queue()
+        self._closed = False
+        for _ in range(standby):
+            self._standby.put(Engine(engine_path))
+
+    def supervise(self, engine):
+        """
+        Wrap an engine so that it fails over to a standby.
+
+        :param engine: A running Engine.
+        :return: The SupervisedEngine.
+        """
+        return SupervisedEngine(self, engine)
+
+    def take_standby(self):
+        """
+        Hand out a warm standby and start warming its replacement.
+
+        :return: A ready Engine. If no standby is warm yet, one is started on the spot.
+        """
+        try:
+            engine = self._standby.get_nowait()
+        except queue.Empty:
+            engine = None
+        threading.Thread(target=self._refill, daemon=True).start()
+        if engine is None or not engine.is_alive():
+            engine = Engine(self.engine_path)
+        return engine
+
+    def close(self):
+        self._closed = True
+        while not self._standby.empty():
+            self._standby.get_nowait().quit()
+
+    def _refill(self):
+        try:
+            engine = Engine(self.engine_path)
+        except (OSError, EngineTerminated) as e:
+            print(f"[SUPERVISOR] Could not start standby engine: {e}")
+            return
+        if self._closed:
+            engine.quit()
+        else:
+            self._standby.put(engine)
+
+
+class _Watchdog:
+    """
+    Sends "stop" to a search that overruns its deadline and kills the engine if it
+    still has not answered after another grace period. Only the search it was started
+    for is stopped, so a watchdog that fires late cannot end the engine's next search.
+    """
+
+    def __init__(self, engine, seconds):
+        self.engine = engine
+        self.search = engine.searches + 1  # Id of the search about to start
+        self.fired = False
+        self._timer = threading.Timer(seconds, self._stop)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def cancel(self):
+        self._timer.cancel()
+
+    def _stop(self):
+        self.fired = True
+        print("[SUPERVISOR] Search overran its deadline, sending stop.")
+        try:
+            if not self.engine.stop(self.search):
+                return  # The search answered in the meantime.
+        except EngineTerminated:
+            return
+        self._timer = threading.Timer(HUNG_GRACE, self._kill)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _kill(self):
+        print("[SUPERVISOR] Engine did not answer stop, killing it.")
+        self.engine.kill()
+
+
+class SupervisedEngine:
+    """
+    Engine with the same interface that survives crashes and hung searches.
+
+    It remembers the mode, side and position it was given, so after a failover the
+    standby gets the same setup and the interrupted search resumes with whatever is
+    left of its movetime.
+    """
+
+    def __init__(self, supervisor, engine):
+        self.supervisor = supervisor
+        self.engine = engine
+        self.failovers = 0
+        self.searches = 0  # Searches started, counted across failovers as Engine.searches
+        self._searching = None  # Id of the running search, or None
+        self._search_lock = threading.Lock()
+        self._mode = None
+        self._side = None
+        self._position = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # pv, ponder_move, last_result, stderr, ... of the current engine.
+        return getattr(self.engine, name)
+
+    def send_command(self, command):
+        self._call(lambda engine: engine.send_command(command))
+
+    def set_position(self, fen=None, moves=None):
+        self._position = (fen, moves)
+        self._call(lambda engine: engine.set_position(fen=fen, moves=moves))
+
+    def set_side(self, side):
+        self._side = side
+        self._call(lambda engine: engine.set_side(side))
+
+    def set_mode(self, mode):
+        self._mode = mode
+        self._call(lambda engine: engine.set_mode(mode))
+
+    def stop(self, search=None):
+        """
+        Stop a search, as Engine.stop.
+
+        :param search: Id of the search to stop (self.searches when it was running), or
+            None for whichever search is running.
+        :return: True if stop was sent.
+        """
+        with self._search_lock:
+            if self._searching is None or (search is not None and search != self._searching):
+                return False
+            try:
+                return self.engine.stop()
+            except EngineTerminated:
+                # The searching thread notices the dead engine and fails over itself.
+                return False
+
+    def quit(self, timeout=5):
+        self.engine.quit(timeout)
+
+    def search(self, movetime=1000, on_info=None):
+        """
+        Run a search, failing over to a standby if the engine dies or hangs.
+
+        :param movetime: The time in milliseconds to search for.
+        :param on_info: Called with each SearchInfo while the search runs.
+        :return: The SearchResult.
+        """
+        started = time.monotonic()
+        remaining = movetime
+        with self._search_lock:
+            self.searches += 1
+            self._searching = self.searches
+        try:
+            for attempt in range(MAX_FAILOVERS + 1):
+                engine = self.engine
+                watchdog = _Watchdog(engine, remaining / 1000 + HUNG_GRACE)
+                try:
+                    return engine.search(remaining, on_info=on_info)
+                except EngineTerminated as e:
+                    if attempt == MAX_FAILOVERS:
+                        raise
+                    self._failover(engine, e)
+                finally:
+                    watchdog.cancel()
+                remaining = max(movetime - (time.monotonic() - started) * 1000, MIN_RESUME_MOVETIME)
+        finally:
+            with self._search_lock:
+                self._searching = None
+
+    def get_best_move(self, movetime=1000):
+        """
+        Get the best move from the current position, as Engine.get_best_move.
+        """
+        result = self.search(movetime)
+        info = result.info
+        return result.best_move, 0 if info.q is None else info.q, 0 if info.nodes is None else info.nodes
+
+    def _call(self, command):
+        for attempt in range(MAX_FAILOVERS + 1):
+            engine = self.engine
+            try:
+                return command(engine)
+            except EngineTerminated as e:
+                if attempt == MAX_FAILOVERS:
+                    raise
+                self._failover(engine, e)
+
+    def _failover(self, failed, error):
+        with self._lock:
+            if self.engine is not failed:
+                return  # Another thread already replaced it.
+            tail = "\n".join(list(failed.stderr)[-10:])
+            print(f"[SUPERVISOR] Engine failed ({error}), switching to standby. Last stderr:\n{tail}")
+            failed.kill()
+            engine = self.supervisor.take_standby()
+            if self._mode is not None:
+                engine.set_mode(self._mode)
+            if self._side is not None:
+                engine.set_side(self._side)
+            if self._position is not None:
+                fen, moves = self._position
+                engine.set_position(fen=fen, moves=moves)
+            self.engine = engine
+            self.failovers += 1
+            self.supervisor.failovers += 1
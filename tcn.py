@@ -1,77 +1,130 @@
-import math
+import sys
+
 import chess
 
+TCN_CHARS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!?{~}(^)[_]@#$,./&-*++='
+PIECE_CHARS = 'qnrbkp'
+
+_PIECE_TYPES = {symbol: chess.Piece.from_symbol(symbol).piece_type for symbol in PIECE_CHARS}
+
+
+def _decode_pair(o, s):
+    """
+    Decode a single pair of alphabet indices into a packed move tuple.
+
+    This is the 1:1 port of the chess-tcn npm library that chess.com uses; it is
+    only run once per pair when the lookup tables are built.
+
+    :param o: Alphabet index of the first character.
+    :param s: Alphabet index of the second character.
+    :return: (from_square, to_square, promotion, drop), or None if the pair does not encode a move.
+    """
+    promotion = None
+    drop = None
+    if s > 63:
+        if (s - 64) // 3 >= len(PIECE_CHARS):
+            return None
+        promotion = _PIECE_TYPES[PIECE_CHARS[(s - 64) // 3]]
+        s = o + (-8 if o < 16 else 8) + ((s - 1) % 3) - 1
+    if not 0 <= s < 64:
+        return None
+    if o > 75:
+        if o - 79 < 0:
+            return None
+        drop = _PIECE_TYPES[PIECE_CHARS[o - 79]]
+        from_square = s
+    else:
+        from_square = o
+    if from_square > 63:
+        return None
+    return from_square, s, promotion, drop
+
+
+def _build_tables():
+    # Both decode tables are keyed by a pair of TCN characters read as one native-endian
+    # 16-bit integer, so a whole game string can be decoded with a single memoryview cast.
+    packed_table = {}
+    move_table = {}
+    encode = {}
+
+    for o, first in enumerate(TCN_CHARS):
+        for s, second in enumerate(TCN_CHARS):
+            packed = _decode_pair(o, s)
+            if packed is None:
+                continue
+            pair = first + second
+            key = int.from_bytes(pair.encode('ascii'), sys.byteorder)
+            if key in move_table:
+                # '+' appears twice in the alphabet; str.index always resolves the first one.
+                continue
+            move = chess.Move(*packed)
+            packed_table[key] = packed
+            move_table[key] = move
+
+            if not move:
+                continue
+            uci = move.uci()
+            encode.setdefault(uci, pair)
+            if move.drop is not None:
+                encode.setdefault(uci[0].lower() + uci[1:], pair)
+
+    return packed_table, move_table, encode
+
+
+_PACKED_TABLE, _MOVE_TABLE, _ENCODE = _build_tables()
+
+
+def _decode(n, table):
+    if isinstance(n, str):
+        n = n.encode('ascii')
+    data = memoryview(n).cast('B')
+    if len(data) % 2:
+        raise ValueError(f"TCN string has odd length: {len(data)}")
+    try:
+        return list(map(table.__getitem__, data.cast('H')))
+    except KeyError as e:
+        pair = e.args[0].to_bytes(2, sys.byteorder)
+        raise ValueError(f"invalid TCN pair: {pair!r}") from None
+
 
-def _move_dict_to_obj(move_dict):
-    move_obj = chess.Move(
-        from_square=(
-            chess.parse_square(move_dict['to_square'])
-            if move_dict['from_square'] is None
-            else chess.parse_square(move_dict['from_square'])
-        ),
-        to_square=(
-            None
-            if move_dict['to_square'] is None
-            else chess.parse_square(move_dict['to_square'])
-        ),
-        drop=(
-            None
-            if move_dict['drop'] is None
-            else chess.Piece.from_symbol(move_dict['drop']).piece_type
-        ),
-        promotion=(
-            None
-            if move_dict['promotion'] is None
-            else chess.Piece.from_symbol(move_dict['promotion']).piece_type
-        ),
-    )
-    return move_obj
-
-
-# tcn_decode and tcn_encode are 1:1 port of chess-tcn npm library that chess.com uses
 def tcn_decode(n):
-    tcn_chars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!?{~}(^)[_]@#$,./&-*++='
-    piece_chars = 'qnrbkp'
-    w = len(n)
-    c = []
-    for i in range(0, w, 2):
-        u = {
-            'from_square': None,
-            'to_square': None,
-            'drop': None,
-            'promotion': None,
-        }
-        o = tcn_chars.index(n[i])
-        s = tcn_chars.index(n[i + 1])
-        if s > 63:
-            u['promotion'] = piece_chars[math.floor((s - 64) / 3)]
-            s = o + (-8 if o < 16 else 8) + ((s - 1) % 3) - 1
-        if o > 75:
-            u['drop'] = piece_chars[o - 79]
-        else:
-            u['from_square'] = tcn_chars[o % 8] + str(math.floor(o / 8) + 1)
-        u['to_square'] = tcn_chars[s % 8] + str(math.floor(s / 8) + 1)
-        move = _move_dict_to_obj(u)
-        c.append(move)
-    return c
+    """
+    Decode a whole TCN game string in one pass.
+
+    :param n: The TCN string, as str or any bytes-like object.
+    :return: A list of chess.Move objects. They are shared lookup table entries and must not be mutated.
+    """
+    return _decode(n, _MOVE_TABLE)
+
+
+def tcn_decode_packed(n):
+    """
+    Decode a whole TCN game string into packed move tuples.
+
+    :param n: The TCN string, as str or any bytes-like object.
+    :return: A list of (from_square, to_square, promotion, drop) tuples; chess.Move(*t) rebuilds a move.
+    """
+    return _decode(n, _PACKED_TABLE)
 
 
 def tcn_encode(n):
-    tcn_chars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!?{~}(^)[_]@#$,./&-*++='
-    piece_chars = 'qnrbkp'
-    o = len(n)
-    w = ''
-    for i in range(o):
-        if n[i][1] == '@':
-            s = 79 + piece_chars.index(n[i][0].lower())
-        else:
-            s = tcn_chars.index(n[i][0]) + 8 * (
-                int(n[i][1]) - 1
-            )
-        u = tcn_chars.index(n[i][2]) + 8 * (int(n[i][3]) - 1)
-        if len(n[i]) > 4:
-            add_u = 9 + u - s if u < s else u - s - 7
-            u = 3 * piece_chars.index(n[i][4]) + 64 + add_u
-        w += tcn_chars[s]
-        w += tcn_chars[u]
-    return w
\ No newline at end of file
+    """
+    Encode a list of moves in UCI format (drops as 'P@e4' or 'p@e4') into a TCN string.
+
+    :param n: The moves to encode.
+    :return: The TCN string.
+    """
+    try:
+        return ''.join([_ENCODE[move] for move in n])
+    except KeyError as e:
+        raise ValueError(f"cannot encode move: {e.args[0]!r}") from None
+
+
+def tcn_encode_bytes(n):
+    """
+    Encode a list of moves in UCI format into an ASCII TCN bytes object.
+
+    :param n: The moves to encode.
+    :return: The TCN bytes.
+    """
+    return tcn_encode(n).encode('ascii')
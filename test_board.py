@@ -0,0 +1,45 @@
+import random
+
+import chess
+import pytest
+from chess.variant import CrazyhouseBoard
+
+from board import BughouseBoard, _may_give_check, checking_squares
+
+
+def missed_checks(board):
+    king = board.king(not board.turn)
+    checking = checking_squares(board, king)
+    return [move.uci() for move in board.legal_moves
+            if board.gives_check(move) and not _may_give_check(board, move, king, checking)]
+
+
+@pytest.mark.parametrize("fen", [
+    "8/6k1/8/8/8/2K5/8/B7 w - - 0 1",  # King move uncovering a bishop
+    "4k3/8/8/8/4K3/8/8/4R3 w - - 0 1",  # King move uncovering a rook
+    "4k3/8/8/8/8/8/8/R3K2R w KQ - 0 1",  # Castling into check
+    "4k3/8/8/3pP3/8/8/8/4K3 w - d6 0 2",  # En passant
+    "r1bqkbnr/pppp1ppp/2n5/4p3/2B1P3/5Q2/PPPP1PPP/RNB1K1NR[Nn] w KQkq - 4 4",  # Drops
+])
+def test_no_check_is_missed(fen):
+    assert missed_checks(CrazyhouseBoard(fen)) == []
+
+
+def test_king_discovered_check_is_kept():
+    board = CrazyhouseBoard("8/6k1/8/8/8/2K5/8/B7 w - - 0 1")
+    move = chess.Move.from_uci("c3c4")
+    assert board.gives_check(move)
+    assert _may_give_check(board, move, board.king(chess.BLACK), checking_squares(board, board.king(chess.BLACK)))
+
+
+def test_no_check_is_missed_in_random_games():
+    rng = random.Random(7)
+    for _ in range(20):
+        board = BughouseBoard()
+        for _ in range(80):
+            board_num = rng.randrange(2)
+            crazyhouse = board.boards[board_num]
+            if crazyhouse.is_game_over():
+                break
+            assert missed_checks(crazyhouse) == []
+            board.push_uci(board_num, rng.choice(sorted(crazyhouse.legal_moves, key=chess.Move.uci)).uci())
@@ -0,0 +1,99 @@
+import json
+
+import pytest
+
+from board import BughouseBoard
+from book import BookMove, BookWriter, OpeningBook, book_key, open_book, write_book
+from book_builder import BookBuilder, merge_runs, read_run, replay_games, write_run
+from tcn import tcn_encode
+
+
+def game(board_1, board_2, result):
+    return json.dumps({"moves": [tcn_encode(board_1), tcn_encode(board_2)], "result": result}) + "\n"
+
+
+def test_book_round_trip(tmp_path):
+    path = str(tmp_path / "book.bin")
+    entries = {key: [BookMove("e2e4", 3, 3, 0.5), BookMove("d2d4", 7, 7, 0.75)] for key in (5, 1 << 63, 42)}
+    write_book(path, entries)
+    with OpeningBook(path) as book:
+        assert len(book) == 3
+        for key in entries:
+            assert key in book
+            moves = book.probe(key)
+            assert [(move.move, move.weight, move.games) for move in moves] == [("d2d4", 7, 7), ("e2e4", 3, 3)]
+            assert moves[0].score == pytest.approx(0.75)
+        assert 6 not in book
+        assert book.probe(6) == []
+
+
+def test_book_lookup_by_position(tmp_path):
+    path = str(tmp_path / "book.bin")
+    board = BughouseBoard()
+    write_book(path, {book_key(board, 0): [BookMove("e2e4", 1)]})
+    with OpeningBook(path) as book:
+        assert book.choose(board, 0) == "e2e4"
+        board.push_uci(1, "d2d4")
+        assert book.choose(board, 1) is None
+
+
+def test_writer_rejects_unsorted_keys(tmp_path):
+    with pytest.raises(ValueError):
+        with BookWriter(str(tmp_path / "book.bin")) as writer:
+            writer.add(2, [BookMove("e2e4", 1)])
+            writer.add(1, [BookMove("e2e4", 1)])
+    assert not (tmp_path / "book.bin").exists()
+
+
+def test_open_book_without_a_book(tmp_path):
+    assert open_book(str(tmp_path / "missing.bin")) is None
+    (tmp_path / "junk.bin").write_bytes(b"not a book")
+    assert open_book(str(tmp_path / "junk.bin")) is None
+
+
+def test_replay_counts_both_teams():
+    counts, replayed, skipped = replay_games([game(["e2e4"], ["d2d4", "d7d5"], "1-0")])
+    assert (replayed, skipped) == (1, 0)
+    board = BughouseBoard()
+    # Team A won: white on board 1 scores, white on board 2 (team B) does not.
+    assert counts[(book_key(board, 0), b"e2e4")] == [1, 2]
+    assert counts[(book_key(board, 1), b"d2d4")] == [1, 0]
+
+
+def test_replay_skips_bad_games_entirely():
+    lines = [game(["e2e4"], [], "1-0"), "not json\n", json.dumps({"moves": ["mC", ""], "result": "?"}),
+             json.dumps({"moves": [tcn_encode(["e2e4", "e7e5"]) + "mC", ""], "result": "0-1"})]
+    counts, replayed, skipped = replay_games(lines)
+    assert (replayed, skipped) == (1, 3)
+    assert counts == {(book_key(BughouseBoard(), 0), b"e2e4"): [1, 2]}
+
+
+def test_merge_runs_adds_up_equal_records(tmp_path):
+    runs = []
+    for i, counts in enumerate([{(1, b"a"): [1, 2], (3, b"c"): [1, 0]},
+                                {(1, b"a"): [2, 1], (2, b"b"): [1, 1]},
+                                {(3, b"c"): [4, 4], (1, b"z"): [1, 0]}]):
+        runs.append(str(tmp_path / f"run-{i}.bin"))
+        write_run(runs[-1], counts)
+    assert [record[:2] for record in read_run(runs[0])] == [(1, b"a".ljust(8, b"\0")), (3, b"c".ljust(8, b"\0"))]
+    merged = [(key, move.rstrip(b"\0"), games, half_points) for key, move, games, half_points in merge_runs(runs)]
+    assert merged == [(1, b"a", 3, 3), (1, b"z", 1, 0), (2, b"b", 1, 1), (3, b"c", 5, 4)]
+
+
+def test_build_with_spilled_runs(tmp_path):
+    archive = tmp_path / "games.jsonl"
+    archive.write_text(game(["e2e4", "e7e5"], [], "1-0") * 3 + game(["e2e4", "c7c5"], [], "0-1") * 2
+                       + game(["d2d4"], [], "1-0"))
+    path = str(tmp_path / "book.bin")
+    builder = BookBuilder(workers=1, min_games=2, chunk_games=2, spill_entries=1, tmp_dir=str(tmp_path))
+    assert builder.build([str(archive)], path) == 2
+    assert (builder.games, builder.skipped) == (6, 0)
+    assert builder.runs > 1
+
+    board = BughouseBoard()
+    with OpeningBook(path) as book:
+        start = book.lookup(board, 0)
+        assert [(move.move, move.games) for move in start] == [("e2e4", 5)]  # d2d4 was played once
+        assert start[0].score == pytest.approx(0.6)
+        board.push_uci(0, "e2e4")
+        assert {move.move: move.games for move in book.lookup(board, 0)} == {"e7e5": 3, "c7c5": 2}
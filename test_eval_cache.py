@@ -0,0 +1,62 @@
+import chess
+
+from board import BughouseBoard
+from eval_cache import EvalCache, position_key
+
+
+def test_hit_needs_a_long_enough_search():
+    cache = EvalCache()
+    cache.put(1, "e2e4", 0.5, 1000, 200)
+    assert cache.get(1, 300) is None
+    entry = cache.get(1, 200)
+    assert (entry.best_move, entry.q, entry.nodes, entry.movetime) == ("e2e4", 0.5, 1000, 200)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_deeper_result_is_kept():
+    cache = EvalCache()
+    cache.put(1, "e2e4", 0.5, 1000, 500)
+    cache.put(1, "d2d4", 0.1, 10, 100)
+    assert cache.get(1).best_move == "e2e4"
+    cache.put(1, "c2c4", 0.7, 2000, 800)
+    assert cache.get(1).best_move == "c2c4"
+
+
+def test_least_recently_used_is_evicted():
+    cache = EvalCache(capacity=2)
+    cache.put(1, "a2a3", 0, 1, 100)
+    cache.put(2, "b2b3", 0, 1, 100)
+    cache.get(1)
+    cache.put(3, "c2c3", 0, 1, 100)
+    assert len(cache) == 2
+    assert cache.get(2) is None
+    assert cache.get(1) is not None and cache.get(3) is not None
+
+
+def test_results_persist(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = EvalCache(path)
+    key = (1 << 64) - 1  # Stored as a signed sqlite integer
+    cache.put(key, "e2e4", 0.5, 1000, 300)
+    cache.put(2, "d2d4", 0.1, 10, 300)
+    cache.put(2, "c2c4", 0.2, 20, 100)
+    cache.close()
+
+    cache = EvalCache(path, capacity=1)
+    assert len(cache) == 0
+    assert cache.get(key, 300).best_move == "e2e4"
+    assert cache.get(2, 300).best_move == "d2d4"
+    cache.close()
+
+
+def test_position_key_depends_on_team_and_mode():
+    board = BughouseBoard()
+    keys = {position_key(board, side, mode) for side in (chess.WHITE, chess.BLACK) for mode in ("go", "sit")}
+    assert len(keys) == 4
+    other = BughouseBoard()
+    other.push_uci(0, "g1f3")
+    other.push_uci(0, "g8f6")
+    other.push_uci(0, "f3g1")
+    other.push_uci(0, "f6g8")
+    # Move counters are not part of the key.
+    assert position_key(other, chess.WHITE, "go") == position_key(board, chess.WHITE, "go")
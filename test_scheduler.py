@@ -0,0 +1,155 @@
+import queue
+import threading
+import time
+
+import pytest
+
+from scheduler import EngineScheduler, Preempted, Priority
+
+
+class FakeEngine:
+    """
+    Searches by waiting until its movetime passes or it is stopped, with search ids as Engine.
+    """
+
+    def __init__(self):
+        self.searches = 0
+        self._searching = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def search(self, seconds):
+        with self._lock:
+            self.searches += 1
+            self._searching = self.searches
+            self._stopped.clear()
+        stopped = self._stopped.wait(seconds)
+        with self._lock:
+            self._searching = None
+        return "stopped" if stopped else "done"
+
+    def stop(self, search=None):
+        with self._lock:
+            if self._searching is None or (search is not None and search != self._searching):
+                return False
+            self._stopped.set()
+            return True
+
+
+class FakePool:
+    def __init__(self, size):
+        self.engines = [FakeEngine() for _ in range(size)]
+        self._idle = queue.Queue()
+        for engine in self.engines:
+            self._idle.put(engine)
+
+    def __len__(self):
+        return len(self.engines)
+
+    def checkout(self):
+        return self._idle.get()
+
+    def checkin(self, engine):
+        self._idle.put(engine)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = EngineScheduler(FakePool(1))
+    yield scheduler
+    scheduler.close()
+
+
+def search(engine, name, seconds, order):
+    order.append(name)
+    return name, engine.search(seconds)
+
+
+def occupy(scheduler, seconds=0.2):
+    # Keep the only engine busy while the test queues jobs behind it.
+    future = scheduler.submit(search, "busy", seconds, [], priority=Priority.MUST_MOVE)
+    time.sleep(0.05)
+    return future
+
+
+def test_priority_order(scheduler):
+    order = []
+    busy = occupy(scheduler)
+    futures = [scheduler.submit(search, "analysis", 0.01, order, priority=Priority.ANALYSIS),
+               scheduler.submit(search, "speculation", 0.01, order, priority=Priority.SPECULATION),
+               scheduler.submit(search, "ponder", 0.01, order, priority=Priority.PONDER),
+               scheduler.submit(search, "late", 0.01, order, priority=Priority.MUST_MOVE, deadline=5),
+               scheduler.submit(search, "early", 0.01, order, priority=Priority.MUST_MOVE, deadline=1)]
+    for future in [busy] + futures:
+        future.result(5)
+    assert order == ["early", "late", "ponder", "speculation", "analysis"]
+
+
+def test_fair_share_within_a_class(scheduler):
+    order = []
+    scheduler.submit(search, "heavy", 0.2, [], priority=Priority.ANALYSIS, session="a").result(5)
+    busy = occupy(scheduler)
+    futures = [scheduler.submit(search, "a", 0.01, order, priority=Priority.SPECULATION, session="a"),
+               scheduler.submit(search, "b", 0.01, order, priority=Priority.SPECULATION, session="b")]
+    for future in [busy] + futures:
+        future.result(5)
+    assert order == ["b", "a"]
+
+
+def test_must_move_preempts_ponder(scheduler):
+    ponder = scheduler.submit(search, "ponder", 5, [], priority=Priority.PONDER)
+    time.sleep(0.05)
+    started = time.monotonic()
+    move = scheduler.submit(search, "move", 0.01, [], priority=Priority.MUST_MOVE)
+    assert move.result(5) == ("move", "done")
+    assert time.monotonic() - started < 1
+    with pytest.raises(Preempted):
+        ponder.result(5)
+    assert scheduler.preemptions == 1
+
+
+def test_stop_running_and_queued_jobs(scheduler):
+    running = scheduler.submit(search, "running", 5, [], priority=Priority.PONDER)
+    time.sleep(0.05)
+    queued = scheduler.submit(search, "queued", 0.01, [], priority=Priority.ANALYSIS)
+    scheduler.stop(queued)
+    scheduler.stop(running)
+    assert running.result(1) == ("running", "stopped")
+    assert queued.cancelled()
+
+
+def test_timeout_stops_the_search(scheduler):
+    assert scheduler.submit(search, "slow", 5, [], priority=Priority.PONDER, timeout=0.05).result(1) == ("slow", "stopped")
+
+
+def test_late_stop_does_not_reach_the_next_job(scheduler):
+    first = scheduler.submit(search, "first", 0.01, [], priority=Priority.PONDER)
+    first.result(1)
+    second = scheduler.submit(search, "second", 0.2, [], priority=Priority.MUST_MOVE)
+    time.sleep(0.05)
+    scheduler.stop(first)
+    assert second.result(1) == ("second", "done")
+
+
+def test_waiting_speculation_expires(scheduler):
+    busy = occupy(scheduler)
+    expiring = scheduler.submit(search, "expiring", 0.01, [], priority=Priority.SPECULATION, deadline=0.01)
+    busy.result(5)
+    time.sleep(0.05)
+    assert expiring.cancelled()
+    assert scheduler.expired == 1
+
+
+def test_reprioritized_job_runs_first(scheduler):
+    order = []
+    busy = occupy(scheduler)
+    analysis = scheduler.submit(search, "analysis", 0.01, order, priority=Priority.ANALYSIS)
+    ponder = scheduler.submit(search, "ponder", 0.01, order, priority=Priority.PONDER)
+    scheduler.reprioritize(analysis, Priority.MUST_MOVE, deadline=1)
+    for future in (busy, analysis, ponder):
+        future.result(5)
+    assert order == ["analysis", "ponder"]
+    assert set(scheduler.usage()[""]) >= {"recent", "must_move", "ponder"}
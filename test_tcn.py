@@ -0,0 +1,69 @@
+import random
+
+import chess
+import pytest
+
+from board import BughouseBoard
+from tcn import tcn_decode, tcn_decode_packed, tcn_encode, tcn_encode_bytes
+
+
+def random_game(seed, plies=60):
+    rng = random.Random(seed)
+    board = BughouseBoard()
+    moves = [[], []]
+    for _ in range(plies):
+        board_num = rng.randrange(2)
+        legal = sorted(board.boards[board_num].legal_moves, key=chess.Move.uci)
+        if not legal:
+            break
+        move = rng.choice(legal).uci()
+        board.push_uci(board_num, move)
+        moves[board_num].append(move)
+    return moves
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_round_trip(seed):
+    for moves in random_game(seed):
+        encoded = tcn_encode(moves)
+        assert [move.uci() for move in tcn_decode(encoded)] == moves
+        assert tcn_decode(tcn_encode_bytes(moves)) == tcn_decode(encoded)
+        assert [chess.Move(*packed) for packed in tcn_decode_packed(encoded)] == tcn_decode(encoded)
+
+
+@pytest.mark.parametrize("moves", [["e7e8q"], ["a2a1n"], ["b7a8r"], ["h2g1b"], ["P@e4"], ["N@f7"], ["Q@d1"]])
+def test_promotions_and_drops(moves):
+    assert [move.uci() for move in tcn_decode(tcn_encode(moves))] == moves
+
+
+def test_lowercase_drops_encode_like_uppercase():
+    assert tcn_encode(["p@e4", "r@a1"]) == tcn_encode(["P@e4", "R@a1"])
+
+
+def test_duplicate_plus_is_a_bishop_drop():
+    # '+' is in the alphabet twice; like chess-tcn, it always decodes as the first one.
+    assert tcn_decode("+C") == [chess.Move.from_uci("B@e4")]
+
+
+def test_king_drop_cannot_be_encoded():
+    with pytest.raises(ValueError):
+        tcn_encode(["K@e4"])
+
+
+@pytest.mark.parametrize("tcn", [
+    "a",  # Odd length
+    ",a",  # First character past the squares but below the drop pieces
+    "a{",  # Promotion from a1, which lands off the board
+    "i+",  # Promotion to a piece that does not exist
+    "mC\x00\x00",  # Characters outside the alphabet
+])
+def test_invalid_strings_are_rejected(tcn):
+    with pytest.raises(ValueError):
+        tcn_decode(tcn)
+    with pytest.raises(ValueError):
+        tcn_decode_packed(tcn)
+
+
+def test_non_ascii_is_rejected():
+    with pytest.raises(ValueError):
+        tcn_decode("mCé!")
@@ -0,0 +1,135 @@
+import types
+
+import pytest
+
+from framing import CommandTooLong, LineBuffer
+from server import GameSession
+from tcn import tcn_encode
+from tracker import GameTracker
+
+BOARD_1 = ["e2e4", "d7d5", "e4d5", "d8d5"]
+BOARD_2 = ["d2d4", "g8f6"]
+
+
+class FakeClient:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, text):
+        self.sent.append(text)
+
+
+def make_session():
+    server = types.SimpleNamespace(scheduler=None, cache=None, book=None, quick_search=None,
+                                   pondering=False, speculation_width=0, coalesce_window=0)
+    return GameSession(server, "test")
+
+
+def delta(board_num, seq, moves):
+    return f"delta {board_num} {seq} {tcn_encode(moves)}"
+
+
+# --------------------------
+# GameTracker
+# --------------------------
+def test_extend_matches_full_update():
+    full = GameTracker()
+    full.update([tcn_encode(BOARD_1), tcn_encode(BOARD_2)])
+
+    tracker = GameTracker()
+    assert tracker.extend(0, tcn_encode(BOARD_1[:2]))
+    assert tracker.extend(1, tcn_encode(BOARD_2))
+    assert tracker.extend(0, tcn_encode(BOARD_1[2:]))
+    assert tracker.received_plies(0) == len(BOARD_1)
+    assert tracker.board.zobrist == full.board.zobrist
+
+
+def test_pending_drop_waits_for_capture():
+    tracker = GameTracker()
+    # Black on board 2 drops the pawn white captures on board 1.
+    assert not tracker.update(["", tcn_encode(["e2e4", "p@e5"])])
+    assert tracker.pending == [0, 1]
+    assert tracker.update([tcn_encode(BOARD_1[:3]), tcn_encode(["e2e4", "p@e5"])])
+    assert tracker.moves_snapshot.endswith("2P@e5")
+
+
+def test_rewind_after_takeback():
+    tracker = GameTracker()
+    tracker.update([tcn_encode(BOARD_1[:2]), tcn_encode(BOARD_2[:1])])
+    before = (tracker.board.zobrist, tracker.moves_snapshot)
+
+    tracker.update([tcn_encode(BOARD_1), tcn_encode(BOARD_2)])
+    assert tracker.update([tcn_encode(BOARD_1[:2]), tcn_encode(BOARD_2[:1])])
+    assert (tracker.board.zobrist, tracker.moves_snapshot) == before
+    assert tracker.tcn == [tcn_encode(BOARD_1[:2]), tcn_encode(BOARD_2[:1])]
+
+
+def test_new_game_resets():
+    tracker = GameTracker()
+    tracker.update([tcn_encode(BOARD_1), tcn_encode(BOARD_2)])
+    assert tracker.update([tcn_encode(["d2d4"]), ""])
+    assert tracker.moves_snapshot == "1d2d4"
+
+
+# --------------------------
+# Delta updates
+# --------------------------
+def test_delta_appends_moves():
+    session, client = make_session(), FakeClient()
+    assert session.apply_command(client, delta(0, 0, BOARD_1[:2]))
+    assert session.apply_command(client, delta(0, 2, BOARD_1[2:]))
+    assert session.moves[0] == tcn_encode(BOARD_1)
+    assert session.moves_snapshot == " ".join(f"1{move}" for move in BOARD_1)
+    assert client.sent == []
+
+
+def test_delta_overlap_is_trimmed():
+    session, client = make_session(), FakeClient()
+    session.apply_command(client, delta(0, 0, BOARD_1[:3]))
+    # The partner's client reports the same board from an older starting point.
+    assert session.apply_command(client, delta(0, 1, BOARD_1[1:]))
+    assert session.moves[0] == tcn_encode(BOARD_1)
+    assert session.tracker.received_plies(0) == len(BOARD_1)
+
+
+def test_delta_duplicate_is_dropped():
+    session, client = make_session(), FakeClient()
+    session.apply_command(client, delta(0, 0, BOARD_1))
+    assert not session.apply_command(client, delta(0, 2, BOARD_1[2:]))
+    assert session.update_counts["duplicates"] == 1
+    assert session.moves[0] == tcn_encode(BOARD_1)
+
+
+def test_delta_gap_requests_resync():
+    session, client = make_session(), FakeClient()
+    session.apply_command(client, delta(1, 0, BOARD_2[:1]))
+    assert not session.apply_command(client, delta(1, 3, ["e2e4"]))
+    assert client.sent == ["resync 1\n"]
+    assert session.moves[1] == tcn_encode(BOARD_2[:1])
+
+    # The full string the client answers with replaces the partial one.
+    assert session.apply_command(client, f"moves 1 {tcn_encode(BOARD_2)}")
+    assert session.tracker.received_plies(1) == len(BOARD_2)
+
+
+# --------------------------
+# Line framing
+# --------------------------
+def test_commands_split_across_reads():
+    lines = LineBuffer()
+    assert lines.feed(b"side 0\ntimes 0 17") == ["side 0"]
+    assert lines.feed(b"00 1700\r\n\nmo") == ["times 0 1700 1700"]
+    assert lines.feed(b"ves 0 mC\n") == ["moves 0 mC"]
+
+
+def test_command_longer_than_buffer():
+    lines = LineBuffer(size=16)
+    command = "moves 0 " + "mC" * 100
+    assert lines.feed(command.encode()) == []
+    assert lines.feed(b"\nside 1\n") == [command, "side 1"]
+
+
+def test_oversized_command_is_rejected():
+    lines = LineBuffer(size=16, max_command=64)
+    with pytest.raises(CommandTooLong):
+        lines.feed(b"x" * 100)
@@ -0,0 +1,131 @@
+from board import BughouseBoard
+from tcn import tcn_decode
+
+
+class GameTracker:
+    """
+    Keeps a BughouseBoard in sync with the TCN move strings of both boards.
+
+    Instead of replaying the whole game on every update like parse_moves, the tracker
+    only decodes and pushes the moves that were appended since the last update. When
+    a board's string no longer extends what was applied (takebacks, a new game, or the
+    two boards being reported in a different order), it pops moves back to the common
+    prefix and replays from there.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Forget every applied move and start from the initial position.
+        """
+        self.board = BughouseBoard()
+        self.tcn = ["", ""]  # Applied prefix of each board's TCN string
+        self.moves_snapshot = ""  # Applied moves in "1e2e4 2d7d5" form, in push order
+        self._offsets = []  # len(self.moves_snapshot) before each push
+        self._pending = [[], []]
+        self._received = ["", ""]  # Every TCN move received per board, applied or pending
+
+    @property
+    def pending(self):
+        """
+        Number of received moves that could not be applied yet, per board.
+        """
+        return [len(self._pending[0]), len(self._pending[1])]
+
+    def update(self, tcn_moves):
+        """
+        Bring the board up to date with the TCN move strings of both boards.
+
+        A drop whose piece has not reached the pocket yet is held back until the
+        capture that provides it arrives from the other board.
+
+        :param tcn_moves: The TCN move strings of board 1 and board 2.
+        :return: True if every received move has been applied.
+        """
+        keep = [_common_prefix(self.tcn[b], tcn_moves[b]) for b in range(2)]
+        if keep[0] == 0 and keep[1] == 0 and (self.tcn[0] or self.tcn[1]):
+            self.reset()
+        else:
+            self._rewind(keep)
+
+        for b in range(2):
+            self._pending[b] = tcn_decode(tcn_moves[b][len(self.tcn[b]):])
+        self._received = list(tcn_moves)
+        self._apply_pending(tcn_moves)
+
+        return not (self._pending[0] or self._pending[1])
+
+    def extend(self, board_num, tcn_moves):
+        """
+        Append moves to one board without comparing anything already received, for updates
+        known to continue the current game.
+
+        :param board_num: The board, 0 or 1.
+        :param tcn_moves: TCN of the moves that follow every move received for that board so
+            far, including moves that are still pending.
+        :return: True if every received move has been applied.
+        """
+        self._received[board_num] += tcn_moves
+        self._pending[board_num].extend(tcn_decode(tcn_moves))
+        self._apply_pending(self._received)
+
+        return not (self._pending[0] or self._pending[1])
+
+    def received_plies(self, board_num):
+        """
+        Number of moves received for a board, applied or pending.
+        """
+        return len(self._received[board_num]) // 2
+
+    def _rewind(self, keep):
+        plies = [len(self.tcn[0]) // 2, len(self.tcn[1]) // 2]
+        history = self.board.board_order
+        offset = None
+        while plies[0] * 2 > keep[0] or plies[1] * 2 > keep[1]:
+            plies[history[-1]] -= 1
+            self.board.pop()
+            offset = self._offsets.pop()
+
+        if offset is not None:
+            self.moves_snapshot = self.moves_snapshot[:offset]
+            self.tcn = [self.tcn[0][:plies[0] * 2], self.tcn[1][:plies[1] * 2]]
+
+    def _apply_pending(self, tcn_moves):
+        # Same ordering rule as parse_moves: board 1 moves go first unless a drop
+        # needs a piece that a board 2 capture has not delivered yet.
+        pending = self._pending
+        index = [0, 0]
+        snapshot = self.moves_snapshot
+        while True:
+            for b in range(2):
+                if index[b] < len(pending[b]) and self.board.can_drop(b, pending[b][index[b]]):
+                    break
+            else:
+                break
+
+            self._offsets.append(len(snapshot))
+            uci = self.board.push(b, pending[b][index[b]])
+            snapshot += f" {b + 1}{uci}" if snapshot else f"{b + 1}{uci}"
+            index[b] += 1
+
+        self.moves_snapshot = snapshot
+        for b in range(2):
+            start = len(self.tcn[b])
+            self.tcn[b] += tcn_moves[b][start:start + 2 * index[b]]
+            pending[b] = pending[b][index[b]:]
+
+
+def _common_prefix(applied, received):
+    """
+    Length of the longest common prefix of two TCN strings, rounded down to whole moves.
+    """
+    if received.startswith(applied):
+        return len(applied)
+    n = 0
+    for a, r in zip(applied, received):
+        if a != r:
+            break
+        n += 1
+    return n - n % 2
@@ -0,0 +1,161 @@
+class SearchInfo:
+    """
+    One UCI "info" line, tokenized once. Fields the line does not mention are None.
+    """
+
+    __slots__ = ('depth', 'seldepth', 'time', 'nodes', 'nps', 'score_cp', 'score_mate', 'q', 'pv', 'string')
+
+    def __init__(self):
+        self.depth = None
+        self.seldepth = None
+        self.time = None  # Milliseconds since the search started
+        self.nodes = None
+        self.nps = None
+        self.score_cp = None
+        self.score_mate = None
+        self.q = None  # hivemind's "Q value", in [-1, 1]
+        self.pv = None
+        self.string = None
+
+    def update(self, other):
+        """
+        Copy every field that is set on another record into this one.
+
+        :param other: A newer SearchInfo.
+        """
+        for name in self.__slots__:
+            value = getattr(other, name)
+            if value is not None:
+                setattr(self, name, value)
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__ if getattr(self, name) is not None)
+        return f"SearchInfo({fields})"
+
+
+class SearchResult:
+    """
+    The outcome of one "go": the best move, the expected reply and the merged info records.
+    """
+
+    def __init__(self, best_move, ponder_move, info, movetime, elapsed):
+        self.best_move = best_move
+        self.ponder_move = ponder_move
+        self.info = info  # SearchInfo with the last value seen for every field
+        self.movetime = movetime  # Requested search time in milliseconds
+        self.elapsed = elapsed  # Seconds from "go" to "bestmove", measured on our side
+
+    @property
+    def overrun(self):
+        """
+        Milliseconds the search took beyond the requested movetime.
+        """
+        return self.elapsed * 1000 - self.movetime
+
+    def __repr__(self):
+        return f"SearchResult({self.best_move!r}, ponder={self.ponder_move!r}, elapsed={self.elapsed:.3f}, {self.info!r})"
+
+
+_INT_FIELDS = {'depth', 'seldepth', 'time', 'nodes', 'nps'}
+# Keywords whose value is a single token we do not keep.
+_SKIPPED_FIELDS = {'multipv', 'currmove', 'currmovenumber', 'hashfull', 'tbhits', 'sbhits', 'cpuload'}
+
+
+def parse_info(line):
+    """
+    Tokenize a UCI "info" line into a SearchInfo.
+
+    Understands the standard fields plus hivemind's "Q value <q>", which may appear on
+    its own or inside "info string".
+
+    :param line: The line, with or without the leading "info".
+    :return: The parsed record.
+    """
+    info = SearchInfo()
+    tokens = line.split()
+    n = len(tokens)
+    i = 1 if tokens and tokens[0] == 'info' else 0
+    while i < n:
+        token = tokens[i]
+        if token in _INT_FIELDS:
+            if i + 1 < n:
+                try:
+                    setattr(info, token, int(tokens[i + 1]))
+                except ValueError:
+                    pass
+            i += 2
+        elif token == 'score':
+            i += 1
+            while i + 1 < n and tokens[i] in ('cp', 'mate'):
+                try:
+                    value = int(tokens[i + 1])
+                except ValueError:
+                    break
+                if tokens[i] == 'cp':
+                    info.score_cp = value
+                else:
+                    info.score_mate = value
+                i += 2
+            while i < n and tokens[i] in ('lowerbound', 'upperbound'):
+                i += 1
+        elif token == 'pv':
+            info.pv = tokens[i + 1:]
+            break
+        elif token == 'string':
+            info.string = ' '.join(tokens[i + 1:])
+            for j in range(i + 1, len(tokens)):
+                if tokens[j] == 'Q' and _parse_q(info, tokens, j) == j + 3:
+                    break
+            break
+        elif token == 'Q':
+            i = _parse_q(info, tokens, i)
+        elif token in _SKIPPED_FIELDS:
+            i += 2
+        else:
+            i += 1
+    return info
+
+
+def merge_info_lines(lines, required=('depth', 'nodes', 'q', 'pv')):
+    """
+    Build the record holding the newest value of every field from raw info lines.
+
+    Lines are parsed newest first and parsing stops once every required field is
+    known, so a search that nobody watched live only pays for a few lines.
+
+    :param lines: Info lines in the order the engine printed them.
+    :param required: Fields that must be found before older lines can be skipped.
+    :return: The merged SearchInfo.
+    """
+    info = SearchInfo()
+    for line in reversed(lines):
+        older = parse_info(line)
+        for name in SearchInfo.__slots__:
+            if getattr(info, name) is None:
+                setattr(info, name, getattr(older, name))
+        if all(getattr(info, name) is not None for name in required):
+            break
+    return info
+
+
+def _parse_q(info, tokens, i):
+    # tokens[i] is 'Q'. Returns the index of the next field.
+    if i + 2 < len(tokens) and tokens[i + 1] == 'value':
+        try:
+            info.q = float(tokens[i + 2])
+        except ValueError:
+            pass
+        return i + 3
+    return i + 1
+
+
+def parse_bestmove(line):
+    """
+    Split a "bestmove <move> [ponder <move>]" line.
+
+    :return: (best_move, ponder_move); ponder_move is None if the engine gave none.
+    """
+    tokens = line.split()
+    best_move = tokens[1] if len(tokens) > 1 else None
+    ponder_move = tokens[3] if len(tokens) > 3 and tokens[2] == 'ponder' else None
+    return best_move, ponder_move